@@ -4,7 +4,9 @@ import * as d3 from "d3";
 import { useEffect, useRef, useState } from "react";
 import { Typography } from "@mui/material";
 
-export const MultiLinePlot = ({ series }) => {
+// onWidthChange: 描画幅（px）が変わったときに呼ばれる。呼び出し側はこの幅に合わせて
+// サーバー側で間引いたデータ（QueryService.downsample / to_plot_series）を渡す
+export const MultiLinePlot = ({ series, onWidthChange }) => {
   const containerRef = useRef(null);
   const svgRef = useRef(null);
   const tooltipRef = useRef(null);
@@ -13,6 +15,11 @@ export const MultiLinePlot = ({ series }) => {
     height: 300,
     fontSize: 14,
   });
+  // onWidthChangeは毎回の描画で最新のものに更新する（インラインの関数を渡されても
+  // リサイズ用のeffectを再実行しないため）
+  const onWidthChangeRef = useRef(onWidthChange);
+  onWidthChangeRef.current = onWidthChange;
+  const reportedWidthRef = useRef(null);
 
   useEffect(() => {
     const handleResize = () => {
@@ -26,6 +33,13 @@ export const MultiLinePlot = ({ series }) => {
           height: window.innerHeight * 0.5,
           fontSize: baseFontSize,
         });
+
+        // 整数に丸めた幅が変わったときだけ呼び出す
+        const roundedWidth = Math.round(width);
+        if (onWidthChangeRef.current && roundedWidth !== reportedWidthRef.current) {
+          reportedWidthRef.current = roundedWidth;
+          onWidthChangeRef.current(roundedWidth);
+        }
       }
     };
 
@@ -1,12 +1,16 @@
 import os
 import glob
-import zipfile
-import tempfile
 import pandas as pd
 import pyarrow as pa
-import pyarrow.parquet as pq
 from datetime import datetime
 import re
+from concurrent.futures import ProcessPoolExecutor
+from parquet_dataset import (
+    IngestManifest, apply_storage_schema, build_storage_schema, compact_partition, list_partition_files,
+    read_merged, remove_source_rows, resolve_storage_options, write_delta
+)
+from sensor_csv import list_zip_csv_members, open_data_stream, sniff_csv_header, source_name, source_size
+from sensor_metrics import FileTrace, MetricsRecorder
 
 def extract_machine_name(filename):
     """ファイル名から機械名を抽出する関数
@@ -19,41 +23,70 @@ def extract_machine_name(filename):
     else:
         return "unknown_machine"
 
-def process_csv(csv_path, output_dir):
-    """CSVファイルを処理してParquetに変換する関数"""
+def process_csv(csv_path, output_dir, manifest=None, storage_schema=None, metrics=None):
+    """CSVファイルを処理してParquetに変換する関数
+    csv_pathには (ZIPファイルのパス, メンバー名) のタプルも指定できる
+    manifestを指定した場合、前回から変更のないファイルは読み飛ばす
+    storage_schemaを指定した場合、センサー列を保存用スキーマの型（float32など）で保存する
+    metrics（MetricsRecorder）を指定した場合、ステージごとの処理時間などを記録する
+    """
+    if manifest is not None and manifest.is_current(csv_path):
+        print(f"Skipped unchanged: {csv_path}")
+        return True
+    
+    trace = FileTrace(source_name(csv_path))
     try:
-        machine_name = extract_machine_name(csv_path)
+        machine_name = extract_machine_name(source_name(csv_path))
         
         # CSVファイルを読み込む
-        # 最初の3行をヘッダーとして読み込む
-        header_rows = pd.read_csv(csv_path, nrows=3, header=None)
+        # 最初の3行をヘッダーとして読み込む（エンコーディングと区切り文字も判定）
+        with trace.span('sniff'):
+            header = sniff_csv_header(csv_path)
+        header_rows = [[cell if cell != '' else float('nan') for cell in row] for row in header['header_rows']]
         
         # センサーIDは1行目
-        sensor_ids = header_rows.iloc[0].tolist()
+        sensor_ids = header_rows[0]
         # センサー名は2行目
-        sensor_names = header_rows.iloc[1].tolist()
+        sensor_names = list(header_rows[1])
         # 単位は3行目
-        units = header_rows.iloc[2].tolist()
+        units = header_rows[2]
         
         # 最初の列名（日時カラム）が空欄なので'timestamp'とする
         if pd.isna(sensor_names[0]):
             sensor_names[0] = 'timestamp'
         
         # 実際のデータを読み込む（3行目以降）
-        df = pd.read_csv(csv_path, skiprows=3, header=None, names=sensor_names)
+        with trace.span('read') as span, open_data_stream(csv_path, header) as stream:
+            df = pd.read_csv(stream, header=None, names=sensor_names, encoding=header['encoding'], sep=header['delimiter'])
+            span['rows'] = len(df)
         
         # タイムスタンプを日付型に変換
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        with trace.span('timestamp', rows=len(df)):
+            df['timestamp'] = pd.to_datetime(df['timestamp'])
         
         # 年と月を抽出
         df['year'] = df['timestamp'].dt.year
         df['month'] = df['timestamp'].dt.month
         df['machine'] = machine_name
+        # 変更されたファイルの以前の行を取り除けるよう、行ごとに取り込み元を残す
+        df['source_file'] = source_name(csv_path)
+        
+        # 保存用スキーマ（同じヘッダー系列のファイルでは作成済みのものを再利用）
+        storage_options = resolve_storage_options(storage_schema)
+        storage = None
+        if storage_options is not None:
+            storage = build_storage_schema(sensor_names[1:], header['units'][1:], storage_options, fingerprint=header['fingerprint'])
+        
+        # 前回から変更されたファイルは、以前に書き込んだ行を先に取り除く
+        # （差分の追記だけでは、新しいファイルにないタイムスタンプや列の行が残るため）
+        if manifest is not None and manifest.get(csv_path) is not None:
+            remove_previous_rows(csv_path, manifest)
         
         # パーティショニングのためにグループ化
         grouped = df.groupby(['machine', 'year', 'month'])
         
         # グループごとにParquetファイルを作成または追加
+        output_dirs = []
         for (machine, year, month), group_df in grouped:
             # パーティションディレクトリを作成
             partition_dir = os.path.join(output_dir, 
@@ -70,70 +103,170 @@ def process_csv(csv_path, output_dir):
                 'sensor_ids': ','.join(map(str, sensor_ids)),
                 'sensor_names': ','.join(map(str, sensor_names)),
                 'units': ','.join(map(str, units)),
-                'source_file': os.path.basename(csv_path),
+                'source_file': source_name(csv_path),
                 'updated_at': datetime.now().isoformat()
             }
             
             # パーティション内のParquetファイル名を決定
             file_id = f"{machine}_{year}{month:02d}"
-            output_file = os.path.join(partition_dir, f"{file_id}.parquet")
-            
-            # 既存のParquetファイルがあるか確認
-            if os.path.exists(output_file):
-                try:
-                    # 既存のファイルを読み込む
-                    existing_table = pq.read_table(output_file)
-                    existing_df = existing_table.to_pandas()
-                    
-                    # 既存データと新しいデータを結合
-                    combined_df = pd.concat([existing_df, partition_df], ignore_index=True)
-                    
-                    # タイムスタンプでソート
-                    combined_df = combined_df.sort_values('timestamp')
-                    
-                    # 重複を削除（タイムスタンプが同じ場合は最新のデータを保持）
-                    combined_df = combined_df.drop_duplicates(subset=['timestamp'], keep='last')
-                    
-                    # 結合したデータをテーブルに変換
-                    table = pa.Table.from_pandas(combined_df)
-                    
-                    print(f"Merged data from {csv_path} into existing {output_file}")
-                except Exception as e:
-                    # 読み込みエラーの場合、既存ファイルを無視して新しいデータだけ保存
-                    print(f"Error reading existing parquet {output_file}: {e}")
-                    table = pa.Table.from_pandas(partition_df)
-                    print(f"Created new file for {csv_path} -> {output_file}")
-            else:
-                # 新しいテーブルを作成
-                table = pa.Table.from_pandas(partition_df)
-                print(f"Created new file for {csv_path} -> {output_file}")
-            
-            # Parquetファイルとして保存（メタデータ付き）
-            pq.write_table(table, output_file, metadata=metadata)
             
+            # 既存のファイルは読み込まず、差分ファイルとして追記する
+            # （重複するタイムスタンプは読み込み時・compact時に最新のデータを優先）
+            with trace.span('arrow', rows=len(partition_df)):
+                table = pa.Table.from_pandas(partition_df, preserve_index=False)
+                if storage is not None:
+                    table = apply_storage_schema(table, storage)
+            with trace.span('write', rows=table.num_rows, nbytes=table.nbytes):
+                delta_file = write_delta(partition_dir, file_id, table, sort_by='timestamp', metadata=metadata)
+            print(f"Appended delta for {csv_path} -> {delta_file}")
+            output_dirs.append(partition_dir)
+        
+        # 取り込みが完了したファイルを記録（差分ファイルはcompactで消えるため
+        # パーティションのディレクトリを出力先として記録する）
+        if manifest is not None:
+            manifest.record(csv_path, outputs=output_dirs, rows=len(df))
+        
+        if metrics is not None:
+            metrics.add(trace.finish(rows=len(df), nbytes=source_size(csv_path)))
         return True
     except Exception as e:
         print(f"Error processing {csv_path}: {e}")
+        if metrics is not None:
+            metrics.add(trace.finish(error=e))
         return False
 
-def process_zip(zip_path, output_dir):
-    """ZIPファイルを解凍して中のCSVファイルを処理する関数"""
+def remove_previous_rows(csv_path, manifest):
+    """前回の取り込みで記録したパーティションから、そのファイルの行を取り除く関数
+    ベースファイル・差分ファイルともにsource_file列で絞り込んで書き直し、行が残らない場合は削除する
+    """
+    dataset_root = os.path.dirname(manifest.path)
+    name = source_name(csv_path)
+    for output in manifest.get(csv_path).get('outputs', []):
+        partition_dir = os.path.join(dataset_root, output)
+        if not os.path.isdir(partition_dir):
+            continue
+        for base, deltas in list_partition_files(partition_dir).values():
+            for path in ([base] if base else []) + deltas:
+                remove_source_rows(path, name)
+        print(f"Removed previous rows of {csv_path} from {partition_dir}")
+
+def process_zip(zip_path, output_dir, manifest=None, storage_schema=None, metrics=None):
+    """ZIPファイル内のCSVファイルを処理する関数
+    ZIPは展開せず、各CSV（フォルダ内のものも含む）をストリームとして読み込む
+    戻り値は (成功したCSV数, エラーになったCSV数)。並列処理と同じくZIP内のCSVごとに数え、
+    ZIP自体を開けない場合はエラー1件とする
+    """
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-            
-            # 解凍したディレクトリ内のCSVファイルを処理
-            csv_files = glob.glob(os.path.join(temp_dir, "**", "*.csv"), recursive=True)
-            
-            for csv_file in csv_files:
-                process_csv(csv_file, output_dir)
-                
-        print(f"Processed ZIP: {zip_path}")
-        return True
+        members = list_zip_csv_members(zip_path)
     except Exception as e:
         print(f"Error processing ZIP {zip_path}: {e}")
-        return False
+        return 0, 1
+    
+    success_count = 0
+    error_count = 0
+    for member in members:
+        if process_csv((zip_path, member), output_dir, manifest, storage_schema, metrics):
+            success_count += 1
+        else:
+            error_count += 1
+    
+    print(f"Processed ZIP: {zip_path}")
+    return success_count, error_count
+
+def process_machine(machine, sources, output_dir, manifest_path, storage_schema=None):
+    """1つの機械のソースを順に取り込み、その機械のパーティションをまとめるワーカー関数
+    プロセスプールから呼び出せるよう、マニフェストは保存済みのものを読み込んで
+    変更の有無の判定に使い、記録したエントリを (エントリ, 成功数, エラー数, ステージの記録) として返す
+    """
+    manifest = IngestManifest(manifest_path)
+    metrics = MetricsRecorder()
+    success_count = 0
+    error_count = 0
+    for source in sources:
+        if process_csv(source, output_dir, manifest, storage_schema, metrics):
+            success_count += 1
+        else:
+            error_count += 1
+    
+    # この機械のパーティションには他のワーカーが書き込まないため、ここでまとめられる
+    compact(output_dir, machine=machine)
+    
+    entries = {}
+    for source in sources:
+        key = manifest.source_key(source)
+        if key in manifest.entries:
+            entries[key] = manifest.entries[key]
+    return entries, success_count, error_count, metrics.records
+
+def process_parallel(csv_files, zip_files, output_dir, manifest, storage_schema=None, workers=None, metrics=None):
+    """CSVファイルとZIP内のCSVを機械ごとに分け、プロセスプールで並列に取り込む関数
+    1つの機械のパーティション（machine=）には1つのワーカーだけが入力順に書き込むため、
+    差分ファイルの順序（後に取り込んだデータを優先）とcompactの結果は逐次処理と同じになる
+    戻り値は (成功したCSV数, エラーになったCSV数)（ZIPはZIP内のCSVごとに数える）
+    metrics（MetricsRecorder）を指定した場合、ワーカーで記録したステージの処理時間などを追加する
+    """
+    sources = list(csv_files)
+    error_count = 0
+    for zip_file in zip_files:
+        try:
+            sources.extend((zip_file, member) for member in list_zip_csv_members(zip_file))
+        except Exception as e:
+            print(f"Error processing ZIP {zip_file}: {e}")
+            error_count += 1
+    
+    shards = {}
+    for source in sources:
+        shards.setdefault(extract_machine_name(source_name(source)), []).append(source)
+    # 大きい機械から先に割り当て、最後に1つの機械だけが残る時間を短くする
+    order = sorted(shards, key=lambda machine: -sum(source_size(source) for source in shards[machine]))
+    print(f"Processing {len(sources)} files for {len(shards)} machines with {workers} workers")
+    
+    # ワーカーは保存済みのマニフェストを読み込み、記録したエントリを返す（保存はここだけで行う）
+    manifest.save()
+    success_count = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            machine: executor.submit(process_machine, machine, shards[machine], output_dir, manifest.path, storage_schema)
+            for machine in order
+        }
+        for machine, future in futures.items():
+            try:
+                entries, success, errors, records = future.result()
+            except Exception as e:
+                print(f"Error processing machine {machine}: {e}")
+                error_count += len(shards[machine])
+                continue
+            manifest.entries.update(entries)
+            if metrics is not None:
+                metrics.extend(records)
+            success_count += success
+            error_count += errors
+    return success_count, error_count
+
+def compact(output_dir, min_deltas=1, machine=None):
+    """各パーティションの差分ファイルをベースファイルにまとめる関数
+    min_deltas未満の差分しかないパーティションはそのままにする
+    machineを指定した場合はその機械のパーティションだけをまとめる
+    """
+    machine_dir = f"machine={machine}" if machine is not None else "machine=*"
+    partitions = glob.glob(os.path.join(output_dir, machine_dir, "year=*", "month=*"))
+    merged_count = 0
+    for partition in sorted(partitions):
+        merged = compact_partition(partition, key='timestamp', min_deltas=min_deltas)
+        if merged:
+            print(f"Compacted {merged} delta files in {partition}")
+        merged_count += merged
+    return merged_count
+
+def load_partition(output_dir, machine, year, month, columns=None):
+    """パーティションのデータを差分ファイルも含めて読み込む関数
+    同じタイムスタンプの行は最後に取り込まれたものを返す
+    """
+    partition_dir = os.path.join(output_dir, f"machine={machine}", f"year={year}", f"month={month}")
+    if not os.path.isdir(partition_dir):
+        return pd.DataFrame()
+    table = read_merged(partition_dir, key='timestamp', columns=columns)
+    return table.to_pandas() if table is not None else pd.DataFrame()
 
 def main():
     # 入力ディレクトリと出力ディレクトリの設定
@@ -150,27 +283,51 @@ def main():
     # 処理ファイル数を表示
     print(f"Found {len(csv_files)} CSV files and {len(zip_files)} ZIP files to process")
     
+    # センサー列の保存用スキーマ（Noneの場合は読み込んだ型のまま保存する）
+    storage_schema = 'compact'
+    
+    # 並列処理に使用するプロセス数（Noneまたは1の場合は逐次処理）
+    workers = os.cpu_count()
+    
+    # 取り込みマニフェスト（前回から変更のないファイルを読み飛ばす）
+    manifest = IngestManifest(os.path.join(output_dir, "_ingest_manifest.json"))
+    
+    # ファイルごとのステージの処理時間・行数・ピークメモリ（JSON Linesで追記する）
+    metrics = MetricsRecorder()
+    
     # 処理カウンター
     success_count = 0
     error_count = 0
     
-    # CSVファイルを処理
-    for i, csv_file in enumerate(csv_files, 1):
-        print(f"Processing CSV {i}/{len(csv_files)}: {csv_file}")
-        if process_csv(csv_file, output_dir):
-            success_count += 1
-        else:
-            error_count += 1
-    
-    # ZIPファイルを処理
-    for i, zip_file in enumerate(zip_files, 1):
-        print(f"Processing ZIP {i}/{len(zip_files)}: {zip_file}")
-        if process_zip(zip_file, output_dir):
-            success_count += 1
-        else:
-            error_count += 1
+    if workers and workers > 1:
+        # 機械ごとに分けて並列に取り込む（各ワーカーが担当する機械のパーティションをまとめる）
+        success_count, error_count = process_parallel(csv_files, zip_files, output_dir, manifest, storage_schema, workers,
+                                                      metrics)
+        manifest.save()
+    else:
+        # CSVファイルを処理
+        for i, csv_file in enumerate(csv_files, 1):
+            print(f"Processing CSV {i}/{len(csv_files)}: {csv_file}")
+            if process_csv(csv_file, output_dir, manifest, storage_schema, metrics):
+                success_count += 1
+            else:
+                error_count += 1
+        
+        # ZIPファイルを処理
+        for i, zip_file in enumerate(zip_files, 1):
+            print(f"Processing ZIP {i}/{len(zip_files)}: {zip_file}")
+            success, errors = process_zip(zip_file, output_dir, manifest, storage_schema, metrics)
+            success_count += success
+            error_count += errors
+        
+        manifest.save()
+        
+        # 差分ファイルをベースファイルにまとめる
+        compact(output_dir)
     
     print(f"Conversion completed! Successful: {success_count}, Errors: {error_count}")
+    if metrics.records:
+        print(f"Stage timings written to {metrics.write(os.path.join(output_dir, '_ingest_metrics.jsonl'))}")
     
     # パーティション情報の表示
     partitions = glob.glob(os.path.join(output_dir, "machine=*", "year=*", "month=*"))
@@ -1,22 +1,57 @@
 import os
 import glob
-import zipfile
-import tempfile
 import pandas as pd
 import pyarrow as pa
-import pyarrow.parquet as pq
+import pyarrow.compute as pc
 import re
+import logging
+import threading
+import time
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 import json
+from memory_budget import ChunkSizer, MemoryBudget, estimate_row_bytes, install_budget, installed_budget, sample_csv_row_size
+from parquet_dataset import (
+    IngestManifest, PartitionWriterManager, apply_storage_schema, build_storage_schema, compact_dataset,
+    read_range, remove_source_rows, resolve_storage_options, sensor_value_type, to_long_table,
+    update_dataset_summary
+)
+from sensor_csv import (
+    ARROW_ENGINES, list_zip_csv_members, open_data_stream, read_csv_arrow, read_csv_range, scan_csv_ranges, sniff_csv_header,
+    source_name, source_size
+)
+from sensor_downsample import to_plot_series
+from sensor_metrics import FileTrace, MetricsRecorder
+from sensor_pipeline import DEFAULT_PIPELINE, in_flight_chunks, resolve_pipeline, run_pipeline
+from sensor_query import QueryService
+from sensor_rollup import RollupAccumulator, remove_rollups
+from timestamp_parser import parse_timestamps_arrow, parse_timestamps_pandas
+
+# チャンクの内容の確認用の出力（DEBUGレベルの場合だけ出力する）
+logger = logging.getLogger('sensor_ingest')
 
 def convert_csvs_to_parquet(
     source_dir, 
     output_dir, 
     dataset_name="sensor_data",
     name_patterns=None, 
-    chunk_size=100000,
+    chunk_size=None,
     encoding='utf-8',
-    date_format=None
+    date_format=None,
+    workers=None,
+    row_group_size=100000,
+    max_open_files=64,
+    engine='pandas',
+    incremental=True,
+    storage_schema=None,
+    layout='wide',
+    rollups=True,
+    memory_budget=None,
+    sources=None,
+    pipeline=None,
+    range_workers=None,
+    metrics=None
 ):
     """
     特殊な3行ヘッダー構造のCSVファイル（通常のCSVとZIP圧縮されたCSV）を
@@ -33,12 +68,73 @@ def convert_csvs_to_parquet(
     name_patterns : list, optional
         CSVファイル名に含まれるべき文字列パターンのリスト (例: ['sensor', 'temperature'])
     chunk_size : int, optional
-        大きなCSVファイルを処理する際のチャンクサイズ
+        大きなCSVファイルを処理する際のチャンクの行数。Noneの場合は、ヘッダーの列数から
+        見積もった1行あたりのメモリ量とmemory_budgetから決め、処理中のメモリ使用量に
+        応じて調整する
     encoding : str, optional
         CSVファイルのエンコーディング
     date_format : str, optional
-        タイムスタンプのフォーマット（例: '%Y/%m/%d %H:%M:%S'）
+        タイムスタンプのフォーマット（例: '%Y/%m/%d %H:%M:%S'）。一致しない値があるファイルはエラーになる
+    workers : int, optional
+        並列処理に使用するプロセス数。Noneまたは1の場合は逐次処理
+    row_group_size : int, optional
+        Parquetの行グループあたりの行数
+    max_open_files : int, optional
+        ファイルごとに同時に開いておくパーティションWriterの最大数
+    engine : str, optional
+        CSV読み込みエンジン（'pandas', 'pyarrow', 'polars'）
+    incremental : bool, optional
+        Trueの場合、取り込みマニフェストに記録された変更のないファイルを読み飛ばす。
+        Falseの場合は全てのファイルを取り込み直す
+    storage_schema : str or dict, optional
+        保存用スキーマ。'compact'を指定するとセンサー列をfloat32、source_fileを
+        辞書エンコード、day/hourをint8で保存する。dictで個別に指定することもできる
+        （例: {'unit_precision': {'℃': 'decimal:1'}, 'time_columns': 'drop'}）
+    layout : str, optional
+        'wide'はセンサーごとの列（"{センサー点番}_{センサー名}"）で保存する。
+        'long'は (sensor_id, timestamp, value) の縦持ちで保存し、sensor_id・timestampの
+        順に並べる。センサーIDと名前・単位の対応はメタデータのsensor_infoに記録される
+    rollups : bool, optional
+        Trueの場合、書き込むチャンクごとにセンサー・時間別と日別の集計（件数・合計・
+        最小・最大・最初と最後の値）を作り、_rollups/ 以下にソースファイル・
+        パーティションごとに保存する。QueryServiceの集計クエリはロールアップから
+        答えられる場合はロールアップを使う。Falseの場合は既存のロールアップを削除する
+    memory_budget : int or str, optional
+        取り込みに使うメモリの予算（バイト数、または '2GB' などの文字列）。Noneの場合は
+        空きメモリの半分。並列処理では各プロセスが予算を共有し、予算が埋まっている間は
+        他のプロセスのチャンクの処理が終わるのを待つ
+    sources : list, optional
+        取り込むCSV・ZIPファイルのパスのリスト。指定した場合はsource_dirを走査せず、
+        マニフェストに記録済みの他のソースは変更なしとしてメタデータに含める
+        （監視フォルダに届いたファイルだけを取り込む場合など）
+    pipeline : dict or bool, optional
+        チャンクに分けて読み込むファイルで、読み込み（ZIPの展開・CSVの解析）・型変換・
+        書き込み（Parquetのエンコード）を並行に行うパイプラインの設定。
+        {'queue_depth': ステージ間のキューに置けるチャンク数,
+         'convert_workers': 型変換のスレッド数,
+         'prefetch_blocks': ZIPの展開を先行して行うブロック数}
+        のうち変更する項目を指定する（既定値はDEFAULT_PIPELINE）。Falseの場合は
+        チャンクを1つずつ順に処理する。engineが'pandas'の場合は指定したときだけ使う
+    range_workers : int, optional
+        チャンクに分けて読み込むファイル（ZIP内のファイルを除く）を、メモリマップして
+        改行で区切ったバイト範囲に分け、range_workers個のスレッドで並列に解析する。
+        書き込みはファイル内の順（timestampの順）に行う。Noneの場合は先頭から順に読み込む
+    metrics : str, optional
+        取り込んだファイルごとのステージ（sniff/read/timestamp/numeric/arrow/write/rollup）の
+        処理時間・行数・バイト数・ピークメモリを書き出すファイル。拡張子が.prom/.om/.txtの
+        場合はOpenMetricsのテキスト形式（ファイルを置き換える）、それ以外はJSON Lines
+        （1ファイル1行。既存のファイルに追記する）。Noneの場合はステージごとの合計を表示するだけ
+    
+    Returns:
+    --------
+    dict
+        processed（取り込んだファイル数）, unchanged（変更なしのファイル数）, rows（データセットの合計行数）,
+        failed（取り込みに失敗したCSV・ZIPのパスのリスト。ZIPは一部のメンバーが失敗した場合も含む）,
+        skipped（パターンに一致するCSVがなく、何も取り込まなかったCSV・ZIPのパスのリスト）
     """
+    if layout not in ('wide', 'long'):
+        raise ValueError(f"未対応のレイアウトです: {layout}")
+    
     # 出力ディレクトリが存在しない場合は作成
     os.makedirs(output_dir, exist_ok=True)
     
@@ -50,44 +146,33 @@ def convert_csvs_to_parquet(
     all_metadata = {
         'files': [],
         'created_at': datetime.now().isoformat(),
+        'layout': layout,
         'sensor_info': {}
     }
     
+    # 取り込みマニフェスト（前回から変更のないファイルを読み飛ばすため）
+    manifest = IngestManifest(os.path.join(dataset_path, '_ingest_manifest.json'))
+    
+    # ロールアップを作らない場合は、古いロールアップが使われないように削除する
+    if not rollups:
+        remove_rollups(dataset_path)
+    
     # 処理したファイル数を追跡
     processed_files = 0
     skipped_files = 0
+    unchanged_files = 0
     total_rows = 0
     
-    # 処理関数
-    def process_df(df, file_metadata):
-        nonlocal total_rows
-
-            
-            # パーティショニング用の列を作成
-            df['year'] = df['timestamp'].dt.year
-            df['month'] = df['timestamp'].dt.month
-            df['day'] = df['timestamp'].dt.day
-            df['hour'] = df['timestamp'].dt.hour
-            
-            # ファイル情報カラムを追加（追跡用）
-            df['source_file'] = file_metadata['original_file']
-            
-            # データ型のチェックと変換（数値型に変換）
-            for col in df.columns:
-                if col not in ['timestamp', 'year', 'month', 'day', 'hour', 'source_file']:
-                    try:
-                        df[col] = pd.to_numeric(df[col], errors='coerce')
-                    except:
-                        pass
-            
-            total_rows += len(df)
-            return df
-        except Exception as e:
-            print(f"データ処理中にエラーが発生しました: {str(e)}")
-            raise
+    # 処理対象のタスク一覧を作成 (種別, パス, ZIP内のファイル名)
+    tasks = []
     
-    # 通常のCSVファイルを処理
-    csv_files = glob.glob(os.path.join(source_dir, "*.csv"))
+    # 通常のCSVファイル
+    if sources is not None:
+        csv_files = [f for f in sources if not f.lower().endswith('.zip')]
+        zip_files = [f for f in sources if f.lower().endswith('.zip')]
+    else:
+        csv_files = glob.glob(os.path.join(source_dir, "*.csv"))
+        zip_files = glob.glob(os.path.join(source_dir, "*.zip"))
     for csv_file in csv_files:
         file_name = os.path.basename(csv_file)
         
@@ -96,134 +181,261 @@ def convert_csvs_to_parquet(
             print(f"スキップ: {file_name} (パターンに一致しません)")
             skipped_files += 1
             continue
+        
+        tasks.append(('csv', csv_file, None))
+    
+    # ZIP圧縮されたCSVファイル（フォルダ内のCSVも含む）
+    for zip_file in zip_files:
+        for member in list_zip_csv_members(zip_file):
+            # ファイル名が指定されたパターンにマッチするか確認
+            if name_patterns and not any(pattern in member for pattern in name_patterns):
+                print(f"スキップ: {member} from {os.path.basename(zip_file)} (パターンに一致しません)")
+                skipped_files += 1
+                continue
             
-        print(f"処理中: {file_name}")
-        try:
-            # 単一ファイルを処理してパーティションに追加
-            rows_processed = process_single_csv(
-                csv_file, 
-                dataset_path, 
-                all_metadata, 
-                None,  # process_df_funcは不要になった
-                chunk_size, 
-                encoding=encoding
-            )
-            processed_files += 1
-            total_rows += rows_processed
-        except Exception as e:
-            print(f"エラー: {file_name} の処理中に問題が発生しました - {str(e)}")
+            tasks.append(('zip', zip_file, member))
+    
+    # 変更のないファイルはマニフェストに記録された結果を使う
+    results = {}
+    pending = []
+    for index, task in enumerate(tasks):
+        source = _task_source(task)
+        entry = manifest.get(source)
+        # レイアウトを変えた場合と、ロールアップがない場合は取り込み直す
+        if (incremental and entry is not None and entry['metadata'].get('layout', 'wide') == layout
+                and (not rollups or _has_rollups(dataset_path, entry['metadata'])) and manifest.is_current(source)):
+            # 出力ファイルはcompact_datasetでまとめ直されている場合があるため、マニフェストの記録を使う
+            file_metadata = dict(entry['metadata'], output_files=entry['outputs'])
+            results[index] = (file_metadata, dict(entry['sensor_info']), entry['rows'], None, None)
+        else:
+            pending.append(index)
+    
+    task_args = (dataset_path, chunk_size, encoding, row_group_size, max_open_files, engine, date_format, storage_schema, layout,
+                 rollups, pipeline, range_workers)
+    
+    if workers and workers > 1 and len(pending) > 1:
+        print(f"{workers}プロセスで{len(pending)}ファイルを並列処理します")
+        # メモリの予算はプロセス間で共有する（予約の合計を共有メモリで管理する）
+        budget = MemoryBudget(memory_budget, workers=min(workers, len(pending)))
+        with ProcessPoolExecutor(max_workers=workers, initializer=install_budget, initargs=(budget,)) as executor:
+            futures = {index: executor.submit(_run_conversion_task, tasks[index], *task_args) for index in pending}
+            for index, future in futures.items():
+                results[index] = future.result()
+    else:
+        budget = MemoryBudget(memory_budget)
+        for index in pending:
+            results[index] = _run_conversion_task(tasks[index], *task_args, budget=budget)
+    
+    # sourcesを指定した場合、今回取り込まないソースはマニフェストの記録をメタデータに含める
+    if sources is not None:
+        task_keys = {manifest.source_key(_task_source(task)) for task in tasks}
+        for key, entry in manifest.entries.items():
+            if key in task_keys or entry['metadata'].get('layout', 'wide') != layout:
+                continue
+            all_metadata['files'].append(dict(entry['metadata'], output_files=entry['outputs']))
+            for sensor_id, info in entry['sensor_info']:
+                all_metadata['sensor_info'].setdefault(sensor_id, info)
+            total_rows += entry['rows']
+            unchanged_files += 1
+
+    # 各タスクの結果をタスク順にマージする（逐次処理と並列処理、差分取り込みで同じ出力になるようにする）
+    pending = set(pending)
+    recorder = MetricsRecorder()
+    failed_sources = []
+    for index, task in enumerate(tasks):
+        file_metadata, sensor_info, rows_processed, error, trace = results[index]
+        recorder.add(trace)
+        if error is not None:
+            print(f"エラー: {_task_label(task)} の処理中に問題が発生しました - {error}")
             skipped_files += 1
+            if task[1] not in failed_sources:
+                failed_sources.append(task[1])
+            continue
+        
+        all_metadata['files'].append(file_metadata)
+        for sensor_id, info in sensor_info.items():
+            if sensor_id not in all_metadata['sensor_info']:
+                all_metadata['sensor_info'][sensor_id] = info
+        total_rows += rows_processed
+        
+        if index not in pending:
+            unchanged_files += 1
+            continue
+        
+        # 取り込んだファイルをマニフェストに記録し、前回の出力のうち
+        # 今回書き込まれなかったファイル（古いパーティションなど）を削除する
+        # （compact_datasetで他のファイルとまとめられたファイルからは、このファイルの行だけを取り除く）
+        source = _task_source(task)
+        previous = manifest.get(source)
+        outputs = [os.path.join(dataset_path, f) for f in file_metadata['output_files']]
+        if previous is not None:
+            for stale in set(previous['outputs']) - set(file_metadata['output_files']):
+                stale_path = os.path.join(dataset_path, stale)
+                if not os.path.exists(stale_path):
+                    continue
+                if manifest.is_shared(stale, source):
+                    remove_source_rows(stale_path, previous['metadata']['original_file'])
+                else:
+                    os.remove(stale_path)
+            # ロールアップはソースファイルごとのファイルのため、今回書き込まれなかったものを削除する
+            for stale in set(previous['metadata'].get('rollup_files', [])) - set(file_metadata.get('rollup_files', [])):
+                stale_path = os.path.join(dataset_path, stale)
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+        manifest.record(
+            source,
+            outputs=outputs,
+            rows=rows_processed,
+            metadata=file_metadata,
+            sensor_info=list(sensor_info.items())
+        )
+        processed_files += 1
     
-    # ZIP圧縮されたCSVファイルを処理
-    zip_files = glob.glob(os.path.join(source_dir, "*.zip"))
-    for zip_file in zip_files:
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            # ZIPファイル内のすべてのファイルをリスト
-            for zip_info in zip_ref.infolist():
-                # CSVファイルのみを処理
-                if zip_info.filename.endswith('.csv'):
-                    # ファイル名が指定されたパターンにマッチするか確認
-                    if name_patterns and not any(pattern in zip_info.filename for pattern in name_patterns):
-                        print(f"スキップ: {zip_info.filename} from {os.path.basename(zip_file)} (パターンに一致しません)")
-                        skipped_files += 1
-                        continue
-                        
-                    print(f"ZIP内のファイルを処理中: {zip_info.filename} from {os.path.basename(zip_file)}")
-                    
-                    try:
-                        # 一時ディレクトリにCSVを展開
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            extracted_path = os.path.join(temp_dir, zip_info.filename)
-                            zip_ref.extract(zip_info.filename, temp_dir)
-                            # 単一ファイルを処理してパーティションに追加
-                            rows_processed = process_single_csv(
-                                extracted_path, 
-                                dataset_path, 
-                                all_metadata, 
-                                None,  # process_df_funcは不要になった
-                                chunk_size, 
-                                encoding=encoding
-                            )
-                            processed_files += 1
-                            total_rows += rows_processed
-                    except Exception as e:
-                        print(f"エラー: {zip_info.filename} の処理中に問題が発生しました - {str(e)}")
-                        skipped_files += 1
+    manifest.save()
+    
+    # 列の和集合のスキーマと行グループのフッターをまとめたサマリーファイルを更新する
+    # （_common_metadata / _metadata。追加・変更されたファイルのフッターだけを読む）
+    update_dataset_summary(dataset_path)
     
     # 統合メタデータの保存
     metadata_path = os.path.join(output_dir, f"{dataset_name}_metadata.json")
     with open(metadata_path, 'w', encoding='utf-8') as f:
         json.dump(all_metadata, f, ensure_ascii=False, indent=2)
     
-    print(f"処理完了: {processed_files}ファイルから{total_rows}行のデータを処理しました。{skipped_files}ファイルがスキップされました。")
+    print(f"処理完了: {processed_files}ファイルを取り込みました（変更なし: {unchanged_files}ファイル）。データセットは合計{total_rows}行です。{skipped_files}ファイルがスキップされました。")
     print(f"データは {dataset_path} に保存され、メタデータは {metadata_path} に保存されました。")
+    
+    # ステージごとの処理時間（取り込んだファイルの合計）
+    if recorder.records:
+        stages = recorder.summary()
+        print("ステージ別の処理時間: " + "、".join(f"{stage} {stats['seconds']:.2f}秒" for stage, stats in stages.items()))
+        if metrics:
+            print(f"取り込みのメトリクスを {recorder.write(metrics)} に書き出しました。")
+    
+    task_paths = {task[1] for task in tasks}
+    return {
+        'processed': processed_files,
+        'unchanged': unchanged_files,
+        'rows': total_rows,
+        'failed': failed_sources,
+        'skipped': [path for path in csv_files + zip_files if path not in task_paths]
+    }
+
+def _task_label(task):
+    """ログ表示用のタスク名を返す"""
+    kind, path, member = task
+    if kind == 'zip':
+        return f"{member} from {os.path.basename(path)}"
+    return os.path.basename(path)
+
+def _task_source(task):
+    """タスクのCSVソース（パス、またはZIPのパスとメンバー名のタプル）を返す"""
+    kind, path, member = task
+    return (path, member) if kind == 'zip' else path
+
+def _task_file_id(task):
+    """出力Parquetファイル名に使うタスク固有のIDを返す"""
+    kind, path, member = task
+    file_id = os.path.splitext(os.path.basename(path))[0]
+    if kind == 'zip':
+        file_id = f"{file_id}__{os.path.splitext(member)[0]}"
+    return re.sub(r'[^\w\-]', '_', file_id)
 
-def process_single_csv(csv_path, dataset_path, all_metadata, process_df_func, chunk_size=100000, encoding='utf-8'):
+def _run_conversion_task(task, dataset_path, chunk_size, encoding, row_group_size, max_open_files, engine, date_format,
+                         storage_schema=None, layout='wide', rollups=True, pipeline=None, range_workers=None,
+                         budget=None):
     """
-    センサーデータの特殊なCSV形式（3行ヘッダー）を処理し、
-    統合Parquetデータセットにデータを追加する
+    1つのCSV（またはZIP内のCSV）を変換するワーカー関数
+    
+    プロセスプールからも呼び出せるよう、結果は共有メタデータに書き込まず
+    (ファイルメタデータ, センサー情報, 処理行数, エラー, ステージの記録) のタプルで返す。
+    budgetを指定しない場合は、install_budgetで設定されたメモリの予算を使う
     """
-    file_name = os.path.basename(csv_path)
+    kind, path, member = task
+    local_metadata = {'files': [], 'sensor_info': {}}
+    trace = FileTrace(_task_label(task))
     
-    # ヘッダー行を個別に読み込む（エンコーディングを試行）
+    print(f"{'ZIP内のファイルを' if kind == 'zip' else ''}処理中: {_task_label(task)}")
     try:
-        sensor_points = pd.read_csv(csv_path, nrows=1, header=None, encoding=encoding, index_col=False).iloc[0].tolist()
-        sensor_names = pd.read_csv(csv_path, skiprows=1, nrows=1, header=None, encoding=encoding, index_col=False).iloc[0].tolist()
-        units = pd.read_csv(csv_path, skiprows=2, nrows=1, header=None, encoding=encoding, index_col=False).iloc[0].tolist()
-    except UnicodeDecodeError:
-        # UTF-8で失敗した場合、Shift-JISを試す
-        print(f"UTF-8でのデコードに失敗しました。Shift-JISを試みます: {os.path.basename(csv_path)}")
-        encoding = 'shift-jis'
-        try:
-            sensor_points = pd.read_csv(csv_path, nrows=1, header=None, encoding=encoding, index_col=False).iloc[0].tolist()
-            sensor_names = pd.read_csv(csv_path, skiprows=1, nrows=1, header=None, encoding=encoding, index_col=False).iloc[0].tolist()
-            units = pd.read_csv(csv_path, skiprows=2, nrows=1, header=None, encoding=encoding, index_col=False).iloc[0].tolist()
-        except:
-            # CP932 (Windows日本語)も試す
-            print(f"Shift-JISでも失敗しました。CP932を試みます: {os.path.basename(csv_path)}")
-            encoding = 'cp932'
-            sensor_points = pd.read_csv(csv_path, nrows=1, header=None, encoding=encoding, index_col=False).iloc[0].tolist()
-            sensor_names = pd.read_csv(csv_path, skiprows=1, nrows=1, header=None, encoding=encoding, index_col=False).iloc[0].tolist()
-            units = pd.read_csv(csv_path, skiprows=2, nrows=1, header=None, encoding=encoding, index_col=False).iloc[0].tolist()
-    
-    # カスタムヘッダーを作成
-    # 1列目は日時列で名前がないため、'timestamp'という名前を付ける
-    custom_headers = ['timestamp']
-    
-    # 重複名のチェックと修正のための辞書
-    header_count = {}
+        # ZIP内のファイルは展開せずにストリームとして読み込む
+        source = _task_source(task)
+        rows_processed = process_single_csv(
+            source, 
+            dataset_path, 
+            local_metadata, 
+            None,  # process_df_funcは不要になった
+            chunk_size, 
+            encoding=encoding,
+            file_id=_task_file_id(task),
+            row_group_size=row_group_size,
+            max_open_files=max_open_files,
+            engine=engine,
+            date_format=date_format,
+            storage_schema=storage_schema,
+            layout=layout,
+            rollups=rollups,
+            memory_budget=budget or installed_budget(),
+            pipeline=pipeline,
+            range_workers=range_workers,
+            trace=trace
+        )
+    except Exception as e:
+        return None, {}, 0, str(e), trace.finish(error=e).to_dict()
     
-    for i in range(1, len(sensor_points)):
-        # センサー点番とセンサー名を組み合わせた列名を作成
-        header = f"{sensor_points[i]}_{sensor_names[i]}"
-        # 特殊文字を除去（パーティショニングに影響するため）
-        header = re.sub(r'[^\w]', '_', header)
-        
-        # 重複名の処理: 同じヘッダー名が既に存在する場合、連番を付ける
-        if header in header_count:
-            header_count[header] += 1
-            header = f"{header}_{header_count[header]}"
-        else:
-            header_count[header] = 0
-            
-        custom_headers.append(header)
-    
-    # ヘッダーの重複チェック（デバッグ用）
-    if len(custom_headers) != len(set(custom_headers)):
-        print(f"警告: 重複するヘッダーが存在します: {[h for h in custom_headers if custom_headers.count(h) > 1]}")
-        # この時点で重複があるとエラーになるため、完全に重複を排除する
-        unique_headers = []
-        header_count = {}
-        
-        for h in custom_headers:
-            if h in header_count:
-                header_count[h] += 1
-                unique_headers.append(f"{h}_{header_count[h]}")
-            else:
-                header_count[h] = 0
-                unique_headers.append(h)
-        
-        custom_headers = unique_headers
+    return local_metadata['files'][0], local_metadata['sensor_info'], rows_processed, None, trace.to_dict()
+
+def process_single_csv(csv_path, dataset_path, all_metadata, process_df_func, chunk_size=None, encoding='utf-8', file_id=None,
+                       row_group_size=100000, max_open_files=64, engine='pandas', date_format=None, storage_schema=None,
+                       layout='wide', rollups=False, memory_budget=None, pipeline=None, range_workers=None, trace=None):
+    """
+    センサーデータの特殊なCSV形式（3行ヘッダー）を処理し、
+    統合Parquetデータセットにデータを追加する
+    
+    csv_pathにはファイルパスの他に (ZIPファイルのパス, メンバー名) のタプルを
+    指定でき、その場合はZIPを展開せずにストリームとして読み込む。
+    file_idは出力Parquetファイル名の接頭辞として使われる。ファイルごとに
+    異なる名前で書き込むため、同じ年月の別ファイルのデータを消さない。
+    row_group_sizeとmax_open_filesはPartitionWriterManagerに渡される。
+    
+    engineに'pyarrow'または'polars'を指定すると、pandasを経由せずに
+    ネイティブのCSVリーダーで型付きのArrowテーブルとして読み込む。
+    storage_schemaを指定すると、書き込み前に保存用スキーマの型に変換する
+    （スキーマは同じヘッダー系列のファイルで1回だけ作成される）。
+    layoutに'long'を指定すると (sensor_id, timestamp, value) の縦持ちで書き込む。
+    rollupsにTrueを指定すると、書き込むチャンクから時間別・日別のロールアップを作成し、
+    ファイルごとに保存する（メタデータのrollup_filesに記録される）。
+    memory_budgetにはMemoryBudget（または予算のバイト数）を指定する。ファイル全体の
+    見積もりのメモリ量が予算に収まらない場合はチャンクに分けて読み込み、チャンクの
+    行数と行グループの行数を予算から決める（chunk_sizeを指定した場合はその行数）。
+    チャンクに分けて読み込む場合は、pipelineの設定（resolve_pipeline）で読み込み・
+    型変換・書き込みをスレッドのパイプラインで並行に行う。チャンクの行数は同時に処理中に
+    なるチャンク数で予算を割って決め、キューで待つチャンクも予算から予約する。
+    range_workersを指定すると、チャンクに分けて読み込むファイルをメモリマップして改行で
+    区切ったバイト範囲に分け（行数も正確に数える）、範囲ごとの解析・変換を
+    range_workers個のスレッドで並列に行う（書き込みは範囲の順）。
+    traceにFileTraceを指定すると、ステージごとの処理時間・行数とピークメモリを記録する。
+    """
+    if engine != 'pandas' and engine not in ARROW_ENGINES:
+        raise ValueError(f"未対応のエンジンです: {engine}")
+    
+    file_name = source_name(csv_path)
+    if file_id is None:
+        file_id = re.sub(r'[^\w\-]', '_', os.path.splitext(file_name)[0])
+    if trace is None:
+        trace = FileTrace(file_name)
+    
+    # ヘッダー3行とエンコーディング・区切り文字を1回の読み込みで判定する
+    # （同じヘッダーのファイルはキャッシュされた解析結果を再利用する）
+    with trace.span('sniff'):
+        header = sniff_csv_header(csv_path, encoding=encoding)
+    if header['encoding'] != encoding:
+        print(f"{encoding}でのデコードに失敗したため、{header['encoding']}を使用します: {file_name}")
+    encoding = header['encoding']
+    delimiter = header['delimiter']
+    sensor_points = header['sensor_points']
+    sensor_names = header['sensor_names']
+    units = header['units']
+    custom_headers = header['custom_headers']
     
     # メタデータを作成
     file_metadata = {
@@ -232,12 +444,19 @@ def process_single_csv(csv_path, dataset_path, all_metadata, process_df_func, ch
         'sensor_names': sensor_names,
         'units': units,
         'processed_at': datetime.now().isoformat(),
-        'column_names': custom_headers  # カラム名をメタデータに保存
+        'column_names': custom_headers,  # カラム名をメタデータに保存
+        'header_fingerprint': header['fingerprint'],
+        'date_format': date_format,
+        'storage_schema': storage_schema,
+        'layout': layout
     }
     
+    # センサーID（縦持ちではsensor_id列の値。ファイル内で重複する点番には連番を付ける）
+    sensor_ids = _long_sensor_ids(sensor_points[1:]) if layout == 'long' else sensor_points[1:]
+    
     # センサー情報をメタデータに追加
     for i in range(1, len(sensor_points)):
-        sensor_id = sensor_points[i]
+        sensor_id = sensor_ids[i - 1]
         if sensor_id not in all_metadata['sensor_info']:
             all_metadata['sensor_info'][sensor_id] = {
                 'name': sensor_names[i],
@@ -248,17 +467,71 @@ def process_single_csv(csv_path, dataset_path, all_metadata, process_df_func, ch
     all_metadata['files'].append(file_metadata)
     
     # ファイルサイズの確認
-    file_size = os.path.getsize(csv_path)
+    file_size = source_size(csv_path)
+    
+    # ヘッダーの列数から見積もった1行あたりのメモリ量と、先頭のデータ行から求めたCSVの
+    # 1行のバイト数でファイル全体のメモリ量を見積もり、予算に収まらない場合はチャンクに分ける
+    if not isinstance(memory_budget, MemoryBudget):
+        memory_budget = MemoryBudget(memory_budget)
+    row_bytes = estimate_row_bytes(header)
+    with trace.span('sniff'):
+        csv_row_size = sample_csv_row_size(csv_path, header)
+    estimated_rows = int(max(file_size - header['header_size'], 0) / csv_row_size) + 1
+    whole_bytes = min(estimated_rows * row_bytes, memory_budget.limit)
+    chunked = estimated_rows * row_bytes > memory_budget.share
+    # バイト範囲に分けて解析する場合（ZIP内のファイルはメモリマップできないため先頭から読む）
+    ranged = bool(range_workers) and chunked and not isinstance(csv_path, tuple)
+    if ranged:
+        pipeline = {**DEFAULT_PIPELINE, **(pipeline or {}), 'convert_workers': range_workers}
+    else:
+        pipeline = resolve_pipeline(pipeline, engine) if chunked else None
+    sizer = ChunkSizer(memory_budget, row_bytes, rows=chunk_size, in_flight=in_flight_chunks(pipeline) if pipeline else 1)
+    if ranged:
+        # バイト範囲は最初に決めるため、チャンクの行数は途中で変えない
+        sizer.fixed = True
+    if chunked:
+        print(f"チャンクに分けて読み込みます: {file_name}（約{estimated_rows}行、1チャンク{sizer.rows}行）")
+    # 書き込み待ちの行グループのバッファも予算に収める
+    row_group_size = memory_budget.row_group_rows(row_group_size, row_bytes)
     
     # パーティショニング列の定義
     partition_cols = ['year', 'month']
     
+    # 保存用スキーマ（センサー列の精度・辞書エンコード・day/hour列の型）
+    storage_options = resolve_storage_options(storage_schema)
+    # （縦持ちではセンサー列がないため、value列の型とsource_file等の列だけに適用する）
+    storage = None
+    if storage_options is not None:
+        storage_columns = (custom_headers[1:], units[1:]) if layout == 'wide' else ([], [])
+        storage = build_storage_schema(*storage_columns, storage_options, fingerprint=header['fingerprint'])
+    value_type = sensor_value_type(storage_options)
+    
+    # ロールアップ（保存する値から集計するため、どのクエリでも同じ結果になる）
+    rollup = None
+    if rollups:
+        rollup = RollupAccumulator(custom_headers[1:] if layout == 'wide' else None)
+    
+    def storage_table(table):
+        if layout == 'long':
+            table = to_long_table(table, custom_headers[1:], sensor_ids, value_type=value_type)
+        if storage is not None:
+            table = apply_storage_schema(table, storage)
+        return table
+    
+    def to_storage(table):
+        with trace.span('arrow', rows=table.num_rows):
+            return storage_table(table)
+    
+    def from_pandas(df):
+        with trace.span('arrow', rows=len(df)):
+            return storage_table(pa.Table.from_pandas(df, preserve_index=False))
+    
     # 処理関数作成 (ここで特定のファイルのcustom_headersをクロージャとして保持)
     def process_df_wrapper(df, metadata):
-        # 処理前のデータフレーム確認
-        print(f"処理前のデータフレーム先頭部分:")
-        print(df.head(2))
-        print(f"データフレーム列名: {df.columns.tolist()}")
+        # 処理前のデータフレーム確認（列の多いデータフレームでは表示に時間がかかるため、DEBUGレベルの場合だけ）
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("処理前のデータフレーム先頭部分:\n%s", df.head(2))
+            logger.debug("データフレーム列名: %s", df.columns.tolist())
         
         # データフレームの列数がヘッダー数と一致するか確認
         if len(df.columns) != len(custom_headers):
@@ -274,59 +547,13 @@ def process_single_csv(csv_path, dataset_path, all_metadata, process_df_func, ch
         # タイムスタンプを日時型に変換
         try:
             # 日時を日時型に変換（日本語形式の日付対応）
-            if 'date_format' in metadata and metadata['date_format']:
-                # 指定されたフォーマットを使用
-                df['timestamp'] = pd.to_datetime(df['timestamp'], format=metadata['date_format'])
-            else:
-                # 推測モード
-                # サンプルデータを取得してフォーマットを推測
-                sample_dates = df['timestamp'].dropna().head(5).tolist()
-                
-                # 日付フォーマットのパターン
-                date_formats = [
-                    '%Y/%m/%d %H:%M:%S',  # 2024/11/21 0:00:00
-                    '%Y/%m/%d',           # 2024/11/21
-                    '%Y-%m-%d %H:%M:%S',  # 2024-11-21 00:00:00
-                    '%Y-%m-%d',           # 2024-11-21
-                    '%Y年%m月%d日 %H時%M分%S秒',
-                    '%Y年%m月%d日',
-                    '%m/%d/%Y %H:%M:%S',  # 米国形式
-                    '%d/%m/%Y %H:%M:%S'   # 欧州形式
-                ]
-                
-                # サンプルデータの表示（デバッグ用）
-                print(f"日付サンプル: {sample_dates[:3]}")
-                
-                # データフレームの最初の行を表示（デバッグ用）
-                print("DataFrame最初の3行:")
-                print(df.head(3))
-                print(f"DataFrame列名: {df.columns.tolist()}")
-                
-                # 各フォーマットを試す
-                detected_format = None
-                for fmt in date_formats:
-                    try:
-                        # 最初のサンプルで試す
-                        if len(sample_dates) > 0:
-                            pd.to_datetime(sample_dates[0], format=fmt)
-                            detected_format = fmt
-                            print(f"検出された日付フォーマット: {fmt}")
-                            break
-                    except:
-                        continue
-                
-                try:
-                    if detected_format:
-                        # 検出されたフォーマットを使用
-                        df['timestamp'] = pd.to_datetime(df['timestamp'], format=detected_format)
-                    else:
-                        # 検出できなかった場合は自動推測
-                        print("日付フォーマットを自動推測します")
-                        df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-                except Exception as e:
-                    print(f"日付変換エラー: {str(e)}")
-                    # エラーが発生した場合、厳密でないパースを試みる
-                    df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
+            # フォーマットはヘッダー系列ごとに記憶され、年月日順の形式はベクトル演算で変換される
+            with trace.span('timestamp', rows=len(df)):
+                df['timestamp'] = parse_timestamps_pandas(
+                    df['timestamp'],
+                    fingerprint=metadata.get('header_fingerprint'),
+                    date_format=metadata.get('date_format')
+                )
             
             # タイムスタンプの変換結果を確認
             if pd.isna(df['timestamp']).all() or (df['timestamp'] < '1980-01-01').all():
@@ -334,72 +561,317 @@ def process_single_csv(csv_path, dataset_path, all_metadata, process_df_func, ch
                 # 問題が大きい場合はここで処理を停止することも考慮
                 # raise ValueError("タイムスタンプの変換に失敗しました")
             
-            # パーティショニング用の列を作成
-            df['year'] = df['timestamp'].dt.year
-            df['month'] = df['timestamp'].dt.month
-            df['day'] = df['timestamp'].dt.day
-            df['hour'] = df['timestamp'].dt.hour
+            # タイムスタンプを変換できなかった行は除外する（年月のパーティションを決められないため）
+            invalid = df['timestamp'].isna()
+            if invalid.any():
+                _report_dropped_rows(int(invalid.sum()), metadata, trace)
+                df = df.loc[~invalid].copy()
+            
+            # パーティショニング用の列を作成（Arrow版と同じint32。欠損値がないため整数のまま）
+            df['year'] = df['timestamp'].dt.year.astype('int32')
+            df['month'] = df['timestamp'].dt.month.astype('int32')
+            df['day'] = df['timestamp'].dt.day.astype('int32')
+            df['hour'] = df['timestamp'].dt.hour.astype('int32')
             
             # ファイル情報カラムを追加（追跡用）
             df['source_file'] = metadata['original_file']
             
             # データ型のチェックと変換（数値型に変換）
-            for col in df.columns:
-                if col not in ['timestamp', 'year', 'month', 'day', 'hour', 'source_file']:
-                    try:
-                        df[col] = pd.to_numeric(df[col], errors='coerce')
-                    except:
-                        pass
+            with trace.span('numeric', rows=len(df)):
+                for col in df.columns:
+                    if col not in ['timestamp', 'year', 'month', 'day', 'hour', 'source_file']:
+                        try:
+                            df[col] = pd.to_numeric(df[col], errors='coerce')
+                        except:
+                            pass
             
             return df
         except Exception as e:
             print(f"データ処理中にエラーが発生しました: {str(e)}")
             raise
     
-    # 大きなファイルの場合はチャンク処理
-    if file_size > 100 * 1024 * 1024:  # 100MB以上
-        for chunk in pd.read_csv(csv_path, skiprows=3, header=None, names=custom_headers, encoding=encoding, index_col=False, chunksize=chunk_size):
-            processed_chunk = process_df_wrapper(chunk, file_metadata)
-            
-            # PyArrowテーブルに変換
-            table = pa.Table.from_pandas(processed_chunk)
-            
-            # パーティショニングして追加
-            pq.write_to_dataset(
-                table,
-                root_path=dataset_path,
-                partition_cols=partition_cols,
-                existing_data_behavior='delete_matching'
-            )
-    else:
-        # 小さなファイルは一度に処理（3行目以降がデータ）
-        df = pd.read_csv(csv_path, skiprows=3, header=None, names=custom_headers, encoding=encoding, index_col=False)
-        processed_df = process_df_wrapper(df, file_metadata)
+    # パーティションごとにParquetWriterを開いたまま書き込む
+    # （チャンクごとにパーティションを書き直さないため、1パスで書き込める）
+    rows_processed = 0
+    with PartitionWriterManager(
+        dataset_path,
+        file_id,
+        partition_cols=partition_cols,
+        row_group_size=row_group_size,
+        max_open_files=max_open_files,
+        # 行グループをtimestamp順（縦持ちではsensor_id・timestamp順）にし、ページインデックスも
+        # 書き込む（read_rangeで期間・センサーに該当するページだけを読めるようにする）
+        sort_by=['sensor_id', 'timestamp'] if layout == 'long' else ['timestamp'],
+        page_index=True
+    ) as writers:
+        def write(table):
+            # ロールアップはチャンクの順に集計する（書き込みと同じスレッドで行う）
+            if rollup is not None:
+                with trace.span('rollup', rows=table.num_rows):
+                    rollup.add(table)
+            with trace.span('write', rows=table.num_rows, nbytes=table.nbytes):
+                writers.write_table(table)
         
-        # PyArrowテーブルに変換
-        table = pa.Table.from_pandas(processed_df)
+        def traced_read(read_chunk):
+            def read():
+                with trace.span('read') as span:
+                    chunk = read_chunk()
+                    span['rows'] = len(chunk) if chunk is not None else 0
+                return chunk
+            return read
         
-        # パーティショニングして追加
-        pq.write_to_dataset(
-            table,
-            root_path=dataset_path,
-            partition_cols=partition_cols,
-            existing_data_behavior='delete_matching'
+        # 各チャンクは見積もりのメモリ量を予算から予約してから読み込む
+        # （並列処理で予算が埋まっている間は、他のプロセスのチャンクの処理が終わるまで待つ）
+        if ranged:
+            with pa.memory_map(csv_path) as mapped:
+                data = mapped.read_buffer()
+                scan = scan_csv_ranges(data, header['header_size'], range_bytes=int(sizer.rows * csv_row_size) + 1)
+                print(f"バイト範囲に分けて並列に解析します: {file_name}（{scan['rows']}行、{len(scan['ranges'])}範囲、"
+                      f"{range_workers}スレッド）")
+                
+                def parse_range(byte_range):
+                    begin, end = byte_range
+                    if engine in ARROW_ENGINES:
+                        table = traced_read(lambda: read_csv_range(data, header, begin, end))()
+                        return to_storage(_process_arrow_table(table, file_metadata, trace))
+                    df = traced_read(lambda: pd.read_csv(
+                        pa.BufferReader(data.slice(begin, end - begin)), header=None, names=custom_headers,
+                        encoding=encoding, sep=delimiter, index_col=False
+                    ))()
+                    return from_pandas(process_df_wrapper(df, file_metadata))
+                
+                ranges = iter(scan['ranges'])
+                rows_processed = _run_chunk_pipeline(lambda: next(ranges, None), parse_range, write,
+                                                     memory_budget, sizer, pipeline, file_name)
+        elif engine in ARROW_ENGINES:
+            # Arrowテーブルとして直接読み込む（予算に収まらないファイルはストリーミング）
+            tables = read_csv_arrow(csv_path, header, engine=engine, streaming=chunked,
+                                    block_size=int(sizer.rows * csv_row_size) + 1, chunk_rows=sizer.rows,
+                                    prefetch_blocks=pipeline['prefetch_blocks'] if pipeline else 0)
+            convert = lambda table: to_storage(_process_arrow_table(table, file_metadata, trace))
+            read_table = traced_read(lambda: next(tables, None))
+            if pipeline:
+                rows_processed = _run_chunk_pipeline(read_table, convert, write, memory_budget, sizer, pipeline, file_name)
+            else:
+                while True:
+                    with memory_budget.reserve(sizer.chunk_bytes if chunked else whole_bytes):
+                        table = read_table()
+                        if table is None:
+                            break
+                        table = convert(table)
+                        write(table)
+                    rows_processed += table.num_rows
+                    sizer.observe(table.num_rows)
+        # 予算に収まらないファイルの場合はチャンク処理（チャンクの行数はメモリ使用量に応じて調整する）
+        elif chunked:
+            with open_data_stream(csv_path, header, pipeline['prefetch_blocks'] if pipeline else 0) as stream, pd.read_csv(
+                stream, header=None, names=custom_headers, encoding=encoding, sep=delimiter, index_col=False, chunksize=sizer.rows
+            ) as reader:
+                @traced_read
+                def read_chunk():
+                    try:
+                        return reader.get_chunk(sizer.rows)
+                    except StopIteration:
+                        return None
+                
+                # PyArrowテーブルに変換してパーティションに追加
+                convert = lambda chunk: from_pandas(process_df_wrapper(chunk, file_metadata))
+                if pipeline:
+                    rows_processed = _run_chunk_pipeline(read_chunk, convert, write, memory_budget, sizer, pipeline,
+                                                         file_name)
+                else:
+                    while True:
+                        with memory_budget.reserve(sizer.chunk_bytes):
+                            chunk = read_chunk()
+                            if chunk is None:
+                                break
+                            table = convert(chunk)
+                            write(table)
+                        rows_processed += table.num_rows
+                        sizer.observe(table.num_rows)
+        else:
+            # 予算に収まるファイルは一度に処理（3行目以降がデータ）
+            with memory_budget.reserve(whole_bytes):
+                df = traced_read(lambda: _read_small_csv(csv_path, header, custom_headers, encoding, delimiter))()
+                processed_df = process_df_wrapper(df, file_metadata)
+                
+                # PyArrowテーブルに変換してパーティションに追加
+                write(from_pandas(processed_df))
+            rows_processed = len(processed_df)
+    
+    # 出力したParquetファイル（データセットからの相対パス）
+    file_metadata['output_files'] = sorted(
+        os.path.relpath(f, dataset_path).replace(os.sep, '/') for f in writers.written_files
+    )
+    
+    if rollup is not None:
+        with trace.span('rollup'):
+            file_metadata['rollup_files'] = rollup.write(dataset_path, file_id)
+    
+    trace.finish(rows=rows_processed, nbytes=file_size,
+                 output_bytes=sum(os.path.getsize(f) for f in writers.written_files if os.path.exists(f)))
+    
+    # 処理したデータ行数
+    return rows_processed
+
+def _run_chunk_pipeline(read_chunk, convert, write, memory_budget, sizer, pipeline, file_name):
+    """
+    チャンクの読み込み・型変換・書き込みをパイプラインで並行に行い、処理した行数を返す
+
+    読み込むチャンクごとに見積もりのメモリ量を予算から予約し、書き込んだ後に解放する
+    （キューで待っている間のチャンクも予算に含まれる）。
+    """
+    stop = threading.Event()
+    acquired = []
+    released = []
+    rows = []
+    
+    def chunks():
+        while True:
+            nbytes = sizer.chunk_bytes
+            if not memory_budget.acquire(nbytes, cancel=stop):
+                return
+            acquired.append(nbytes)
+            chunk = read_chunk()
+            if chunk is None:
+                return
+            yield chunk, nbytes
+    
+    def sink(item):
+        table, nbytes = item
+        write(table)
+        memory_budget.release(nbytes)
+        released.append(nbytes)
+        rows.append(table.num_rows)
+        sizer.observe(table.num_rows)
+    
+    stats = {}
+    started = time.perf_counter()
+    try:
+        chunk_count = run_pipeline(
+            chunks(),
+            [('convert', lambda item: (convert(item[0]), item[1]), pipeline['convert_workers'])],
+            sink,
+            queue_depth=pipeline['queue_depth'],
+            stats=stats,
+            stop=stop
         )
+    finally:
+        # 例外で止まった場合は、書き込まれなかったチャンクの予約を解放する
+        memory_budget.release(sum(acquired) - sum(released))
+    elapsed = time.perf_counter() - started
+    print(f"パイプライン: {file_name} {chunk_count}チャンク、経過{elapsed:.1f}秒"
+          f"（読み込み{stats['read']:.1f}秒、変換{stats['convert']:.1f}秒、書き込み{stats['write']:.1f}秒）")
+    return sum(rows)
+
+def _process_arrow_table(table, metadata, trace=None):
+    """
+    process_df_wrapperのArrow版
+    タイムスタンプの変換とパーティション・追跡用の列の追加をArrowの計算関数で行う
+    （traceにFileTraceを指定すると、タイムスタンプの変換時間を記録する）
+    """
+    with trace.span('timestamp', rows=table.num_rows) if trace is not None else nullcontext():
+        timestamps = parse_timestamps_arrow(
+            table.column('timestamp'),
+            fingerprint=metadata.get('header_fingerprint'),
+            date_format=metadata.get('date_format')
+        )
+    if timestamps.null_count == len(timestamps):
+        print(f"警告: タイムスタンプの変換に問題がある可能性があります。最初の5つの値: {table.column('timestamp')[:5].to_pylist()}")
+    
+    table = table.set_column(0, 'timestamp', timestamps)
+    
+    # タイムスタンプを変換できなかった行は除外する（年月のパーティションを決められないため）
+    if timestamps.null_count:
+        _report_dropped_rows(timestamps.null_count, metadata, trace)
+        table = table.filter(pc.is_valid(timestamps))
+        timestamps = table.column('timestamp')
+    
+    # パーティショニング用の列を作成（pandasのdt.year等と同じint32）
+    for name, func in [('year', pc.year), ('month', pc.month), ('day', pc.day), ('hour', pc.hour)]:
+        table = table.append_column(name, func(timestamps).cast(pa.int32()))
+    
+    # ファイル情報カラムを追加（追跡用）
+    table = table.append_column(
+        'source_file',
+        pa.nulls(table.num_rows, pa.string()).fill_null(metadata['original_file'])
+    )
+    return table
+
+def _report_dropped_rows(count, metadata, trace=None):
+    """タイムスタンプを変換できずに除外した行数を警告し、traceに記録する"""
+    print(f"警告: {metadata['original_file']} のタイムスタンプを変換できない{count}行を除外しました")
+    if trace is not None:
+        trace.drop(count)
+
+def _has_rollups(dataset_path, metadata):
+    """前回の取り込みで作成したロールアップが全て残っているかどうか"""
+    if 'rollup_files' not in metadata:
+        return False
+    return all(os.path.exists(os.path.join(dataset_path, f)) for f in metadata['rollup_files'])
+
+def _long_sensor_ids(sensor_points):
+    """縦持ちで使うセンサーIDのリスト（ファイル内で重複する点番には連番を付ける）"""
+    sensor_ids = []
+    seen = {}
+    for point in sensor_points:
+        sensor_id = str(point)
+        if sensor_id in seen:
+            seen[sensor_id] += 1
+            sensor_id = f"{sensor_id}_{seen[sensor_id]}"
+        else:
+            seen[sensor_id] = 0
+        sensor_ids.append(sensor_id)
+    return sensor_ids
+
+def _read_small_csv(csv_path, header, custom_headers, encoding, delimiter):
+    """
+    ファイル全体を一度に読み込む
+    
+    同じヘッダー系列の前回のファイルで数値列と判明した列はdtypeを指定して
+    型推論を省略する。指定した型で読めない値があった場合は型指定なしで読み直す。
+    """
+    read_args = dict(header=None, names=custom_headers, encoding=encoding, sep=delimiter, index_col=False)
     
-    # 処理したデータ行数を更新
-    return len(df) if 'df' in locals() else chunk_size  # 近似値
+    dtypes = header['dtypes']
+    if dtypes:
+        try:
+            with open_data_stream(csv_path, header) as stream:
+                return pd.read_csv(stream, dtype=dtypes, **read_args)
+        except (ValueError, TypeError):
+            dtypes.clear()
+    
+    with open_data_stream(csv_path, header) as stream:
+        df = pd.read_csv(stream, **read_args)
+    
+    # 数値として読み込めた列を記録し、次のファイルで再利用する
+    dtypes.update({
+        col: 'float64' for col in df.columns[1:] if df[col].dtype == 'float64'
+    })
+    return df
 
-def query_parquet_with_duckdb(dataset_path, sql_query):
-    """DuckDBを使用してParquetデータセットにクエリを実行する"""
-    import duckdb
+def query_parquet_with_duckdb(dataset_path, sql_query, params=None):
+    """
+    DuckDBを使用してParquetデータセットにクエリを実行する
     
-    conn = duckdb.connect(":memory:")
-    result = conn.execute(sql_query.format(dataset_path=dataset_path)).fetchdf()
-    return result
+    データセットごとに常駐するQueryServiceを使い回す（接続のプール・パラメータの
+    バインド・結果のキャッシュ）。データセットは'dataset'という名前で参照でき、
+    クエリ中の{dataset_path}はデータセットのパスに置き換えられる。
+    値は?プレースホルダとparamsで渡す。
+    """
+    service = _QUERY_SERVICES.get(dataset_path)
+    if service is None:
+        service = _QUERY_SERVICES.setdefault(dataset_path, QueryService(dataset_path))
+    return service.query(sql_query.replace('{dataset_path}', dataset_path), params)
+
+# データセットのパス -> QueryService
+_QUERY_SERVICES = {}
 
 # 使用例
 if __name__ == "__main__":
+    # チャンクの内容を確認する場合はlevel=logging.DEBUGにする
+    logging.basicConfig(level=logging.INFO)
+    
     # 設定
     source_directory = "/path/to/csv_files"
     output_directory = "/path/to/parquet_output"
@@ -417,55 +889,47 @@ if __name__ == "__main__":
         dataset_name=dataset_name,
         name_patterns=name_filters,
         encoding='shift-jis',  # 日本語環境ではShift-JISが一般的
-        date_format='%Y/%m/%d %H:%M:%S'  # 2024/11/21 0:00:00 形式を指定
+        date_format='%Y/%m/%d %H:%M:%S',  # 2024/11/21 0:00:00 形式を指定
+        workers=os.cpu_count(),  # プロセスプールで並列処理（Noneで逐次処理）
+        engine='pyarrow',  # 'pandas' / 'polars' も指定可能
+        storage_schema='compact',  # センサー列をfloat32などの小さい型で保存
+        memory_budget='4GB',  # 全プロセスで共有するメモリの予算（チャンクの行数を列数に応じて決める）
+        metrics=os.path.join(output_directory, 'ingest_metrics.jsonl')  # ファイルごとのステージの処理時間（.promはOpenMetrics）
     )
     
     # DuckDBを使用したクエリ例
     dataset_path = os.path.join(output_directory, dataset_name)
     
-    # 時間帯別の平均値を取得するクエリ
-    hourly_query = """
-    SELECT 
-        year,
-        month, 
-        day,
-        hour,
-        AVG("{sensor_column}") as avg_value
-    FROM '{dataset_path}/*/*.parquet'
-    WHERE year = 2023 AND month = 3
-    GROUP BY year, month, day, hour
-    ORDER BY year, month, day, hour
-    """
-    
-    # 日別の統計情報を取得するクエリ
-    daily_query = """
-    SELECT 
-        year,
-        month, 
-        day,
-        AVG("{sensor_column}") as avg_value,
-        MIN("{sensor_column}") as min_value,
-        MAX("{sensor_column}") as max_value,
-        COUNT(*) as data_points
-    FROM '{dataset_path}/*/*.parquet'
-    GROUP BY year, month, day
-    ORDER BY year, month, day
-    """
+    # 取り込みで細かく分かれたファイルをパーティションごとにまとめる（変更のあったパーティションのみ）
+    compact_dataset(dataset_path, target_file_mb=128, sort_by='timestamp')
     
     # センサー列名を指定
     sensor_column = "ABC123_Temperature"
     
-    # クエリを実行
-    hourly_results = query_parquet_with_duckdb(
-        dataset_path, 
-        hourly_query.replace("{sensor_column}", sensor_column)
-    )
+    # 常駐型のクエリサービス（接続のプール・パラメータのバインド・結果のキャッシュ）
+    service = QueryService(dataset_path, pool_size=4, threads=4, memory_limit='2GB')
+    
+    # 時間帯別の平均値（年月はパラメータとしてバインドされる）
+    hourly_results = service.hourly(sensor_column, 2023, 3)
     print("時間別平均値:")
     print(hourly_results.head())
     
-    daily_results = query_parquet_with_duckdb(
-        dataset_path, 
-        daily_query.replace("{sensor_column}", sensor_column)
-    )
+    # 日別の統計情報（同じクエリはデータセットが更新されるまでキャッシュから返す）
+    daily_results = service.daily(sensor_column)
     print("\n日別統計:")
     print(daily_results.head())
+    
+    # 月別の集計（日別のロールアップから求められるため、生データは読み込まない）
+    monthly_results = service.aggregate([sensor_column], interval='month')
+    print("\n月別統計:")
+    print(monthly_results.head())
+    
+    # グラフ表示用に表示幅（ピクセル数）に合わせて間引いた系列（MultiLinePlotのseries形式）
+    points = service.downsample([sensor_column], datetime(2023, 3, 1), datetime(2023, 4, 1), width=1200, method='lttb')
+    series = to_plot_series(points)
+    print(f"\nグラフ表示用の点数: {len(points)}")
+    
+    # 短い期間の値（パーティション・行グループ・ページインデックスで絞り込み、該当するページだけを読む）
+    window = read_range(dataset_path, [sensor_column], datetime(2023, 3, 15, 12, 0), datetime(2023, 3, 15, 12, 10))
+    print("\n12:00〜12:10の値:")
+    print(window.to_pandas().head())
@@ -0,0 +1,206 @@
+import multiprocessing
+import re
+from contextlib import contextmanager
+import psutil
+from sensor_csv import SNIFF_BLOCK_SIZE, open_data_stream
+
+# メモリ予算を指定しない場合に使う、空きメモリの割合
+DEFAULT_MEMORY_FRACTION = 0.5
+
+# 読み込み中のチャンクが使うメモリの、値そのもののサイズに対する倍率
+# （CSVの読み込みバッファ、pandas/Arrowへの変換、保存用スキーマへの変換のコピー）
+WORKING_SET_FACTOR = 4
+
+# timestamp列とyear/month/day/hour/source_file列の1行あたりのサイズの目安（バイト）
+_FIXED_ROW_BYTES = 64
+
+# チャンクの行数の範囲
+MIN_CHUNK_ROWS = 1000
+MAX_CHUNK_ROWS = 2000000
+
+# 書き込み待ちの行グループのバッファに使う、ワーカーの予算の割合
+ROW_GROUP_BUDGET_RATIO = 0.25
+
+# 予算の空きを待つ間隔（秒）
+_WAIT_INTERVAL = 0.5
+
+# プロセスプールのワーカーで共有する予算（install_budgetで設定する）
+_INSTALLED_BUDGET = None
+
+_SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+
+def parse_size(value):
+    """バイト数、または '512MB' / '2GB' のような文字列をバイト数に変換する"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?B?)\s*', str(value).upper())
+    if not match:
+        raise ValueError(f"メモリサイズを解釈できません: {value}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+
+def estimate_row_bytes(header):
+    """
+    ヘッダーの列数から、読み込んだ1行が処理中に使うメモリ量を見積もる
+    （センサー列はfloat64、WORKING_SET_FACTOR倍のコピーを含む）
+    """
+    n_sensors = len(header['custom_headers']) - 1
+    return (_FIXED_ROW_BYTES + 9 * n_sensors) * WORKING_SET_FACTOR
+
+
+def sample_csv_row_size(source, header):
+    """データ行の先頭を読み込み、CSVの1行あたりのバイト数を求める"""
+    with open_data_stream(source, header) as f:
+        sample = f.read(SNIFF_BLOCK_SIZE)
+    lines = sample.count(b'\n')
+    if lines == 0:
+        # 1行がSNIFF_BLOCK_SIZEより長い（または1行しかない）場合
+        return max(len(sample), 1)
+    return max(sample.rfind(b'\n') + 1, 1) / lines
+
+
+class MemoryBudget:
+    """
+    CSVの取り込みに使うメモリの予算
+
+    予算はワーカー（プロセス）で等分し、チャンクの行数や行グループの大きさを
+    ワーカーの取り分に収まるように決める。各ワーカーはチャンクを読み込む前に
+    そのチャンクの見積もりのメモリ量を予約し（reserve）、予算全体が埋まっている
+    間は他のワーカーのチャンクの処理が終わるのを待つ。予約の合計はプロセス間で
+    共有するため、プロセスプールのワーカーにはinitializerでinstall_budgetを
+    呼び出して渡す。
+
+    Parameters:
+    -----------
+    limit : int or str, optional
+        予算（バイト数、または '2GB' などの文字列）。Noneの場合は空きメモリの
+        fraction倍
+    workers : int, optional
+        予算を共有するワーカー数
+    fraction : float, optional
+        limitを指定しない場合に使う空きメモリの割合
+    """
+
+    def __init__(self, limit=None, workers=1, fraction=DEFAULT_MEMORY_FRACTION):
+        if limit is None:
+            limit = psutil.virtual_memory().available * fraction
+        self.limit = parse_size(limit)
+        self.workers = max(int(workers or 1), 1)
+        self._reserved = multiprocessing.Value('q', 0)
+        self._condition = multiprocessing.Condition(self._reserved.get_lock())
+
+    @property
+    def share(self):
+        """1ワーカーあたりの予算（バイト）"""
+        return self.limit // self.workers
+
+    @property
+    def reserved(self):
+        return self._reserved.value
+
+    def chunk_rows(self, row_bytes):
+        """1ワーカーの予算に収まるチャンクの行数"""
+        return _clamp_rows(self.share // max(int(row_bytes), 1))
+
+    def row_group_rows(self, row_group_size, row_bytes):
+        """
+        書き込み待ちのバッファがワーカーの予算のROW_GROUP_BUDGET_RATIOに収まる
+        行グループの行数（row_group_sizeより大きくはしない）
+        """
+        stored_bytes = max(int(row_bytes) // WORKING_SET_FACTOR, 1)
+        rows = max(int(self.share * ROW_GROUP_BUDGET_RATIO) // stored_bytes, MIN_CHUNK_ROWS)
+        return min(row_group_size, rows) if row_group_size else rows
+
+    @contextmanager
+    def reserve(self, nbytes):
+        """
+        nbytesを予約する（予算全体を超える間は他のワーカーの解放を待つ）
+
+        他に予約がない場合は予算より大きくても予約できる（1つのチャンクが
+        予算を超える場合に待ち続けないようにする）。
+        """
+        nbytes = max(int(nbytes), 0)
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+    def acquire(self, nbytes, cancel=None):
+        """
+        nbytesを予約する（reserveと異なり、予約と解放を別のスレッドで行える）
+        cancel（threading.Event）が設定された場合は予約せずにFalseを返す
+        """
+        nbytes = max(int(nbytes), 0)
+        with self._condition:
+            while self._reserved.value > 0 and self._reserved.value + nbytes > self.limit:
+                if cancel is not None and cancel.is_set():
+                    return False
+                self._condition.wait(_WAIT_INTERVAL)
+            self._reserved.value += nbytes
+        return True
+
+    def release(self, nbytes):
+        """acquireで予約したnbytesを解放する"""
+        with self._condition:
+            self._reserved.value -= max(int(nbytes), 0)
+            self._condition.notify_all()
+
+
+class ChunkSizer:
+    """
+    チャンクを処理するごとにプロセスのRSSを確認し、次のチャンクの行数を調整する
+
+    RSSの増加がワーカーの予算を超えた場合は行数を減らし、予算の半分に満たない
+    場合は行数を増やす。システムの空きメモリが予算の1割を下回った場合は半分にする。
+    rowsを指定した場合（chunk_sizeを指定した場合）は行数を変えない。
+    in_flightにはパイプラインで同時にメモリ上にあるチャンク数を指定し、
+    チャンクの行数をワーカーの予算をin_flightで割った量に収める。
+    """
+
+    def __init__(self, budget, row_bytes, rows=None, in_flight=1):
+        self.budget = budget
+        self.row_bytes = row_bytes
+        self.in_flight = max(int(in_flight), 1)
+        self.fixed = rows is not None
+        self.rows = rows if rows is not None else self._max_rows()
+        self._process = psutil.Process()
+        self._baseline = self._process.memory_info().rss
+
+    @property
+    def chunk_bytes(self):
+        """現在のチャンクの見積もりのメモリ量"""
+        return self.rows * self.row_bytes
+
+    def observe(self, rows):
+        """rows行のチャンクを処理した後のメモリ使用量から、次のチャンクの行数を決める"""
+        if self.fixed or rows <= 0:
+            return self.rows
+
+        used = self._process.memory_info().rss - self._baseline
+        share = self.budget.share
+        if psutil.virtual_memory().available < self.budget.limit * 0.1:
+            self.rows = _clamp_rows(self.rows // 2)
+        elif used > share:
+            self.rows = _clamp_rows(int(self.rows * share / used * 0.9))
+        elif used < share * 0.5 and rows >= self.rows:
+            self.rows = _clamp_rows(min(int(self.rows * 1.5), self._max_rows()))
+        return self.rows
+
+    def _max_rows(self):
+        return self.budget.chunk_rows(self.row_bytes * self.in_flight)
+
+
+def install_budget(budget):
+    """プロセスプールのワーカーで共有する予算を設定する（ProcessPoolExecutorのinitializer）"""
+    global _INSTALLED_BUDGET
+    _INSTALLED_BUDGET = budget
+
+
+def installed_budget():
+    return _INSTALLED_BUDGET
+
+
+def _clamp_rows(rows):
+    return int(min(max(rows, MIN_CHUNK_ROWS), MAX_CHUNK_ROWS))
@@ -0,0 +1,1417 @@
+import hashlib
+import json
+import os
+import zipfile
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from parquet_page_index import page_row_ranges, read_column_rows, read_footer, timestamp_unit
+
+
+# 保存用スキーマ（storage_schema='compact'）の既定値
+STORAGE_DEFAULTS = {
+    # センサー列の既定の型（'float32' / 'float64' / 'decimal:小数桁数'）
+    'sensor_precision': 'float32',
+    # 単位ごとの型（例: {'℃': 'decimal:1'}）。decimalは整数として保存される
+    'unit_precision': {},
+    # 列ごとの型（単位ごとの指定より優先）
+    'column_precision': {},
+    # timestampから求められるday/hour列: 'int8' / 'drop' / 'keep'
+    'time_columns': 'int8',
+    # 辞書エンコードする文字列列
+    'dictionary_columns': ['source_file'],
+}
+
+# decimalの全体の桁数（9桁以下はParquetでint32として保存される）
+DECIMAL_PRECISION = 9
+
+# ページインデックスを書き込む場合の1ページの最大行数
+# （短い期間の読み込みで、読むページのサイズがこの程度になる）
+PAGE_INDEX_ROWS = 8192
+
+# (ヘッダーのフィンガープリント, 列, オプション) -> 保存用スキーマ
+_STORAGE_SCHEMA_CACHE = {}
+
+
+def resolve_storage_options(storage_schema):
+    """
+    storage_schemaの指定をオプションの辞書にする
+    None: 変換結果の型のまま保存 / 'compact': 既定値 / dict: 既定値を上書き
+    """
+    if storage_schema is None:
+        return None
+    if storage_schema == 'compact':
+        return dict(STORAGE_DEFAULTS)
+    if isinstance(storage_schema, dict):
+        return {**STORAGE_DEFAULTS, **storage_schema}
+    raise ValueError(f"未対応のstorage_schemaです: {storage_schema}")
+
+
+def build_storage_schema(sensor_columns, sensor_units, options, fingerprint=None):
+    """
+    センサー列の保存用スキーマを作成する（ファイル系列ごとに1回だけ作成して再利用する）
+
+    Returns:
+    --------
+    tuple
+        (キャストするフィールドのpyarrow.Schema, 削除する列のリスト)
+    """
+    key = (
+        fingerprint,
+        tuple(sensor_columns),
+        json.dumps(options, sort_keys=True, ensure_ascii=False, default=str)
+    )
+    if key in _STORAGE_SCHEMA_CACHE:
+        return _STORAGE_SCHEMA_CACHE[key]
+
+    fields = [pa.field('timestamp', pa.timestamp('us'))]
+    for column, unit in zip(sensor_columns, sensor_units):
+        spec = options['column_precision'].get(column) or options['unit_precision'].get(unit) or options['sensor_precision']
+        fields.append(pa.field(column, _precision_type(spec)))
+
+    dropped = []
+    if options['time_columns'] == 'drop':
+        dropped = ['day', 'hour']
+    elif options['time_columns'] == 'int8':
+        fields += [pa.field('day', pa.int8()), pa.field('hour', pa.int8())]
+
+    for column in options['dictionary_columns']:
+        fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+
+    storage = (pa.schema(fields), dropped)
+    _STORAGE_SCHEMA_CACHE[key] = storage
+    return storage
+
+
+def apply_storage_schema(table, storage):
+    """テーブルを保存用スキーマの型に変換する（スキーマにない列はそのまま残す）"""
+    schema, dropped = storage
+    table = table.drop_columns([c for c in dropped if c in table.column_names])
+
+    for field in schema:
+        index = table.schema.get_field_index(field.name)
+        if index < 0 or table.schema.field(index).type == field.type:
+            continue
+        column = _cast_storage_column(table.column(index), field)
+        table = table.set_column(index, pa.field(field.name, column.type), column)
+    return table
+
+
+def sensor_value_type(options):
+    """縦持ちのvalue列の型（保存用スキーマのsensor_precision。指定がない場合はfloat64）"""
+    if options is None:
+        return pa.float64()
+    return _precision_type(options['sensor_precision'])
+
+
+def to_long_table(table, sensor_columns, sensor_ids, value_type=pa.float64(), keep_columns=('year', 'month', 'source_file')):
+    """
+    横持ち（センサーごとの列）のテーブルを縦持ち（sensor_id, timestamp, value）に変換する
+
+    値が欠損している行は含めない。行はsensor_id、timestampの順に並べるため、
+    行グループの統計情報で1つのセンサーの期間だけを読み込める。
+
+    Parameters:
+    -----------
+    table : pyarrow.Table
+        timestamp列とセンサー列を含むテーブル
+    sensor_columns : list
+        センサー列の名前
+    sensor_ids : list
+        各センサー列のセンサーID（sensor_columnsと同じ順）
+    value_type : pyarrow.DataType, optional
+        value列の型
+    keep_columns : tuple, optional
+        各行にそのまま残す列（パーティション列など）
+    """
+    # センサーIDの昇順に列を並べ、列の番号で並べ替える（文字列の比較を避ける）
+    order = sorted(range(len(sensor_columns)), key=lambda i: sensor_ids[i])
+    n_rows = table.num_rows
+
+    def repeat(column):
+        return pa.chunked_array(column.chunks * len(order), type=column.type)
+
+    sensor_index = pa.array(np.repeat(np.arange(len(order), dtype=np.int32), n_rows))
+    values = pa.chunked_array(
+        [chunk for i in order for chunk in table.column(sensor_columns[i]).cast(value_type).chunks],
+        type=value_type
+    )
+    columns = {'__sensor': sensor_index, 'timestamp': repeat(table.column('timestamp')), 'value': values}
+    for col in keep_columns:
+        if col in table.column_names:
+            columns[col] = repeat(table.column(col))
+
+    long_table = pa.table(columns)
+    long_table = long_table.filter(pc.is_valid(long_table['value']))
+    long_table = long_table.sort_by([('__sensor', 'ascending'), ('timestamp', 'ascending')])
+
+    ids = pa.array([str(sensor_ids[i]) for i in order], type=pa.string())
+    sensor_id = ids.take(long_table['__sensor'])
+    return long_table.drop_columns(['__sensor']).add_column(0, 'sensor_id', sensor_id)
+
+
+def _precision_type(spec):
+    if spec == 'float32':
+        return pa.float32()
+    if spec == 'float64':
+        return pa.float64()
+    if isinstance(spec, str) and spec.startswith('decimal:'):
+        return pa.decimal128(DECIMAL_PRECISION, int(spec.split(':', 1)[1]))
+    raise ValueError(f"未対応のセンサー精度です: {spec}")
+
+
+def _cast_storage_column(column, field):
+    """列を保存用の型にキャストする（変換できない場合は元の型のまま残す）"""
+    try:
+        if pa.types.is_dictionary(field.type):
+            return pc.dictionary_encode(column.cast(field.type.value_type))
+        if pa.types.is_decimal(field.type):
+            values = column.cast(pa.float64())
+            values = pc.if_else(pc.is_nan(values), pa.scalar(None, pa.float64()), values)
+            try:
+                return pc.round(values, field.type.scale).cast(field.type)
+            except pa.ArrowInvalid:
+                # 桁あふれする値がある場合はこのチャンクだけfloat64で保存する
+                print(f"警告: {field.name} の値が{field.type}に収まらないため、float64で保存します")
+                return values
+        return column.cast(field.type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        print(f"警告: {field.name} を{field.type}に変換できないため、元の型で保存します")
+        return column
+
+
+def _writer_options(schema, page_index=False):
+    """
+    スキーマに応じたParquetの書き込みオプション
+
+    測定値（浮動小数点・decimal）と時刻の列は値の種類が多く、辞書エンコードしても
+    辞書が大きくなるだけなので、辞書エンコードは文字列などの列に限る。
+    decimalは整数として保存する。page_index=Trueの場合はページインデックスを
+    書き込み、1ページの行数をPAGE_INDEX_ROWSまでにする（read_rangeで読む
+    ページを絞り込めるようにする）。
+    """
+    measured = [
+        pa.types.is_floating(field.type) or pa.types.is_decimal(field.type) or pa.types.is_timestamp(field.type)
+        for field in schema
+    ]
+    options = {'use_dictionary': [field.name for field, is_measured in zip(schema, measured) if not is_measured]}
+    if any(pa.types.is_decimal(field.type) for field in schema):
+        options['store_decimal_as_integer'] = True
+    if page_index:
+        options['write_page_index'] = True
+        options['max_rows_per_page'] = PAGE_INDEX_ROWS
+    return options
+
+
+class PartitionWriterManager:
+    """
+    year=/month= パーティションごとにParquetWriterを開いたまま保持し、
+    チャンク単位のデータを1パスで書き込むためのマネージャー
+
+    書き込み中のファイルは隠しファイル（.xxx.tmp）として作成し、
+    close()時にリネームして確定させる（読み手には完成したファイルしか見えない）。
+    開いているファイル数がmax_open_filesを超えた場合は、最も長く使われて
+    いないパーティションのファイルを確定して閉じる。
+
+    Parameters:
+    -----------
+    dataset_path : str
+        データセットのルートディレクトリ
+    file_id : str
+        出力ファイル名の接頭辞（ソースファイルごとに一意にする）
+    partition_cols : list, optional
+        パーティション列（デフォルト: ['year', 'month']）
+    row_group_size : int, optional
+        1つの行グループに含める行数
+    max_open_files : int, optional
+        同時に開いておくParquetWriterの最大数
+    compression : str, optional
+        Parquetの圧縮コーデック
+    sort_by : list, optional
+        各行グループ内の並び順に使う列（フッターにソート順として記録される）
+    page_index : bool, optional
+        ページ単位の統計情報（Page Index）を書き込むかどうか
+    """
+
+    def __init__(self, dataset_path, file_id, partition_cols=None, row_group_size=100000,
+                 max_open_files=64, compression='snappy', sort_by=None, page_index=False):
+        self.dataset_path = dataset_path
+        self.file_id = file_id
+        self.partition_cols = partition_cols or ['year', 'month']
+        self.row_group_size = row_group_size
+        self.max_open_files = max_open_files
+        self.compression = compression
+        self.sort_by = sort_by
+        self.page_index = page_index
+
+        # パーティションキー -> 書き込み状態（LRU順）
+        self._open = OrderedDict()
+        # パーティションキー -> 次に使うパート番号
+        self._next_part = {}
+        # 確定したファイルのパス一覧
+        self.written_files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write_table(self, table):
+        """パーティション列を含むテーブルを分割して各パーティションに書き込む"""
+        if table.num_rows == 0:
+            return
+
+        for key, part_table in self._split_partitions(table):
+            self._write_partition(key, part_table)
+
+    def close(self):
+        """全てのWriterのバッファを書き出し、ファイルを確定する"""
+        while self._open:
+            key, state = self._open.popitem(last=False)
+            self._finalize(state)
+
+    def abort(self):
+        """書き込み中のファイルを全て破棄する"""
+        while self._open:
+            _, state = self._open.popitem(last=False)
+            try:
+                state['writer'].close()
+            finally:
+                if os.path.exists(state['tmp_path']):
+                    os.remove(state['tmp_path'])
+
+    def _split_partitions(self, table):
+        """テーブルをパーティションキーごとに分割する"""
+        keys = table.select(self.partition_cols).group_by(self.partition_cols).aggregate([])
+        data = table.drop_columns(self.partition_cols)
+
+        for row in keys.to_pylist():
+            mask = None
+            for col in self.partition_cols:
+                value = row[col]
+                cond = pc.is_null(table[col]) if value is None else pc.equal(table[col], value)
+                mask = cond if mask is None else pc.and_(mask, cond)
+            key = tuple(row[col] for col in self.partition_cols)
+            yield key, data.filter(mask)
+
+    def _write_partition(self, key, table):
+        state = self._open.get(key)
+
+        if state is not None:
+            # 既存のスキーマに合わせる（チャンク間でint/floatがぶれる場合など）
+            try:
+                table = table.cast(state['schema'])
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, ValueError):
+                # キャストできない場合は現在のファイルを確定し、新しいパートを開く
+                del self._open[key]
+                self._finalize(state)
+                state = None
+            else:
+                self._open.move_to_end(key)
+
+        if state is None:
+            state = self._open_partition(key, table.schema)
+
+        state['buffer'].append(table)
+        state['buffered_rows'] += table.num_rows
+        if self.row_group_size and state['buffered_rows'] >= self.row_group_size:
+            self._flush(state, full_groups_only=True)
+
+    def _open_partition(self, key, schema):
+        # 上限に達している場合は最も古いWriterを閉じる
+        while len(self._open) >= self.max_open_files:
+            _, oldest = self._open.popitem(last=False)
+            self._finalize(oldest)
+
+        if any(value is None for value in key):
+            raise ValueError(f"パーティション列が欠損している行は書き込めません: {dict(zip(self.partition_cols, key))}")
+        partition_dir = os.path.join(
+            self.dataset_path,
+            *[f"{col}={value}" for col, value in zip(self.partition_cols, key)]
+        )
+        os.makedirs(partition_dir, exist_ok=True)
+
+        part = self._next_part.get(key, 0)
+        self._next_part[key] = part + 1
+
+        file_name = f"{self.file_id}-{part}.parquet"
+        final_path = os.path.join(partition_dir, file_name)
+        tmp_path = os.path.join(partition_dir, f".{file_name}.tmp")
+
+        options = _writer_options(schema, page_index=self.page_index)
+        if self.sort_by:
+            options['sorting_columns'] = pq.SortingColumn.from_ordering(
+                schema, [(col, 'ascending') for col in self.sort_by]
+            )
+
+        state = {
+            'writer': pq.ParquetWriter(tmp_path, schema, compression=self.compression, **options),
+            'schema': schema,
+            'tmp_path': tmp_path,
+            'final_path': final_path,
+            'buffer': [],
+            'buffered_rows': 0,
+        }
+        self._open[key] = state
+        return state
+
+    def _flush(self, state, full_groups_only=False):
+        """
+        バッファに溜まった行を行グループとして書き出す
+        full_groups_only=Trueの場合、row_group_sizeに満たない端数はバッファに残す
+        """
+        if not state['buffer']:
+            return
+
+        table = pa.concat_tables(state['buffer'])
+        if self.sort_by:
+            # 各行グループがsort_byの順に並ぶようにする
+            table = table.sort_by([(col, 'ascending') for col in self.sort_by])
+        if full_groups_only:
+            n_rows = (table.num_rows // self.row_group_size) * self.row_group_size
+        else:
+            n_rows = table.num_rows
+
+        state['writer'].write_table(table.slice(0, n_rows), row_group_size=self.row_group_size or None)
+        remainder = table.slice(n_rows)
+        state['buffer'] = [remainder] if remainder.num_rows else []
+        state['buffered_rows'] = remainder.num_rows
+
+    def _finalize(self, state):
+        """Writerを閉じて一時ファイルを最終ファイル名にリネームする"""
+        self._flush(state)
+        state['writer'].close()
+        os.replace(state['tmp_path'], state['final_path'])
+        self.written_files.append(state['final_path'])
+
+
+class IngestManifest:
+    """
+    取り込み済みのソースファイルを記録するマニフェスト
+
+    ソースのパス（ZIPの場合はメンバー名も含む）をキーに、サイズ・更新時刻・
+    内容のハッシュと出力したParquetファイルを記録する。再実行時は
+    変更のないソースを読み飛ばし、新規または変更されたソースだけを取り込む。
+    保存は一時ファイルへの書き込みとリネームで行うため、途中で中断しても
+    マニフェストが壊れることはない。
+
+    Parameters:
+    -----------
+    path : str
+        マニフェストファイル（JSON）のパス
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.entries = data.get('entries', {})
+
+    @staticmethod
+    def source_key(source):
+        """ソースのキー（ZIP内のファイルは 'ZIPのパス!メンバー名'）"""
+        if isinstance(source, tuple):
+            zip_path, member = source
+            return f"{os.path.abspath(zip_path)}!{member}"
+        return os.path.abspath(source)
+
+    @staticmethod
+    def stat_source(source):
+        """ソースのサイズと更新時刻を取得する（ZIP内のファイルはCRCも取得する）"""
+        if isinstance(source, tuple):
+            zip_path, member = source
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                info = zip_ref.getinfo(member)
+            # ZIPのCRC32は展開しなくても得られるため、内容のハッシュとして使う
+            return {
+                'size': info.file_size,
+                'mtime': datetime(*info.date_time).isoformat(),
+                'hash': f"crc32:{info.CRC:08x}"
+            }
+
+        stat = os.stat(source)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    @staticmethod
+    def hash_source(source):
+        """ソースの内容のハッシュを計算する"""
+        if isinstance(source, tuple):
+            return IngestManifest.stat_source(source)['hash']
+
+        digest = hashlib.sha1()
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return f"sha1:{digest.hexdigest()}"
+
+    def get(self, source):
+        """記録済みのエントリを返す（未記録の場合はNone）"""
+        return self.entries.get(self.source_key(source))
+
+    def is_current(self, source):
+        """
+        ソースが前回の取り込みから変更されていないかを判定する
+
+        サイズと更新時刻が一致すれば変更なしとする。更新時刻だけが異なる場合は
+        内容のハッシュを比較し、一致すれば更新時刻を記録し直して変更なしとする。
+        出力したファイルが削除されている場合は変更ありとして扱う。
+        """
+        entry = self.get(source)
+        if entry is None:
+            return False
+
+        dataset_root = os.path.dirname(self.path)
+        if any(not os.path.exists(os.path.join(dataset_root, f)) for f in entry.get('outputs', [])):
+            return False
+
+        current = self.stat_source(source)
+        if current['size'] != entry['size']:
+            return False
+        if current['mtime'] == entry['mtime'] and current.get('hash', entry['hash']) == entry['hash']:
+            return True
+
+        if self.hash_source(source) == entry['hash']:
+            entry['mtime'] = current['mtime']
+            return True
+        return False
+
+    def record(self, source, outputs=None, **info):
+        """
+        取り込みが完了したソースを記録する
+
+        outputsには出力したParquetファイルのパスを指定する（マニフェストの
+        ディレクトリからの相対パスで保存される）。その他のキーワード引数は
+        エントリにそのまま保存される。
+        """
+        entry = self.stat_source(source)
+        entry.setdefault('hash', self.hash_source(source))
+
+        dataset_root = os.path.dirname(self.path)
+        entry['outputs'] = sorted(
+            os.path.relpath(f, dataset_root).replace(os.sep, '/') for f in (outputs or [])
+        )
+        entry['ingested_at'] = datetime.now().isoformat()
+        entry.update(info)
+
+        self.entries[self.source_key(source)] = entry
+        return entry
+
+    def is_shared(self, output, source):
+        """出力ファイル（相対パス）がsource以外のソースからも参照されているか"""
+        key = self.source_key(source)
+        return any(output in entry.get('outputs', []) for k, entry in self.entries.items() if k != key)
+
+    def replace_outputs(self, old_files, new_files):
+        """
+        old_filesを出力に含むエントリの出力をnew_filesに置き換える
+        （compact_datasetでファイルをまとめ直した後に呼ぶ）
+        """
+        dataset_root = os.path.dirname(self.path)
+        old = {os.path.relpath(f, dataset_root).replace(os.sep, '/') for f in old_files}
+        new = {os.path.relpath(f, dataset_root).replace(os.sep, '/') for f in new_files}
+        for entry in self.entries.values():
+            outputs = set(entry.get('outputs', []))
+            if outputs & old:
+                entry['outputs'] = sorted((outputs - old) | new)
+
+    def save(self):
+        """マニフェストを書き出す（一時ファイルに書いてからリネーム）"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        _save_json(self.path, {'version': self.VERSION, 'entries': self.entries})
+
+
+# 差分ファイルの名前（ベースファイル名.delta-取り込み時刻.parquet）
+DELTA_MARKER = '.delta-'
+
+
+def write_delta(partition_dir, base_name, table, sort_by='timestamp', metadata=None):
+    """
+    パーティションに差分ファイルを追記する（既存のファイルは読み書きしない）
+
+    テーブルはsort_byの列で並べ替えてから書き出す。ファイル名には取り込み時刻を
+    固定桁で含めるため、名前順がそのまま取り込み順になる。
+
+    Parameters:
+    -----------
+    partition_dir : str
+        パーティションのディレクトリ
+    base_name : str
+        ベースファイル名（拡張子なし）
+    table : pyarrow.Table
+        書き込むデータ
+    sort_by : str, optional
+        並べ替えに使う列
+    metadata : dict, optional
+        スキーマに付与するメタデータ
+    """
+    os.makedirs(partition_dir, exist_ok=True)
+    if sort_by in table.column_names:
+        table = table.sort_by(sort_by)
+    if metadata:
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            **{str(k): str(v) for k, v in metadata.items()}
+        })
+
+    stamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    seq = 0
+    while True:
+        file_name = f"{base_name}{DELTA_MARKER}{stamp}{seq:03d}.parquet"
+        final_path = os.path.join(partition_dir, file_name)
+        if not os.path.exists(final_path):
+            break
+        seq += 1
+
+    tmp_path = os.path.join(partition_dir, f".{file_name}.tmp")
+    pq.write_table(table, tmp_path, **_writer_options(table.schema, page_index=True))
+    os.replace(tmp_path, final_path)
+    return final_path
+
+
+def list_partition_files(partition_dir):
+    """
+    パーティション内のファイルをベースファイル名ごとにまとめる
+    {ベースファイル名: (ベースファイルのパスまたはNone, 取り込み順の差分ファイルのリスト)}
+    """
+    groups = {}
+    for file_name in sorted(os.listdir(partition_dir)):
+        if file_name.startswith('.') or not file_name.endswith('.parquet'):
+            continue
+        path = os.path.join(partition_dir, file_name)
+        if DELTA_MARKER in file_name:
+            base_name = file_name.split(DELTA_MARKER, 1)[0]
+            groups.setdefault(base_name, [None, []])[1].append(path)
+        else:
+            base_name = file_name[:-len('.parquet')]
+            groups.setdefault(base_name, [None, []])[0] = path
+    return {name: (base, deltas) for name, (base, deltas) in groups.items()}
+
+
+def read_merged(partition_dir, key='timestamp', columns=None):
+    """
+    ベースファイルと差分ファイルを読み込み、keyが重複する行は最後に
+    取り込まれたものを残して返す（merge-on-read）
+
+    列構成の異なるファイルは列の和集合にそろえ、存在しない列は欠損値になる。
+    行は全体として置き換わる（以前のread-concat-sort-rewriteと同じ結果）。
+
+    Parameters:
+    -----------
+    partition_dir : str
+        パーティションのディレクトリ
+    key : str, optional
+        重複判定に使う列
+    columns : list, optional
+        読み込む列（keyは自動的に含まれる）
+    """
+    paths = []
+    for base, deltas in list_partition_files(partition_dir).values():
+        paths.extend(([base] if base else []) + deltas)
+    return merge_files(paths, key=key, columns=columns)
+
+
+def merge_files(paths, key='timestamp', columns=None):
+    """取り込み順に並んだParquetファイルをkeyの最新優先で1つのテーブルにまとめる"""
+    if columns is not None and key not in columns:
+        columns = [key] + list(columns)
+
+    tables = []
+    for path in paths:
+        table = pq.read_table(path)
+        # 以前のバージョンで保存されたpandasのインデックス列は除く
+        table = table.drop_columns([c for c in table.column_names if c.startswith('__index_level_')])
+        if columns is not None:
+            table = table.select([c for c in columns if c in table.column_names])
+        tables.append(table)
+
+    if not tables:
+        return None
+
+    metadata = _merge_metadata(t.schema.metadata for t in tables)
+    combined = pa.concat_tables(
+        [t.replace_schema_metadata(None) for t in tables], promote_options='permissive'
+    )
+    return _latest_by_key(combined, key).replace_schema_metadata(metadata)
+
+
+def compact_partition(partition_dir, key='timestamp', min_deltas=1):
+    """
+    差分ファイルをベースファイルにまとめる
+
+    まとめたファイルを一時ファイルに書いてからベースファイルと置き換え、
+    その後で差分ファイルを削除する。削除の前に中断しても、残った差分は
+    ベースファイルに反映済みの内容を再度適用するだけなので結果は変わらない。
+
+    Returns:
+    --------
+    int
+        まとめた差分ファイルの数
+    """
+    merged_count = 0
+    for base_name, (base, deltas) in list_partition_files(partition_dir).items():
+        if len(deltas) < max(min_deltas, 1):
+            continue
+
+        table = merge_files(([base] if base else []) + deltas, key=key)
+        final_path = os.path.join(partition_dir, f"{base_name}.parquet")
+        tmp_path = os.path.join(partition_dir, f".{base_name}.parquet.tmp")
+        pq.write_table(table, tmp_path, **_writer_options(table.schema, page_index=True))
+        os.replace(tmp_path, final_path)
+
+        for path in deltas:
+            os.remove(path)
+        merged_count += len(deltas)
+    return merged_count
+
+
+def _latest_by_key(table, key):
+    """keyごとに最後の行だけを残し、keyの順に並べる"""
+    if table.num_rows == 0:
+        return table
+    indexed = table.append_column('__row', pa.array(np.arange(table.num_rows)))
+    latest = indexed.group_by(key).aggregate([('__row', 'max')])
+    return table.take(latest['__row_max']).sort_by(key)
+
+
+def _merge_metadata(metadatas):
+    """
+    ファイルごとのメタデータをまとめる（後のファイルの値を優先し、
+    source_fileは取り込んだ全ファイルを残す）
+    """
+    merged = {}
+    sources = []
+    for metadata in metadatas:
+        if not metadata:
+            continue
+        merged.update(metadata)
+        for name in metadata.get(b'source_file', b'').decode('utf-8').split(','):
+            if name and name not in sources:
+                sources.append(name)
+    if sources:
+        merged[b'source_file'] = ','.join(sources).encode('utf-8')
+    return merged or None
+
+
+def remove_source_rows(path, source_file, column='source_file'):
+    """
+    複数のソースのデータをまとめたファイルから、指定したソースの行を取り除く
+    （一時ファイルに書いてから置き換える。行が残らない場合はファイルを削除する）
+    列のない以前のファイルは、メタデータのsource_fileがそのソースだけの場合に削除する
+    """
+    table = pq.read_table(path)
+    if column not in table.column_names:
+        metadata = table.schema.metadata or {}
+        if metadata.get(b'source_file', b'').decode('utf-8') == source_file:
+            os.remove(path)
+        return
+    table = table.filter(pc.fill_null(pc.not_equal(table[column], source_file), True))
+    if table.num_rows == 0:
+        os.remove(path)
+        return
+
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    pq.write_table(table, tmp_path, **_writer_options(table.schema, page_index=True))
+    os.replace(tmp_path, path)
+
+
+# compact_datasetの状態ファイル（まとめ終えたパーティションのファイル構成と、
+# 置き換え途中のパーティション）
+COMPACTION_STATE_FILE = '_compaction_state.json'
+
+
+def compact_dataset(dataset_path, target_file_mb=128, sort_by='timestamp', row_group_size=100000,
+                    incremental=True, compression='snappy'):
+    """
+    パーティションごとに細かく分かれたParquetファイルを、sort_byで並べ替えた
+    target_file_mb程度のファイルにまとめ直す
+
+    新しいファイルは隠しファイル（.xxx.tmp）として書き込み、置き換える前に
+    新旧のファイル一覧を状態ファイルに記録してからリネームと削除を行う。
+    途中で中断した場合は、次回の実行時に置き換えを完了するか元に戻すため、
+    パーティションの内容が新旧混在のまま残ることはない。
+    各ファイルのスキーマのメタデータはまとめて新しいファイルに引き継ぐ。
+    データセットに取り込みマニフェストがある場合は出力ファイルの記録も更新する。
+
+    Parameters:
+    -----------
+    dataset_path : str
+        データセットのルートディレクトリ
+    target_file_mb : float, optional
+        まとめた後のファイルサイズの目安（MB）
+    sort_by : str or list, optional
+        ファイル内の並び順に使う列（縦持ちのデータセットでは ['sensor_id', 'timestamp']）
+    row_group_size : int, optional
+        Parquetの行グループあたりの行数
+    incremental : bool, optional
+        Trueの場合、前回まとめた後にファイルが変わっていないパーティションは読み飛ばす
+    compression : str, optional
+        Parquetの圧縮コーデック
+
+    Returns:
+    --------
+    dict
+        まとめ直したパーティション（データセットからの相対パス） -> (元のファイル, 新しいファイル)
+    """
+    state_path = os.path.join(dataset_path, COMPACTION_STATE_FILE)
+    state = {'partitions': {}, 'pending': {}}
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state.update(json.load(f))
+
+    manifest_path = os.path.join(dataset_path, '_ingest_manifest.json')
+    manifest = IngestManifest(manifest_path) if os.path.exists(manifest_path) else None
+
+    _recover_pending(dataset_path, state, state_path, manifest)
+
+    target_bytes = target_file_mb * 1024 * 1024
+    compacted = {}
+    for partition_dir in _list_partition_dirs(dataset_path):
+        rel = os.path.relpath(partition_dir, dataset_path).replace(os.sep, '/')
+        files = sorted(
+            os.path.join(partition_dir, f) for f in os.listdir(partition_dir)
+            if f.endswith('.parquet') and not f.startswith('.')
+        )
+        signature = _file_signature(files)
+        if incremental and state['partitions'].get(rel) == signature:
+            continue
+
+        if any(DELTA_MARKER in os.path.basename(f) for f in files):
+            print(f"差分ファイルを含むパーティションはcompact_partitionでまとめてください: {rel}")
+            continue
+
+        # 1つのファイルで目標サイズに収まっている場合は書き直さない
+        rows_per_file, total_rows = _plan_rows_per_file(files, target_bytes, row_group_size)
+        if len(files) < 2 and total_rows <= rows_per_file:
+            state['partitions'][rel] = signature
+            continue
+
+        new_names = _write_compacted(partition_dir, files, rows_per_file, sort_by, row_group_size, compression)
+
+        # 置き換えの内容を先に記録してから、新しいファイルを公開して古いファイルを削除する
+        swap = {'old': [os.path.basename(f) for f in files], 'new': new_names}
+        state['pending'][rel] = swap
+        _save_json(state_path, state)
+        _apply_swap(dataset_path, rel, swap, state, state_path, manifest)
+
+        compacted[rel] = (files, [os.path.join(partition_dir, f) for f in new_names])
+        print(f"{rel}: {len(files)}ファイルを{len(new_names)}ファイルにまとめました")
+
+    # 削除されたパーティションの記録を消す
+    for rel in list(state['partitions']):
+        if not os.path.isdir(os.path.join(dataset_path, rel)):
+            del state['partitions'][rel]
+
+    _save_json(state_path, state)
+
+    # サマリーファイルがある場合はまとめ直したファイルに合わせて更新する
+    if compacted and os.path.exists(os.path.join(dataset_path, SUMMARY_INDEX_FILE)):
+        update_dataset_summary(dataset_path)
+    return compacted
+
+
+def _write_compacted(partition_dir, files, rows_per_file, sort_by, row_group_size, compression):
+    """パーティションのファイルを読み込んで並べ替え、目標サイズごとに隠しファイルとして書き出す"""
+    tables = [pq.read_table(f) for f in files]
+    metadata = _merge_metadata(t.schema.metadata for t in tables)
+    table = pa.concat_tables(
+        [t.replace_schema_metadata(None) for t in tables], promote_options='permissive'
+    )
+    sort_keys = [sort_by] if isinstance(sort_by, str) else list(sort_by or [])
+    sort_keys = [col for col in sort_keys if col in table.column_names]
+    if sort_keys:
+        table = table.sort_by([(col, 'ascending') for col in sort_keys])
+    table = table.replace_schema_metadata(metadata)
+
+    stamp = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    new_names = []
+    for i, offset in enumerate(range(0, max(table.num_rows, 1), rows_per_file)):
+        file_name = f"compacted-{stamp}-{i}.parquet"
+        tmp_path = os.path.join(partition_dir, f".{file_name}.tmp")
+        with pq.ParquetWriter(tmp_path, table.schema, compression=compression,
+                             **_writer_options(table.schema, page_index=True)) as writer:
+            writer.write_table(table.slice(offset, rows_per_file), row_group_size=row_group_size or None)
+        new_names.append(file_name)
+    return new_names
+
+
+def _apply_swap(dataset_path, rel, swap, state, state_path, manifest):
+    """
+    記録した置き換えを実行する（中断後に再実行しても同じ結果になる）
+    新しいファイルを公開し、古いファイルを削除してからマニフェストと状態ファイルを更新する
+    """
+    partition_dir = os.path.join(dataset_path, rel)
+    new_paths = [os.path.join(partition_dir, f) for f in swap['new']]
+    old_paths = [os.path.join(partition_dir, f) for f in swap['old']]
+
+    for final_path in new_paths:
+        tmp_path = os.path.join(partition_dir, f".{os.path.basename(final_path)}.tmp")
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, final_path)
+    for old_path in old_paths:
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+    if manifest is not None:
+        manifest.replace_outputs(old_paths, new_paths)
+        manifest.save()
+
+    state['partitions'][rel] = _file_signature(new_paths)
+    del state['pending'][rel]
+    _save_json(state_path, state)
+
+
+def _recover_pending(dataset_path, state, state_path, manifest):
+    """前回中断した置き換えを完了する（新しいファイルが揃っていない場合は元に戻す）"""
+    for rel, swap in list(state['pending'].items()):
+        partition_dir = os.path.join(dataset_path, rel)
+        written = [
+            os.path.exists(os.path.join(partition_dir, f)) or os.path.exists(os.path.join(partition_dir, f".{f}.tmp"))
+            for f in swap['new']
+        ]
+        if all(written):
+            _apply_swap(dataset_path, rel, swap, state, state_path, manifest)
+            continue
+
+        for f in swap['new']:
+            for path in (os.path.join(partition_dir, f), os.path.join(partition_dir, f".{f}.tmp")):
+                if os.path.exists(path):
+                    os.remove(path)
+        del state['pending'][rel]
+        _save_json(state_path, state)
+
+
+def _plan_rows_per_file(files, target_bytes, row_group_size):
+    """
+    元のファイルの1行あたりのサイズ（フッター等を除いた圧縮後のデータ量）から
+    1ファイルあたりの行数を見積もる。(1ファイルあたりの行数, 全体の行数) を返す
+    """
+    total_rows = 0
+    total_bytes = 0
+    for f in files:
+        metadata = pq.ParquetFile(f).metadata
+        total_rows += metadata.num_rows
+        total_bytes += sum(
+            metadata.row_group(i).column(j).total_compressed_size
+            for i in range(metadata.num_row_groups)
+            for j in range(metadata.num_columns)
+        )
+    bytes_per_row = total_bytes / max(total_rows, 1)
+    rows_per_file = max(int(target_bytes / max(bytes_per_row, 1e-9)), row_group_size or 1, 1)
+    return rows_per_file, total_rows
+
+
+def _list_partition_dirs(dataset_path):
+    """Parquetファイルを含むパーティションのディレクトリを返す（隠し・_始まりは除く）"""
+    partition_dirs = []
+    for root, dirs, files in os.walk(dataset_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(('.', '_')))
+        if root != dataset_path and any(f.endswith('.parquet') and not f.startswith('.') for f in files):
+            partition_dirs.append(root)
+    return partition_dirs
+
+
+def _file_signature(files):
+    """ファイル名・サイズ・更新時刻の一覧（パーティションの変更検出に使う）"""
+    signature = []
+    for f in files:
+        stat = os.stat(f)
+        signature.append([os.path.basename(f), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+# データセットのサマリーの索引（ファイルごとのサイズ・更新時刻とスキーマの系列）
+SUMMARY_INDEX_FILE = '_summary.json'
+
+
+def update_dataset_summary(dataset_path):
+    """
+    データセットのサマリーファイル（_common_metadata / _metadata）を更新する
+
+    _metadataには全てのファイルの行グループのフッター情報をまとめるが、Parquetの
+    仕様上、1つの_metadataに含められるのは同じスキーマのファイルだけである。
+    そのためスキーマの系列ごとに _metadata.<系列> を作成し、全系列の列の和集合を
+    _common_metadataに書き込む（系列が1つの場合は _metadata も作成する）。
+    前回から追加されたファイルはフッターだけを読んで追記し、削除・変更された
+    ファイルを含む系列だけを作り直す。
+
+    Returns:
+    --------
+    pyarrow.Schema
+        データセット全体のスキーマ（列の和集合）
+    """
+    index_path = os.path.join(dataset_path, SUMMARY_INDEX_FILE)
+    index = {'files': {}}
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+
+    current = {}
+    for partition_dir in _list_partition_dirs(dataset_path):
+        for file_name in os.listdir(partition_dir):
+            if file_name.endswith('.parquet') and not file_name.startswith('.'):
+                path = os.path.join(partition_dir, file_name)
+                stat = os.stat(path)
+                rel = os.path.relpath(path, dataset_path).replace(os.sep, '/')
+                current[rel] = [stat.st_size, stat.st_mtime_ns]
+
+    # 削除・変更されたファイルを含む系列と、前回の索引にない系列は作り直す
+    files = index['files']
+    previous_groups = set(index.get('groups', {}))
+    changed = [rel for rel, info in files.items() if current.get(rel) != [info['size'], info['mtime_ns']]]
+    dirty = {files[rel]['group'] for rel in changed}
+    for rel in changed:
+        del files[rel]
+
+    # 追加されたファイルはフッターだけを読み込む
+    footers = {}
+    for rel in sorted(current):
+        if rel in files:
+            continue
+        metadata = _read_footer(dataset_path, rel)
+        group = _schema_group(metadata)
+        footers[rel] = metadata
+        files[rel] = {'size': current[rel][0], 'mtime_ns': current[rel][1], 'group': group, 'num_rows': metadata.num_rows}
+
+    members = {}
+    for rel in sorted(files):
+        members.setdefault(files[rel]['group'], []).append(rel)
+
+    for group in sorted(dirty | {files[rel]['group'] for rel in footers}):
+        summary_path = os.path.join(dataset_path, f"_metadata.{group}")
+        if group not in members:
+            if os.path.exists(summary_path):
+                os.remove(summary_path)
+            continue
+
+        if group in dirty or group not in previous_groups or not os.path.exists(summary_path):
+            summary = None
+            rels = members[group]
+        else:
+            summary = pq.read_metadata(summary_path)
+            rels = [rel for rel in members[group] if rel in footers]
+
+        for rel in rels:
+            metadata = footers.get(rel) or _read_footer(dataset_path, rel)
+            if summary is None:
+                summary = metadata
+            else:
+                summary.append_row_groups(metadata)
+        _write_footer(summary, summary_path)
+
+    # 列の和集合のスキーマ（系列ごとのサマリーのスキーマだけを読む）
+    schemas = [pq.read_schema(os.path.join(dataset_path, f"_metadata.{group}")) for group in sorted(members)]
+    schema = _unify_schemas(schemas)
+    if schema is not None:
+        pq.write_metadata(schema, os.path.join(dataset_path, '_common_metadata'))
+
+    metadata_path = os.path.join(dataset_path, '_metadata')
+    if len(members) == 1:
+        _write_footer(pq.read_metadata(os.path.join(dataset_path, f"_metadata.{next(iter(members))}")), metadata_path)
+    elif os.path.exists(metadata_path):
+        os.remove(metadata_path)
+
+    index['groups'] = {group: len(rels) for group, rels in members.items()}
+    _save_json(index_path, index)
+    return schema
+
+
+def open_dataset(dataset_path, partitioning='hive'):
+    """
+    サマリーファイルからpyarrowのデータセットを開く
+
+    各ファイルのフッターを読まずに、サマリーに記録された行グループの統計情報で
+    パーティションと行グループを絞り込める。スキーマはデータセット全体の列の
+    和集合になる（ファイルにない列は欠損値）。サマリーがない場合や、系列ごとの
+    スキーマをまとめられない場合はディレクトリを走査して開く。
+    """
+    index_path = os.path.join(dataset_path, SUMMARY_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return ds.dataset(dataset_path, format='parquet', partitioning=partitioning)
+
+    with open(index_path, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    groups = sorted(index.get('groups', {}))
+
+    # パーティションの型を系列ごとに推定すると、year=2024 と year=2024.0 のように
+    # 系列によって型が異なる場合があるため、全ファイルのパスから1つのスキーマを作る
+    if partitioning == 'hive':
+        partitioning = _hive_partitioning(index.get('files', {}))
+
+    try:
+        children = [
+            ds.parquet_dataset(os.path.join(dataset_path, f"_metadata.{group}"), partitioning=partitioning)
+            for group in groups
+        ]
+        if not children:
+            return ds.dataset(dataset_path, format='parquet', partitioning=partitioning)
+
+        # 系列ごとのフラグメント（行グループの統計情報付き）を1つのデータセットにまとめ、
+        # 列の和集合のスキーマで読み込む（型の異なる列は読み込み時にキャストされる）
+        return ds.FileSystemDataset(
+            [fragment for child in children for fragment in child.get_fragments()],
+            schema=_unify_schemas([child.schema for child in children]),
+            format=ds.ParquetFileFormat(),
+            filesystem=children[0].filesystem
+        )
+    except (pa.ArrowTypeError, pa.ArrowInvalid) as e:
+        print(f"警告: サマリーからデータセットを開けないため、ディレクトリを走査します: {e}")
+        return ds.dataset(dataset_path, format='parquet', partitioning=partitioning)
+
+
+def _hive_partitioning(rels):
+    """
+    ファイルの相対パス（year=2024/month=1/xxx.parquet）からhiveパーティションを作る
+    値が全て整数のキーはint32、それ以外は文字列にする（ds.datasetの推定と同じ）
+    """
+    values = {}
+    for rel in sorted(rels):
+        for part in rel.split('/')[:-1]:
+            if '=' in part:
+                key, value = part.split('=', 1)
+                values.setdefault(key, set()).add(value)
+
+    def is_int32(value):
+        return value.lstrip('-').isascii() and value.lstrip('-').isdigit() and -2 ** 31 <= int(value) < 2 ** 31
+
+    return ds.partitioning(pa.schema([
+        pa.field(key, pa.int32() if all(is_int32(value) for value in key_values) else pa.string())
+        for key, key_values in values.items()
+    ]), flavor='hive')
+
+
+# 縦持ち（sensor_id, timestamp, value）のテーブルの列
+LONG_COLUMNS = ('sensor_id', 'timestamp', 'value')
+
+# タイムスタンプの単位 -> マイクロ秒に対する倍率
+_UNIT_SCALE = {'ms': (1000, 1), 'us': (1, 1), 'ns': (1, 1000)}
+
+
+def read_range(dataset_path, sensors, start=None, end=None, partitions=None, stats=None):
+    """
+    指定したセンサーの期間 [start, end) の行だけを読み込む
+
+    year=/month= などのパーティション、行グループの最小・最大値、ページインデックス
+    （列インデックス・オフセットインデックス）の順に読む範囲を絞り込み、該当する
+    ページだけを読み込む。フッターとページインデックスはファイルごとにキャッシュ
+    するため、ある時刻や短い期間の読み込みは数ページの読み込みで済む。
+    ページインデックスのないファイルは、該当する行グループを読み込む。
+    差分ファイルのあるパーティションは、timestampが同じ行は最後に取り込まれたものを返す。
+
+    Parameters:
+    -----------
+    dataset_path : str
+        データセットのルートディレクトリ
+    sensors : list
+        読み込むセンサー（横持ちでは列名、縦持ちではsensor_id）
+    start : str or datetime, optional
+        期間の開始（含む）
+    end : str or datetime, optional
+        期間の終了（含まない）。startと同じ場合はその時刻の行を返す
+    partitions : dict, optional
+        年月以外のパーティションの値（例: {'machine': 'machine1'}）
+    stats : dict, optional
+        読み込んだファイル・行グループ・ページの数とバイト数を加算する
+
+    Returns:
+    --------
+    pyarrow.Table
+        横持ちでは timestamp と各センサーの列（timestamp順）、
+        縦持ちでは sensor_id, timestamp, value（sensor_id・timestamp順）
+    """
+    if isinstance(sensors, str):
+        sensors = [sensors]
+    sensors = [str(sensor) for sensor in sensors]
+    lo = _to_micros(start) if start is not None else None
+    hi = _to_micros(end) if end is not None else None
+    if lo is not None and hi is not None:
+        # 期間を両端を含む範囲にする
+        hi = hi if hi == lo else hi - 1
+    elif hi is not None:
+        hi -= 1
+    if stats is not None:
+        for name in ('files', 'row_groups', 'pages', 'bytes'):
+            stats.setdefault(name, 0)
+
+    tables = []
+    for partition_dir in _range_partition_dirs(dataset_path, lo, hi, partitions or {}):
+        for base, deltas in list_partition_files(partition_dir).values():
+            parts = [
+                table for table in (
+                    _read_file_range(path, sensors, lo, hi, stats) for path in ([base] if base else []) + deltas
+                ) if table is not None
+            ]
+            if not parts:
+                continue
+            table = pa.concat_tables(parts, promote_options='permissive')
+            if deltas and 'sensor_id' not in table.column_names:
+                table = _latest_by_key(table, 'timestamp')
+            tables.append(table)
+
+    long = any('sensor_id' in table.column_names for table in tables)
+    if not tables:
+        return _empty_range_table(dataset_path, sensors)
+    table = pa.concat_tables(tables, promote_options='permissive')
+    if long:
+        return table.sort_by([('sensor_id', 'ascending'), ('timestamp', 'ascending')])
+    for sensor in sensors:
+        if sensor not in table.column_names:
+            table = table.append_column(sensor, pa.nulls(table.num_rows, type=pa.float64()))
+    return table.select(['timestamp'] + sensors).sort_by('timestamp')
+
+
+def _empty_range_table(dataset_path, sensors):
+    """
+    該当する行がない場合の空のテーブル（横持ち・縦持ちは_common_metadataか、
+    ない場合は最初のファイルのスキーマで判定する）
+    """
+    schema = None
+    common_metadata_path = os.path.join(dataset_path, '_common_metadata')
+    if os.path.exists(common_metadata_path):
+        schema = pq.read_schema(common_metadata_path)
+    else:
+        for partition_dir in _list_partition_dirs(dataset_path):
+            for base, deltas in list_partition_files(partition_dir).values():
+                schema = pq.read_schema(base or deltas[0])
+                break
+            break
+
+    if schema is not None and all(name in schema.names for name in LONG_COLUMNS):
+        fields = []
+        for name in LONG_COLUMNS:
+            field_type = schema.field(name).type
+            if name == 'timestamp':
+                field_type = pa.timestamp('us')
+            elif pa.types.is_dictionary(field_type):
+                field_type = field_type.value_type
+            fields.append(pa.field(name, field_type))
+        return pa.schema(fields).empty_table()
+    return pa.table({
+        'timestamp': pa.array([], type=pa.timestamp('us')),
+        **{sensor: pa.array([], type=pa.float64()) for sensor in sensors}
+    })
+
+
+def _to_micros(value):
+    return int(np.datetime64(value, 'us').astype(np.int64))
+
+
+def _range_partition_dirs(dataset_path, lo, hi, partitions):
+    """パーティションのキー（year, month と partitions）で期間外のディレクトリを除いて返す"""
+    to_month = lambda micros: None if micros is None else tuple(
+        int(v) for v in str(np.datetime64(micros, 'us').astype('datetime64[M]')).split('-')
+    )
+    lo_month, hi_month = to_month(lo), to_month(hi)
+
+    def in_range(keys, key, value):
+        if key in partitions:
+            return value == str(partitions[key])
+        try:
+            if key == 'year':
+                year = int(value)
+                return (lo_month is None or lo_month[0] <= year) and (hi_month is None or year <= hi_month[0])
+            if key == 'month' and 'year' in keys:
+                month = (int(keys['year']), int(value))
+                return (lo_month is None or lo_month <= month) and (hi_month is None or month <= hi_month)
+        except ValueError:
+            pass
+        return True
+
+    partition_dirs = []
+    for root, dirs, files in os.walk(dataset_path):
+        keys = dict(
+            part.split('=', 1) for part in os.path.relpath(root, dataset_path).split(os.sep) if '=' in part
+        )
+        dirs[:] = sorted(
+            d for d in dirs
+            if not d.startswith(('.', '_')) and ('=' not in d or in_range(keys, *d.split('=', 1)))
+        )
+        if root != dataset_path and any(f.endswith('.parquet') and not f.startswith('.') for f in files):
+            partition_dirs.append(root)
+    return partition_dirs
+
+
+def _read_file_range(path, sensors, lo, hi, stats):
+    """1つのファイルから期間・センサーに該当する行を読み込む（該当しない場合はNone）"""
+    footer = read_footer(path)
+    long = all(name in footer.columns for name in LONG_COLUMNS)
+    if long:
+        columns = list(LONG_COLUMNS)
+    else:
+        columns = ['timestamp'] + [sensor for sensor in sensors if sensor in footer.columns]
+    if 'timestamp' not in footer.columns or (not long and len(columns) == 1):
+        return None
+    if stats is not None:
+        stats['files'] += 1
+
+    # 比較に使う値の範囲（タイムスタンプはファイルの単位の整数）
+    multiply, divide = _UNIT_SCALE[timestamp_unit(footer, 'timestamp')]
+    to_file_unit = lambda micros, ceil: -(-micros * divide // multiply) if ceil else micros * divide // multiply
+    bounds = {'timestamp': (
+        None if lo is None else np.int64(to_file_unit(lo, True)).tobytes(),
+        None if hi is None else np.int64(to_file_unit(hi, False)).tobytes(),
+    )}
+    targets = sorted(sensor.encode('utf-8') for sensor in sensors) if long else None
+
+    tables = []
+    handle = None
+    try:
+        for rg in range(len(footer.row_groups)):
+            if not _row_group_matches(footer, rg, bounds, targets):
+                continue
+            if stats is not None:
+                stats['row_groups'] += 1
+            if not footer.flat or not footer.has_page_index(rg, columns):
+                tables.append(_plain_columns(pq.ParquetFile(path).read_row_group(rg, columns=columns)))
+                continue
+
+            if handle is None:
+                handle = open(path, 'rb')
+            ranges = _page_ranges(footer, handle, rg, 'timestamp', bounds['timestamp'])
+            if long:
+                ranges = _intersect_ranges(ranges, _page_ranges(footer, handle, rg, 'sensor_id', None, targets))
+            for row_begin, row_end in ranges:
+                tables.append(pa.table({
+                    name: read_column_rows(footer, handle, rg, name, row_begin, row_end, stats)
+                    for name in columns
+                }))
+    finally:
+        if handle is not None:
+            handle.close()
+    if not tables:
+        return None
+
+    table = pa.concat_tables(tables, promote_options='permissive')
+    timestamps = table['timestamp'].cast(pa.timestamp('us'))
+    table = table.set_column(table.column_names.index('timestamp'), 'timestamp', timestamps)
+    mask = pc.is_valid(timestamps)
+    if lo is not None:
+        mask = pc.and_(mask, pc.greater_equal(timestamps, pa.scalar(lo, type=pa.timestamp('us'))))
+    if hi is not None:
+        mask = pc.and_(mask, pc.less_equal(timestamps, pa.scalar(hi, type=pa.timestamp('us'))))
+    if long:
+        mask = pc.and_(mask, pc.is_in(table['sensor_id'], value_set=pa.array(sensors, type=pa.string())))
+    return table.filter(mask)
+
+
+def _row_group_matches(footer, rg, bounds, targets):
+    """行グループの最小・最大値が期間（縦持ちではセンサー）に該当するかどうか"""
+    statistics = footer.statistics(rg, 'timestamp')
+    if statistics is not None:
+        low, high = (np.frombuffer(v, dtype='<i8')[0] for v in statistics)
+        lo, hi = (None if v is None else np.frombuffer(v, dtype='<i8')[0] for v in bounds['timestamp'])
+        if (lo is not None and high < lo) or (hi is not None and low > hi):
+            return False
+    if targets is not None:
+        statistics = footer.statistics(rg, 'sensor_id')
+        if statistics is not None and not any(statistics[0] <= t <= statistics[1] for t in targets):
+            return False
+    return True
+
+
+def _page_ranges(footer, handle, rg, name, bounds, targets=None):
+    """列インデックスで、期間（またはいずれかのtargets）に該当するページの行の範囲を返す"""
+    locations, column_index = footer.page_index(rg, name, handle)
+    rg_rows = footer.row_group_rows(rg)
+    if column_index is None:
+        return [(0, rg_rows)]
+
+    keep = []
+    for is_null, low, high in zip(column_index['null_pages'], column_index['min'], column_index['max']):
+        if is_null:
+            keep.append(False)
+        elif targets is not None:
+            keep.append(any(low <= t <= high for t in targets))
+        else:
+            low, high = np.frombuffer(low, dtype='<i8')[0], np.frombuffer(high, dtype='<i8')[0]
+            lo, hi = (None if v is None else np.frombuffer(v, dtype='<i8')[0] for v in bounds)
+            keep.append((lo is None or high >= lo) and (hi is None or low <= hi))
+    return page_row_ranges(locations, rg_rows, keep)
+
+
+def _intersect_ranges(a, b):
+    """行番号の範囲のリスト同士の共通部分"""
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        begin, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if begin < end:
+            result.append((begin, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def _plain_columns(table):
+    """辞書型の列を値の型に戻す（ページから読んだ列と型をそろえる）"""
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(field.type.value_type))
+    return table.replace_schema_metadata(None)
+
+
+def _read_footer(dataset_path, rel):
+    metadata = pq.read_metadata(os.path.join(dataset_path, rel))
+    metadata.set_file_path(rel)
+    return metadata
+
+
+def _write_footer(metadata, path):
+    tmp_path = f"{path}.tmp"
+    metadata.write_metadata_file(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _schema_group(metadata):
+    """Parquetのスキーマ（列名と物理型・論理型）から系列のIDを作る"""
+    schema = metadata.schema
+    columns = [
+        (column.path, column.physical_type, str(column.logical_type), column.max_definition_level)
+        for column in (schema.column(i) for i in range(len(schema)))
+    ]
+    return hashlib.sha1(json.dumps(columns, ensure_ascii=False).encode('utf-8')).hexdigest()[:12]
+
+
+def _unify_schemas(schemas):
+    """
+    スキーマの和集合（同じ列の型が異なる場合は広い型にそろえる）
+    辞書エンコードの有無が系列によって異なる列は、元の値の型にそろえる
+    """
+    schemas = [pa.schema([field.remove_metadata() for field in schema]) for schema in schemas]
+    if not schemas:
+        return None
+    try:
+        return pa.unify_schemas(schemas, promote_options='permissive')
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        schemas = [
+            pa.schema([
+                field.with_type(field.type.value_type) if pa.types.is_dictionary(field.type) else field
+                for field in schema
+            ])
+            for schema in schemas
+        ]
+        return pa.unify_schemas(schemas, promote_options='permissive')
+
+
+def _save_json(path, data):
+    """JSONを一時ファイルに書いてからリネームする"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,396 @@
+import os
+import struct
+from collections import OrderedDict
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Thrift Compact Protocolの型
+_STOP, _TRUE, _FALSE, _BYTE, _I16, _I32, _I64, _DOUBLE, _BINARY, _LIST, _SET, _MAP, _STRUCT = range(13)
+
+# フッターを読み込む際に、末尾からまとめて読むバイト数
+_FOOTER_READ_SIZE = 64 * 1024
+
+# (パス) -> (サイズ, 更新時刻, ParquetFooter)
+_FOOTER_CACHE = OrderedDict()
+_FOOTER_CACHE_SIZE = 256
+
+
+# ---------------------------------------------------------------------------
+# Thrift Compact Protocol（Parquetのフッター・ページインデックスの形式）
+# 構造体は {フィールドID: (型, 値)}、リストは (要素の型, [値]) として扱い、
+# 読み込んだ構造体をそのまま書き戻せるようにする
+# ---------------------------------------------------------------------------
+
+def _read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _read_value(buf, pos, ttype):
+    if ttype in (_TRUE, _FALSE):
+        # リストの要素のboolは1バイト（1: true）
+        return buf[pos] == _TRUE, pos + 1
+    if ttype == _BYTE:
+        return struct.unpack_from('<b', buf, pos)[0], pos + 1
+    if ttype in (_I16, _I32, _I64):
+        value, pos = _read_varint(buf, pos)
+        return _zigzag(value), pos
+    if ttype == _DOUBLE:
+        return struct.unpack_from('<d', buf, pos)[0], pos + 8
+    if ttype == _BINARY:
+        length, pos = _read_varint(buf, pos)
+        return bytes(buf[pos:pos + length]), pos + length
+    if ttype in (_LIST, _SET):
+        header = buf[pos]
+        pos += 1
+        size, elem_type = header >> 4, header & 0x0F
+        if size == 15:
+            size, pos = _read_varint(buf, pos)
+        values = []
+        for _ in range(size):
+            value, pos = _read_value(buf, pos, elem_type)
+            values.append(value)
+        return (elem_type, values), pos
+    if ttype == _MAP:
+        size, pos = _read_varint(buf, pos)
+        if size == 0:
+            return (0, 0, []), pos
+        types = buf[pos]
+        pos += 1
+        key_type, value_type = types >> 4, types & 0x0F
+        items = []
+        for _ in range(size):
+            key, pos = _read_value(buf, pos, key_type)
+            value, pos = _read_value(buf, pos, value_type)
+            items.append((key, value))
+        return (key_type, value_type, items), pos
+    if ttype == _STRUCT:
+        return read_struct(buf, pos)
+    raise ValueError(f"未対応のThriftの型です: {ttype}")
+
+
+def read_struct(buf, pos=0):
+    """Thrift Compact Protocolの構造体を読み込む（{フィールドID: (型, 値)}, 次の位置）"""
+    fields = {}
+    field_id = 0
+    while True:
+        header = buf[pos]
+        pos += 1
+        ttype = header & 0x0F
+        if ttype == _STOP:
+            return fields, pos
+        delta = header >> 4
+        if delta:
+            field_id += delta
+        else:
+            value, pos = _read_varint(buf, pos)
+            field_id = _zigzag(value)
+        if ttype in (_TRUE, _FALSE):
+            fields[field_id] = (ttype, ttype == _TRUE)
+        else:
+            value, pos = _read_value(buf, pos, ttype)
+            fields[field_id] = (ttype, value)
+
+
+def _write_varint(out, n):
+    while True:
+        if n < 0x80:
+            out.append(n)
+            return
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+
+
+def _write_value(out, ttype, value):
+    if ttype in (_TRUE, _FALSE):
+        out.append(_TRUE if value else _FALSE)
+    elif ttype == _BYTE:
+        out += struct.pack('<b', value)
+    elif ttype in (_I16, _I32, _I64):
+        _write_varint(out, (value << 1) ^ (value >> 63))
+    elif ttype == _DOUBLE:
+        out += struct.pack('<d', value)
+    elif ttype == _BINARY:
+        _write_varint(out, len(value))
+        out += value
+    elif ttype in (_LIST, _SET):
+        elem_type, values = value
+        if len(values) < 15:
+            out.append((len(values) << 4) | elem_type)
+        else:
+            out.append(0xF0 | elem_type)
+            _write_varint(out, len(values))
+        for item in values:
+            _write_value(out, elem_type, item)
+    elif ttype == _MAP:
+        key_type, value_type, items = value
+        _write_varint(out, len(items))
+        if items:
+            out.append((key_type << 4) | value_type)
+            for key, item in items:
+                _write_value(out, key_type, key)
+                _write_value(out, value_type, item)
+    elif ttype == _STRUCT:
+        write_struct(out, value)
+    else:
+        raise ValueError(f"未対応のThriftの型です: {ttype}")
+
+
+def write_struct(out, fields):
+    """{フィールドID: (型, 値)} の構造体をThrift Compact Protocolで書き込む"""
+    last_id = 0
+    for field_id in sorted(fields):
+        ttype, value = fields[field_id]
+        # boolのフィールドは型に値を含める
+        if ttype in (_TRUE, _FALSE):
+            ttype = _TRUE if value else _FALSE
+        delta = field_id - last_id
+        if 0 < delta <= 15:
+            out.append((delta << 4) | ttype)
+        else:
+            out.append(ttype)
+            _write_varint(out, (field_id << 1) ^ (field_id >> 63))
+        if ttype not in (_TRUE, _FALSE):
+            _write_value(out, ttype, value)
+        last_id = field_id
+    out.append(_STOP)
+    return out
+
+
+def _get(fields, field_id, default=None):
+    item = fields.get(field_id)
+    return default if item is None else item[1]
+
+
+# ---------------------------------------------------------------------------
+# フッターとページインデックス
+# ---------------------------------------------------------------------------
+
+class ParquetFooter:
+    """
+    Parquetファイルのフッター（FileMetaData）を読み込んだもの
+
+    行グループ・列チャンクの統計情報とページインデックスの位置を参照できる。
+    ページインデックスは行グループごとに1回の読み込みでまとめて取得し、保持する。
+    """
+
+    def __init__(self, path, metadata):
+        self.path = path
+        self.metadata = metadata
+        schema = _get(metadata, 2)[1]
+        # 入れ子のないスキーマの列名 -> (列番号, SchemaElement)
+        self.columns = {}
+        self.flat = all(_get(element, 5) is None for element in schema[1:])
+        for index, element in enumerate(schema[1:]):
+            self.columns[_get(element, 4).decode('utf-8')] = (index, element)
+        self.row_groups = _get(metadata, 4, (0, []))[1]
+        self._page_indexes = {}
+
+    def row_group_rows(self, rg):
+        return _get(self.row_groups[rg], 3)
+
+    def column_chunk(self, rg, name):
+        index, _ = self.columns[name]
+        return _get(self.row_groups[rg], 1)[1][index]
+
+    def statistics(self, rg, name):
+        """列チャンクの (最小値, 最大値) の生のバイト列（統計情報がない場合はNone）"""
+        meta = _get(self.column_chunk(rg, name), 3)
+        stats = _get(meta, 12)
+        if stats is None:
+            return None
+        low, high = _get(stats, 6, _get(stats, 2)), _get(stats, 5, _get(stats, 1))
+        if low is None or high is None:
+            return None
+        return low, high
+
+    def has_page_index(self, rg, names):
+        return all(
+            _get(self.column_chunk(rg, name), 4) is not None and _get(self.column_chunk(rg, name), 6) is not None
+            for name in names
+        )
+
+    def page_index(self, rg, name, handle):
+        """
+        列チャンクのページインデックス
+        ([(ページのオフセット, 圧縮後のサイズ, 先頭の行番号)], 列インデックス)
+        """
+        if rg not in self._page_indexes:
+            self._page_indexes[rg] = self._read_page_indexes(rg, handle)
+        return self._page_indexes[rg][name]
+
+    def _read_page_indexes(self, rg, handle):
+        # 行グループの全ての列のページインデックスは連続しているため、まとめて読む
+        spans = []
+        for name in self.columns:
+            chunk = self.column_chunk(rg, name)
+            if _get(chunk, 4) is not None:
+                spans.append((_get(chunk, 4), _get(chunk, 5)))
+            if _get(chunk, 6) is not None:
+                spans.append((_get(chunk, 6), _get(chunk, 7)))
+        if not spans:
+            return {}
+        begin = min(offset for offset, _ in spans)
+        end = max(offset + length for offset, length in spans)
+        handle.seek(begin)
+        buf = handle.read(end - begin)
+
+        indexes = {}
+        for name in self.columns:
+            chunk = self.column_chunk(rg, name)
+            locations, column_index = None, None
+            if _get(chunk, 4) is not None:
+                offset_index, _ = read_struct(buf, _get(chunk, 4) - begin)
+                locations = [(_get(loc, 1), _get(loc, 2), _get(loc, 3)) for loc in _get(offset_index, 1)[1]]
+            if _get(chunk, 6) is not None:
+                column_index, _ = read_struct(buf, _get(chunk, 6) - begin)
+                column_index = {
+                    'null_pages': _get(column_index, 1)[1],
+                    'min': _get(column_index, 2)[1],
+                    'max': _get(column_index, 3)[1],
+                }
+            indexes[name] = (locations, column_index)
+        return indexes
+
+
+def read_footer(path):
+    """Parquetファイルのフッターを読み込む（サイズ・更新時刻が同じ間はキャッシュを使う）"""
+    stat = os.stat(path)
+    cached = _FOOTER_CACHE.get(path)
+    if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        _FOOTER_CACHE.move_to_end(path)
+        return cached[2]
+
+    with open(path, 'rb') as f:
+        tail_size = min(stat.st_size, _FOOTER_READ_SIZE)
+        f.seek(stat.st_size - tail_size)
+        tail = f.read(tail_size)
+        if tail[-4:] != b'PAR1':
+            raise ValueError(f"Parquetファイルではありません: {path}")
+        footer_length = struct.unpack('<i', tail[-8:-4])[0]
+        if footer_length + 8 > len(tail):
+            f.seek(stat.st_size - footer_length - 8)
+            tail = f.read(footer_length + 8)
+    metadata, _ = read_struct(tail[-8 - footer_length:-8])
+
+    footer = ParquetFooter(path, metadata)
+    _FOOTER_CACHE[path] = (stat.st_size, stat.st_mtime_ns, footer)
+    while len(_FOOTER_CACHE) > _FOOTER_CACHE_SIZE:
+        _FOOTER_CACHE.popitem(last=False)
+    return footer
+
+
+def timestamp_unit(footer, name):
+    """タイムスタンプ列の単位（'ms' / 'us' / 'ns'）"""
+    _, element = footer.columns[name]
+    logical = _get(element, 10)
+    if logical is not None and 8 in logical:
+        unit = _get(_get(logical, 8), 2)
+        return {1: 'ms', 2: 'us', 3: 'ns'}[next(iter(unit))]
+    converted = _get(element, 6)
+    return {9: 'ms', 10: 'us'}.get(converted, 'us')
+
+
+def page_row_ranges(locations, rg_rows, keep):
+    """ページごとの採否（keep）を行番号の範囲のリスト [(開始, 終了)] に変換する"""
+    ranges = []
+    for i, (_, _, first_row) in enumerate(locations):
+        if not keep[i]:
+            continue
+        last_row = locations[i + 1][2] if i + 1 < len(locations) else rg_rows
+        if ranges and ranges[-1][1] == first_row:
+            ranges[-1] = (ranges[-1][0], last_row)
+        else:
+            ranges.append((first_row, last_row))
+    return ranges
+
+
+def read_column_rows(footer, handle, rg, name, row_begin, row_end, stats=None):
+    """
+    列チャンクのうち、行番号 [row_begin, row_end) を含むページだけを読み込む
+
+    選んだページ（と辞書ページ）を1回の読み込みで取得し、その列だけの
+    Parquetファイルをメモリ上に組み立ててpyarrowでデコードする。
+
+    Returns:
+    --------
+    pyarrow.ChunkedArray
+        [row_begin, row_end) の行の値
+    """
+    locations, _ = footer.page_index(rg, name, handle)
+    rg_rows = footer.row_group_rows(rg)
+    first = max(i for i, loc in enumerate(locations) if loc[2] <= row_begin)
+    last = max(i for i, loc in enumerate(locations) if loc[2] < row_end)
+    page_begin = locations[first][0]
+    page_end = locations[last][0] + locations[last][1]
+    rows_begin = locations[first][2]
+    rows_end = locations[last + 1][2] if last + 1 < len(locations) else rg_rows
+
+    chunk = footer.column_chunk(rg, name)
+    meta = _get(chunk, 3)
+    dictionary_offset = _get(meta, 11)
+    data_offset = _get(meta, 9)
+    has_dictionary = dictionary_offset is not None and dictionary_offset < data_offset
+    # 辞書ページは先頭のデータページの直前にあるため、先頭のページから読む場合はまとめて読む
+    read_begin = dictionary_offset if has_dictionary and page_begin == data_offset else page_begin
+    handle.seek(read_begin)
+    pages = handle.read(page_end - read_begin)
+    dictionary = b''
+    if has_dictionary:
+        if read_begin == dictionary_offset:
+            dictionary, pages = pages[:data_offset - dictionary_offset], pages[data_offset - dictionary_offset:]
+        else:
+            handle.seek(dictionary_offset)
+            dictionary = handle.read(data_offset - dictionary_offset)
+    if stats is not None:
+        stats['pages'] += last - first + 1 + (1 if has_dictionary else 0)
+        stats['bytes'] += len(dictionary) + len(pages)
+
+    table = _decode_pages(footer, name, meta, dictionary, pages, rows_end - rows_begin)
+    return table.column(0).slice(row_begin - rows_begin, row_end - row_begin)
+
+
+def _decode_pages(footer, name, meta, dictionary, pages, num_rows):
+    """ページのバイト列から1列だけのParquetファイルを組み立ててデコードする"""
+    _, element = footer.columns[name]
+    root = dict(_get(footer.metadata, 2)[1][0])
+    root[5] = (_I32, 1)
+
+    dictionary_offset = 4
+    data_offset = 4 + len(dictionary)
+    new_meta = {k: v for k, v in meta.items() if k in (1, 2, 3, 4)}
+    new_meta[5] = (_I64, num_rows)
+    new_meta[6] = (_I64, len(dictionary) + len(pages))
+    new_meta[7] = (_I64, len(dictionary) + len(pages))
+    new_meta[9] = (_I64, data_offset)
+    if dictionary:
+        new_meta[11] = (_I64, dictionary_offset)
+
+    column_chunk = {2: (_I64, 4), 3: (_STRUCT, new_meta)}
+    row_group = {
+        1: (_LIST, (_STRUCT, [column_chunk])),
+        2: (_I64, len(dictionary) + len(pages)),
+        3: (_I64, num_rows),
+    }
+    metadata = {
+        1: footer.metadata[1],
+        2: (_LIST, (_STRUCT, [root, element])),
+        3: (_I64, num_rows),
+        4: (_LIST, (_STRUCT, [row_group])),
+    }
+    if 6 in footer.metadata:
+        metadata[6] = footer.metadata[6]
+
+    footer_bytes = write_struct(bytearray(), metadata)
+    data = b'PAR1' + dictionary + pages + bytes(footer_bytes) + struct.pack('<i', len(footer_bytes)) + b'PAR1'
+    return pq.read_table(pa.BufferReader(data))
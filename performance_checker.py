@@ -16,6 +16,23 @@ import multiprocessing
 import shutil
 import tempfile
 import gc
+import csv
+import json
+import socket
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from sensor_csv import HEADER_ROWS, scan_csv_ranges, sniff_csv_header
+from sensor_fixture import DATE_FORMAT_ALIASES, generate_sensor_csv
+
+# ベンチマークマトリクスで比較するエンジン
+MATRIX_ENGINES = ['pandas', 'polars', 'pyarrow', 'duckdb']
+
+# ベンチマークマトリクスの結果の列（CSVに書き出す順）
+MATRIX_FIELDS = [
+    'host', 'cpu_count', 'memory_gb', 'engine', 'codec', 'level', 'row_group_size', 'threads', 'chunk_size',
+    'cache', 'runs', 'mean', 'p50', 'p95', 'min', 'max', 'mb_per_second', 'rows_per_second',
+    'rows', 'input_bytes', 'output_bytes', 'rss_growth', 'error'
+]
 
 class PerformanceChecker:
     def __init__(self, log_to_file=True, log_to_console=True, log_level=logging.INFO, log_file="performance_check.log"):
@@ -132,14 +149,17 @@ class PerformanceChecker:
             # 一時ディレクトリの削除
             shutil.rmtree(temp_dir)
     
-    def test_csv_to_parquet_performance(self, csv_file_path, parquet_file_path=None, engine="polars", num_runs=3):
-        """CSVファイルからParquetへの変換パフォーマンステスト"""
+    def test_csv_to_parquet_performance(self, csv_file_path, parquet_file_path=None, engine="polars", num_runs=3, sensor_format=False):
+        """CSVファイルからParquetへの変換パフォーマンステスト（sensor_formatは3行ヘッダーのセンサーCSVの場合）"""
         self.logger.info("======= CSV→Parquet変換パフォーマンステスト =======")
         self.logger.info(f"CSVファイル: {csv_file_path}")
         
         if not os.path.exists(csv_file_path):
             self.logger.error(f"CSVファイルが見つかりません: {csv_file_path}")
             return
+        if csv_file_path.lower().endswith('.zip'):
+            self.logger.error(f"ZIPファイルは計測できません。展開したCSVを指定してください: {csv_file_path}")
+            return
         
         if parquet_file_path is None:
             parquet_file_path = csv_file_path.replace('.csv', '.parquet')
@@ -151,17 +171,21 @@ class PerformanceChecker:
         # CSVファイルの基本情報
         csv_file_size = os.path.getsize(csv_file_path)
         self.logger.info(f"CSVファイルサイズ: {self._format_bytes(csv_file_size)}")
+        layout = _sensor_csv_layout(csv_file_path) if sensor_format else None
+        if engine == "polars" and layout is not None and not _is_utf8(layout['encoding']):
+            self.logger.error(f"polarsはUTF-8以外のCSVを読み込めません（エンコーディング: {layout['encoding']}）。"
+                              "--engine pandasか、UTF-8に変換したコピーで計測する--matrixを使用してください")
+            return
         
         # CSVの行数を取得（高速に）
+        # 変換時のバイト範囲の分割と同じ事前走査（メモリマップして改行を数える）を使う
         self.logger.info("CSVの行数カウント開始...")
         start_time = time.time()
-        if engine == "polars":
-            line_count = pl.scan_csv(csv_file_path).select(pl.count()).collect().item()
-        else:  # pandas
-            with open(csv_file_path, 'r', encoding='utf-8') as f:
-                line_count = sum(1 for _ in f) - 1  # ヘッダー行を除く
+        with pa.memory_map(csv_file_path) as mapped:
+            scan = scan_csv_ranges(mapped.read_buffer())
+        line_count = max(scan['rows'] - (layout['header_rows'] if layout else 1), 0)  # ヘッダー行を除く
         count_time = time.time() - start_time
-        self.logger.info(f"CSVの行数: {line_count}行")
+        self.logger.info(f"CSVの行数: {line_count}行（{len(scan['ranges'])}範囲）")
         self.logger.info(f"行数カウント時間: {count_time:.2f}秒")
         
         # 各実行の結果を保存
@@ -185,10 +209,10 @@ class PerformanceChecker:
             
             if engine == "polars":
                 # Polarsでの読み込み
-                df = pl.read_csv(csv_file_path)
+                df = pl.read_csv(csv_file_path, **_polars_read_options(layout))
             else:
                 # Pandasでの読み込み
-                df = pd.read_csv(csv_file_path)
+                df = pd.read_csv(csv_file_path, **_pandas_read_options(layout))
             
             read_end = time.time()
             read_time = read_end - read_start
@@ -268,7 +292,152 @@ class PerformanceChecker:
         # 速度計算
         avg_speed_mb_per_sec = (csv_file_size / 1024 / 1024) / (sum(total_times)/len(total_times))
         self.logger.info(f"平均処理速度: {avg_speed_mb_per_sec:.2f} MB/秒")
-    
+
+    def run_benchmark_matrix(self, csv_file_path, output_path="benchmark_matrix.csv", engines=None,
+                             codecs=("snappy", "zstd:3"), row_group_sizes=(None,), threads=None,
+                             chunk_sizes=(None,), cache_modes=("cold", "warm"), num_runs=3, work_dir=None,
+                             sensor_format=False):
+        """
+        エンジン・圧縮・行グループ・スレッド数・チャンクの組み合わせごとにCSV→Parquetの変換時間を計測する
+
+        組み合わせごとに新しいプロセスで計測する（スレッド数はプロセスの開始時に設定する必要があり、
+        前の組み合わせのメモリやスレッドプールの影響も受けないため）。
+        coldはOSのページキャッシュから入力ファイルを追い出してから計測し（posix_fadviseを
+        使えない環境では計測しない）、warmは1回読み込んでから計測する。
+
+        Args:
+            csv_file_path (str): 入力CSVファイルパス（sensor_formatがFalseの場合は1行目がヘッダー。ZIPは不可）
+            output_path (str): 結果の出力先（拡張子が.jsonの場合はJSON、それ以外はCSV。既存のファイルは置き換える）
+            engines (list): 比較するエンジン（Noneの場合は全て）
+            codecs (list): 圧縮方式（'zstd:3'のようにコロンの後に圧縮レベルを指定できる。'none'は無圧縮）
+            row_group_sizes (list): 行グループの行数（Noneはエンジンの既定値）
+            threads (list): スレッド数（Noneの場合は1と論理コア数）
+            chunk_sizes (list): 1回に読み込む行数（Noneはファイル全体。duckdbはNoneのみ）
+            cache_modes (list): 'cold' と 'warm' の一方または両方
+            num_runs (int): 組み合わせごとの計測回数
+            work_dir (str): 出力Parquetを置く作業ディレクトリ（Noneの場合は一時ディレクトリ）
+            sensor_format (bool): 3行ヘッダーのセンサーCSVとして読み込む（列名はヘッダーから作成する。
+                UTF-8以外の場合は、UTF-8に変換したコピーを全エンジンで読み込む）
+
+        Returns:
+            list: 組み合わせ・キャッシュの状態ごとの結果（MATRIX_FIELDSのdict）
+        """
+        self.logger.info("======= ベンチマークマトリクス =======")
+        if not os.path.exists(csv_file_path):
+            self.logger.error(f"CSVファイルが見つかりません: {csv_file_path}")
+            return []
+        if csv_file_path.lower().endswith('.zip'):
+            self.logger.error(f"ZIPファイルは計測できません。展開したCSVを指定してください: {csv_file_path}")
+            return []
+
+        engines = list(engines or MATRIX_ENGINES)
+        unknown = [engine for engine in engines if engine not in MATRIX_ENGINES]
+        if unknown:
+            raise ValueError(f"未対応のエンジンです: {unknown}（{MATRIX_ENGINES}から選択してください）")
+        threads = list(threads or sorted({1, psutil.cpu_count(logical=True) or 1}))
+        cache_modes = list(cache_modes)
+        if 'cold' in cache_modes and not hasattr(os, 'posix_fadvise'):
+            self.logger.warning("この環境ではページキャッシュを追い出せないため、coldの計測を省略します")
+            cache_modes = [mode for mode in cache_modes if mode != 'cold']
+
+        # 行数と1行の平均バイト数（pyarrowのチャンクの行数をブロックのバイト数に換算する）
+        csv_file_size = os.path.getsize(csv_file_path)
+        layout = _sensor_csv_layout(csv_file_path) if sensor_format else None
+        with pa.memory_map(csv_file_path) as mapped:
+            rows = max(scan_csv_ranges(mapped.read_buffer())['rows'] - (layout['header_rows'] if layout else 1), 0)
+        row_bytes = csv_file_size / max(rows, 1)
+        self.logger.info(f"CSVファイル: {csv_file_path}（{self._format_bytes(csv_file_size)}、{rows}行）")
+
+        configs = []
+        for engine, codec, row_group_size, thread_count, chunk_size in itertools.product(
+                engines, codecs, row_group_sizes, threads, chunk_sizes):
+            if engine == 'duckdb' and chunk_size:
+                continue
+            name, level = _parse_codec(codec)
+            configs.append({
+                'engine': engine, 'codec': name, 'level': level, 'row_group_size': row_group_size,
+                'threads': thread_count, 'chunk_size': chunk_size
+            })
+        self.logger.info(f"組み合わせ数: {len(configs)}（キャッシュ: {', '.join(cache_modes)}、各{num_runs}回）")
+
+        host = {
+            'host': socket.gethostname(),
+            'cpu_count': psutil.cpu_count(logical=True),
+            'memory_gb': round(psutil.virtual_memory().total / 1024 ** 3, 1)
+        }
+        temp_dir = tempfile.mkdtemp(dir=work_dir)
+        results = []
+        try:
+            # polars・duckdbはShift-JIS/CP932を読めないため、UTF-8に変換したコピーを全エンジンで読み込む
+            # （変換したファイルのサイズでMB/秒を計算する。文字コードの変換時間は含まない）
+            if layout is not None and not _is_utf8(layout['encoding']):
+                csv_file_path, layout = _transcode_to_utf8(csv_file_path, layout, temp_dir)
+                csv_file_size = os.path.getsize(csv_file_path)
+                row_bytes = csv_file_size / max(rows, 1)
+                self.logger.warning(f"UTF-8に変換したコピーで計測します（{self._format_bytes(csv_file_size)}）")
+            for i, config in enumerate(configs, 1):
+                self.logger.info(f"[{i}/{len(configs)}] {_format_config(config)}")
+                parquet_path = os.path.join(temp_dir, f"matrix_{i}.parquet")
+                # polarsのスレッド数は読み込み時の環境変数で決まるため、子プロセスの開始前に設定する
+                previous = os.environ.get('POLARS_MAX_THREADS')
+                os.environ['POLARS_MAX_THREADS'] = str(config['threads'])
+                try:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                        measured = executor.submit(
+                            _run_matrix_config, config, csv_file_path, parquet_path, cache_modes, num_runs, row_bytes, layout
+                        ).result()
+                except Exception as e:
+                    measured = [{'cache': mode, 'times': [], 'output_bytes': 0, 'rss_growth': 0, 'error': str(e)}
+                                for mode in cache_modes]
+                finally:
+                    if previous is None:
+                        os.environ.pop('POLARS_MAX_THREADS', None)
+                    else:
+                        os.environ['POLARS_MAX_THREADS'] = previous
+
+                for run in measured:
+                    result = _summarize_runs(host, config, run, rows, csv_file_size)
+                    results.append(result)
+                    if result['error']:
+                        self.logger.warning(f"  {run['cache']}: エラー: {result['error']}")
+                    else:
+                        self.logger.info(
+                            f"  {run['cache']}: 平均 {result['mean']:.3f}秒 / p50 {result['p50']:.3f}秒 / "
+                            f"p95 {result['p95']:.3f}秒 / {result['mb_per_second']:.2f} MB/秒 / "
+                            f"Parquet {self._format_bytes(result['output_bytes'])}"
+                        )
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        _write_matrix_results(results, output_path)
+        self.logger.info(f"ベンチマークマトリクスの結果を保存しました: {output_path}")
+
+        # キャッシュの状態ごとに最も速かった組み合わせ
+        for mode in cache_modes:
+            finished = [r for r in results if r['cache'] == mode and not r['error']]
+            if finished:
+                best = min(finished, key=lambda r: r['p50'])
+                self.logger.info(f"最速（{mode}、p50）: {_format_config(best)} - {best['p50']:.3f}秒 / {best['mb_per_second']:.2f} MB/秒")
+        return results
+
+    def generate_sensor_fixture(self, output_path, **options):
+        """
+        ベンチマーク用の3行ヘッダーのセンサーCSVを生成する（実データがない環境で計測するため）
+
+        Args:
+            output_path (str): 出力先（.zipの場合はZIP）
+            **options: sensor_fixture.generate_sensor_csvの引数（rows, columns, interval, nan_ratio など）
+
+        Returns:
+            str: 生成したファイルのパス
+        """
+        self.logger.info("======= ベンチマーク用CSVの生成 =======")
+        stats = generate_sensor_csv(output_path, **options)
+        self.logger.info(f"生成したファイル: {stats['path']}（{', '.join(stats['members'])}）")
+        self.logger.info(f"行数: {stats['rows']}行 / 列数: {stats['columns']}列 / サイズ: {self._format_bytes(stats['bytes'])}")
+        self.logger.info(f"生成時間: {stats['seconds']:.2f}秒（{stats['mb_per_second']} MB/秒）")
+        return stats['path']
+
     def _format_bytes(self, bytes):
         """バイト数を人間が読みやすい形式にフォーマット"""
         for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
@@ -278,9 +447,264 @@ class PerformanceChecker:
         return f"{bytes:.2f} PB"
 
 
+def _parse_codec(codec):
+    """'zstd:3' を ('zstd', 3) に分ける（レベルを指定しない場合はNone）"""
+    name, _, level = str(codec).partition(':')
+    name = name.strip().lower()
+    if name in ('', 'uncompressed'):
+        name = 'none'
+    return name, int(level) if level else None
+
+
+def _format_config(config):
+    codec = config['codec'] if config['level'] is None else f"{config['codec']}:{config['level']}"
+    return (f"engine={config['engine']} codec={codec} row_group_size={config['row_group_size'] or '既定'} "
+            f"threads={config['threads']} chunk_size={config['chunk_size'] or '全体'}")
+
+
+def _evict_page_cache(path):
+    """ファイルをOSのページキャッシュから追い出す（変更されていないページのみ。coldの計測用）"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _warm_page_cache(path):
+    """ファイルを読み込んでOSのページキャッシュに載せる（warmの計測用）"""
+    with open(path, 'rb') as f:
+        while f.read(16 * 1024 * 1024):
+            pass
+
+
+def _sensor_csv_layout(csv_path):
+    """3行ヘッダーのセンサーCSVの読み込み設定（ヘッダーを読み飛ばし、列名は変換時と同じものを使う）"""
+    header = sniff_csv_header(csv_path)
+    return {
+        'header_rows': HEADER_ROWS,
+        'names': header['custom_headers'],
+        'encoding': header['encoding'],
+        'delimiter': header['delimiter']
+    }
+
+
+def _is_utf8(encoding):
+    return encoding.replace('-', '').replace('_', '').lower() in ('utf8', 'utf8sig')
+
+
+def _transcode_to_utf8(csv_path, layout, output_dir):
+    """UTF-8以外のCSVをUTF-8に変換したコピーを作成し、(コピーのパス, 読み込み設定) を返す"""
+    utf8_path = os.path.join(output_dir, os.path.splitext(os.path.basename(csv_path))[0] + '.utf8.csv')
+    with open(csv_path, 'r', encoding=layout['encoding'], newline='') as src, \
+            open(utf8_path, 'w', encoding='utf-8', newline='') as dst:
+        shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+    return utf8_path, {**layout, 'encoding': 'utf-8'}
+
+
+def _pandas_read_options(layout):
+    if layout is None:
+        return {}
+    return {'skiprows': layout['header_rows'], 'header': None, 'names': layout['names'],
+            'encoding': layout['encoding'], 'sep': layout['delimiter']}
+
+
+def _polars_read_options(layout):
+    # polarsはUTF-8以外を読めない（不正なバイトを置き換えて読むと日時などが文字化けし、計測結果を比較できない）
+    if layout is None:
+        return {}
+    if not _is_utf8(layout['encoding']):
+        raise ValueError(f"polarsはUTF-8以外のCSVを読み込めません（エンコーディング: {layout['encoding']}）")
+    return {'skip_rows': layout['header_rows'], 'has_header': False, 'new_columns': layout['names'],
+            'separator': layout['delimiter'], 'encoding': 'utf8'}
+
+
+def _convert_with_pandas(csv_path, parquet_path, config, row_bytes, layout=None):
+    """pandasで読み込み、pyarrowで書き込む（スレッド数はArrowへの変換と書き込みに使う）"""
+    if config['chunk_size']:
+        chunks = pd.read_csv(csv_path, chunksize=config['chunk_size'], **_pandas_read_options(layout))
+    else:
+        chunks = [pd.read_csv(csv_path, **_pandas_read_options(layout))]
+    writer = None
+    try:
+        for df in chunks:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(parquet_path, table.schema, compression=config['codec'],
+                                          compression_level=config['level'])
+            writer.write_table(table.cast(writer.schema), row_group_size=config['row_group_size'])
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _convert_with_pyarrow(csv_path, parquet_path, config, row_bytes, layout=None):
+    """pyarrowで読み込み・書き込む（チャンクの行数は1行の平均バイト数でブロックのバイト数に換算する）"""
+    import pyarrow.csv as pv
+    use_threads = config['threads'] > 1
+    read_options = {}
+    parse_options = pv.ParseOptions()
+    if layout is not None:
+        read_options = {'skip_rows': layout['header_rows'], 'column_names': layout['names'], 'encoding': layout['encoding']}
+        parse_options = pv.ParseOptions(delimiter=layout['delimiter'])
+    if not config['chunk_size']:
+        table = pv.read_csv(csv_path, read_options=pv.ReadOptions(use_threads=use_threads, **read_options),
+                            parse_options=parse_options)
+        pq.write_table(table, parquet_path, compression=config['codec'], compression_level=config['level'],
+                       row_group_size=config['row_group_size'])
+        return
+    block_size = max(int(config['chunk_size'] * row_bytes), 1024 * 1024)
+    reader = pv.open_csv(csv_path, read_options=pv.ReadOptions(use_threads=use_threads, block_size=block_size, **read_options),
+                         parse_options=parse_options)
+    with pq.ParquetWriter(parquet_path, reader.schema, compression=config['codec'],
+                          compression_level=config['level']) as writer:
+        for batch in reader:
+            writer.write_table(pa.Table.from_batches([batch], reader.schema), row_group_size=config['row_group_size'])
+
+
+def _convert_with_polars(csv_path, parquet_path, config, row_bytes, layout=None):
+    """polarsで読み込み・書き込む（チャンクを指定した場合はストリーミングで処理する）"""
+    options = {
+        'compression': 'uncompressed' if config['codec'] == 'none' else config['codec'],
+        'compression_level': config['level'],
+        'row_group_size': config['row_group_size']
+    }
+    if config['chunk_size']:
+        with pl.Config(streaming_chunk_size=config['chunk_size']):
+            pl.scan_csv(csv_path, **_polars_read_options(layout)).sink_parquet(parquet_path, **options)
+    else:
+        pl.read_csv(csv_path, **_polars_read_options(layout)).write_parquet(parquet_path, **options)
+
+
+def _convert_with_duckdb(csv_path, parquet_path, config, row_bytes, layout=None):
+    """duckdbのCOPYで変換する（チャンクの行数は指定できない）"""
+    import duckdb
+    options = ["FORMAT parquet", f"COMPRESSION {'uncompressed' if config['codec'] == 'none' else config['codec']}"]
+    if config['level'] is not None:
+        options.append(f"COMPRESSION_LEVEL {config['level']}")
+    if config['row_group_size']:
+        options.append(f"ROW_GROUP_SIZE {config['row_group_size']}")
+    con = duckdb.connect()
+    try:
+        con.execute(f"SET threads TO {config['threads']}")
+        source = csv_path.replace("'", "''")
+        target = parquet_path.replace("'", "''")
+        if layout is None:
+            read_options = "header = true"
+        else:
+            encoding = 'utf-8' if _is_utf8(layout['encoding']) else layout['encoding']
+            if encoding != 'utf-8':
+                # UTF-8以外（utf-16・latin-1を除く）はencodings拡張が必要
+                try:
+                    con.execute("INSTALL encodings; LOAD encodings")
+                except Exception as e:
+                    raise ValueError(f"duckdbでエンコーディング {encoding} を読み込めません（encodings拡張: {e}）") from e
+            names = ', '.join("'" + name.replace("'", "''") + "'" for name in layout['names'])
+            read_options = (f"header = false, skip = {layout['header_rows']}, delim = '{layout['delimiter']}', "
+                            f"encoding = '{encoding}', names = [{names}]")
+        con.execute(f"COPY (SELECT * FROM read_csv('{source}', {read_options})) TO '{target}' ({', '.join(options)})")
+    finally:
+        con.close()
+
+
+_MATRIX_CONVERTERS = {
+    'pandas': _convert_with_pandas,
+    'pyarrow': _convert_with_pyarrow,
+    'polars': _convert_with_polars,
+    'duckdb': _convert_with_duckdb
+}
+
+
+def _run_matrix_config(config, csv_path, parquet_path, cache_modes, num_runs, row_bytes, layout=None):
+    """
+    1つの組み合わせをキャッシュの状態ごとにnum_runs回計測する（子プロセスで実行する）
+
+    Returns:
+        list: キャッシュの状態ごとの {'cache', 'times', 'output_bytes', 'rss_growth', 'error'}
+    """
+    pa.set_cpu_count(config['threads'])
+    pa.set_io_thread_count(config['threads'])
+    convert = _MATRIX_CONVERTERS[config['engine']]
+    process = psutil.Process()
+    measured = []
+    for mode in cache_modes:
+        run = {'cache': mode, 'times': [], 'output_bytes': 0, 'rss_growth': 0, 'error': None}
+        try:
+            if mode == 'warm':
+                # 1回目はキャッシュ・ライブラリの初期化を含むため計測しない
+                _warm_page_cache(csv_path)
+                convert(csv_path, parquet_path, config, row_bytes, layout)
+            for _ in range(num_runs):
+                if os.path.exists(parquet_path):
+                    os.remove(parquet_path)
+                if mode == 'cold':
+                    _evict_page_cache(csv_path)
+                gc.collect()
+                initial_memory = process.memory_info().rss
+                start_time = time.perf_counter()
+                convert(csv_path, parquet_path, config, row_bytes, layout)
+                run['times'].append(time.perf_counter() - start_time)
+                run['rss_growth'] = max(run['rss_growth'], process.memory_info().rss - initial_memory)
+            run['output_bytes'] = os.path.getsize(parquet_path)
+        except Exception as e:
+            # 複数行のエラーメッセージ（duckdbなど）は1行目だけを記録する
+            message = str(e).strip().splitlines()
+            run['error'] = f"{type(e).__name__}: {message[0] if message else ''}"
+        measured.append(run)
+    return measured
+
+
+def _summarize_runs(host, config, run, rows, input_bytes):
+    """計測時間を平均・p50・p95・MB/秒などの1行にまとめる"""
+    result = {**host, **config, 'cache': run['cache'], 'runs': len(run['times']), 'rows': rows,
+              'input_bytes': input_bytes, 'output_bytes': run['output_bytes'], 'rss_growth': run['rss_growth'],
+              'error': run['error']}
+    if run['times'] and not run['error']:
+        times = np.array(run['times'])
+        mean = float(times.mean())
+        result.update({
+            'mean': round(mean, 6),
+            'p50': round(float(np.percentile(times, 50)), 6),
+            'p95': round(float(np.percentile(times, 95)), 6),
+            'min': round(float(times.min()), 6),
+            'max': round(float(times.max()), 6),
+            'mb_per_second': round(input_bytes / 1024 / 1024 / mean, 3) if mean > 0 else None,
+            'rows_per_second': round(rows / mean, 1) if mean > 0 else None
+        })
+    return {field: result.get(field) for field in MATRIX_FIELDS}
+
+
+def _write_matrix_results(results, output_path):
+    """結果を書き出す（拡張子が.jsonの場合はJSON、それ以外はCSV）"""
+    if output_path.lower().endswith('.json'):
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    else:
+        with open(output_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=MATRIX_FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+    return output_path
+
+
+def _parse_list(value, convert=str):
+    """カンマ区切りの引数をリストにする（'default' / 'none' / 0 はNone）"""
+    items = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if convert is not str and item.lower() in ('default', 'none', '0'):
+            items.append(None)
+        else:
+            items.append(convert(item))
+    return items
+
+
 def main():
     parser = argparse.ArgumentParser(description='CSVからParquetへの変換パフォーマンスチェック')
-    parser.add_argument('csv_file', help='入力CSVファイルパス')
+    parser.add_argument('csv_file', nargs='?', help='入力CSVファイルパス（--generateの場合は不要）')
     parser.add_argument('--parquet_file', help='出力Parquetファイルパス（指定しない場合はCSVと同じ名前で拡張子が.parquetになります）')
     parser.add_argument('--engine', choices=['polars', 'pandas'], default='polars', help='使用するエンジン (polars または pandas)')
     parser.add_argument('--log_file', default='performance_check.log', help='ログファイル名')
@@ -293,6 +717,32 @@ def main():
     parser.add_argument('--disk_test', action='store_true', help='ディスク性能テストを実行する')
     parser.add_argument('--disk_test_size', type=int, default=100, help='ディスク性能テスト用ファイルサイズ（MB）')
     parser.add_argument('--num_runs', type=int, default=3, help='テスト実行回数')
+    parser.add_argument('--sensor_format', action='store_true', help='3行ヘッダー（センサー点番、センサー名、単位）のセンサーCSVとして読み込む')
+    
+    # ベンチマーク用CSVの生成のオプション
+    generate_group = parser.add_argument_group('ベンチマーク用CSVの生成オプション')
+    generate_group.add_argument('--generate', action='store_true', help='3行ヘッダーのセンサーCSVを生成して計測する（csv_fileの代わりに）')
+    generate_group.add_argument('--generate_output', default='sensor_fixture.csv', help='生成するCSVファイルパス（ZIPは不可）')
+    generate_group.add_argument('--generate_rows', type=int, default=1000000, help='生成する行数')
+    generate_group.add_argument('--generate_columns', type=int, default=50, help='生成するセンサー列数')
+    generate_group.add_argument('--generate_interval', default='1s', help="サンプリング間隔（'1s'・'100ms'・'1min'など）")
+    generate_group.add_argument('--generate_nan_ratio', type=float, default=0.01, help='欠損値（空欄）の割合')
+    generate_group.add_argument('--generate_duplicate_columns', type=int, default=0, help='センサー点番・センサー名が重複する列数')
+    generate_group.add_argument('--generate_date_format', default='slash', help=f"日時の形式（{', '.join(DATE_FORMAT_ALIASES)}、またはstrftimeの形式）")
+    generate_group.add_argument('--generate_pad_hour', action='store_true', help='時を0埋めする（00:00:00）')
+    generate_group.add_argument('--generate_encoding', default='utf-8', help='エンコーディング（utf-8, shift-jis, cp932）')
+    generate_group.add_argument('--generate_seed', type=int, default=0, help='乱数のシード（同じシード・設定からは同じファイルを生成する）')
+    
+    # ベンチマークマトリクスのオプション
+    matrix_group = parser.add_argument_group('ベンチマークマトリクスオプション')
+    matrix_group.add_argument('--matrix', action='store_true', help='エンジン・設定の組み合わせごとに計測する（--engineの代わりに）')
+    matrix_group.add_argument('--matrix_engines', default=','.join(MATRIX_ENGINES), help='比較するエンジン（カンマ区切り）')
+    matrix_group.add_argument('--matrix_codecs', default='snappy,zstd:3', help='圧縮方式（カンマ区切り。zstd:9のように圧縮レベルを指定できる）')
+    matrix_group.add_argument('--matrix_row_group_sizes', default='default', help='行グループの行数（カンマ区切り。defaultはエンジンの既定値）')
+    matrix_group.add_argument('--matrix_threads', help='スレッド数（カンマ区切り。指定しない場合は1と論理コア数）')
+    matrix_group.add_argument('--matrix_chunk_sizes', default='none', help='1回に読み込む行数（カンマ区切り。noneはファイル全体）')
+    matrix_group.add_argument('--matrix_cache', default='cold,warm', help='計測するキャッシュの状態（cold, warm）')
+    matrix_group.add_argument('--matrix_output', default='benchmark_matrix.csv', help='結果の出力先（.jsonの場合はJSON、それ以外はCSV）')
     
     # 仮想環境関連のオプション
     venv_group = parser.add_argument_group('仮想環境オプション')
@@ -301,6 +751,12 @@ def main():
     venv_group.add_argument('--list_venvs', action='store_true', help='利用可能な仮想環境を一覧表示して終了')
     
     args = parser.parse_args()
+    if args.generate and args.csv_file:
+        parser.error('--generateの場合はcsv_fileを指定せず、--generate_outputで出力先を指定してください')
+    if not args.generate and not args.csv_file:
+        parser.error('csv_fileを指定するか、--generateを指定してください')
+    if args.generate and args.generate_output.lower().endswith('.zip'):
+        parser.error('--generate_outputにはCSVファイルを指定してください（ZIPを生成する場合はsensor_fixture.pyを直接実行してください）')
     
     # ログレベルの設定
     log_level = getattr(logging, args.log_level)
@@ -320,12 +776,47 @@ def main():
     if args.disk_test:
         checker.check_disk_performance(args.disk_test_size)
     
+    # ベンチマーク用CSVの生成（オプション）
+    csv_file = args.csv_file
+    sensor_format = args.sensor_format
+    if args.generate:
+        csv_file = checker.generate_sensor_fixture(
+            args.generate_output,
+            rows=args.generate_rows,
+            columns=args.generate_columns,
+            interval=args.generate_interval,
+            nan_ratio=args.generate_nan_ratio,
+            duplicate_columns=args.generate_duplicate_columns,
+            date_format=args.generate_date_format,
+            pad_hour=args.generate_pad_hour,
+            encoding=args.generate_encoding,
+            seed=args.generate_seed
+        )
+        sensor_format = True
+    
+    # エンジン・設定の組み合わせごとの計測（オプション）
+    if args.matrix:
+        checker.run_benchmark_matrix(
+            csv_file,
+            output_path=args.matrix_output,
+            engines=_parse_list(args.matrix_engines),
+            codecs=_parse_list(args.matrix_codecs),
+            row_group_sizes=_parse_list(args.matrix_row_group_sizes, int),
+            threads=[n for n in _parse_list(args.matrix_threads, int) if n] if args.matrix_threads else None,
+            chunk_sizes=_parse_list(args.matrix_chunk_sizes, int),
+            cache_modes=_parse_list(args.matrix_cache),
+            num_runs=args.num_runs,
+            sensor_format=sensor_format
+        )
+        return
+    
     # CSVからParquetへの変換パフォーマンステスト
     checker.test_csv_to_parquet_performance(
-        args.csv_file,
+        csv_file,
         args.parquet_file,
         args.engine,
-        args.num_runs
+        args.num_runs,
+        sensor_format
     )
 
 
@@ -442,7 +933,7 @@ if __name__ == "__main__":
     
     # 仮想環境で実行するかどうかを判断
     if args.venv or args.venv_name:
-        if not args.csv_file:
+        if not args.csv_file and '--generate' not in unknown:
             print("エラー: CSVファイルパスを指定してください。")
             sys.exit(1)
             
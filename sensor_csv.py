@@ -0,0 +1,525 @@
+import csv
+import hashlib
+import io
+import os
+import re
+import zipfile
+from contextlib import contextmanager
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+from sensor_pipeline import ReadAheadReader
+
+# ヘッダー判定時に試すエンコーディング（日本語ロガーの出力を想定）
+DEFAULT_ENCODINGS = ['utf-8', 'shift-jis', 'cp932']
+
+# ヘッダー読み込み時の読み込みブロックサイズ
+SNIFF_BLOCK_SIZE = 64 * 1024
+
+# ヘッダー行数（センサー点番、センサー名、単位）
+HEADER_ROWS = 3
+
+# CSV読み込みエンジン（pandas以外はArrowのテーブルを直接返す）
+ARROW_ENGINES = ('pyarrow', 'polars')
+
+# 欠損値として扱う文字列
+NULL_VALUES = ['', 'NaN', 'nan', 'NA', 'N/A', 'NULL', 'null', '-', '--', '---']
+
+# pyarrowのストリーミング読み込みのブロックサイズ（バイト）
+CSV_BLOCK_SIZE = 16 * 1024 * 1024
+
+# 改行の数を数える際に1回に調べるバイト数
+_SCAN_BLOCK_SIZE = 64 * 1024 * 1024
+
+# 範囲の境界で次の改行を探す際に1回に調べるバイト数
+_NEWLINE_SEARCH_SIZE = 64 * 1024
+
+# 数値として解釈できる文字列のパターン（pd.to_numeric(errors='coerce')相当の判定用）
+_NUMERIC_PATTERN = r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$'
+
+# ヘッダーのフィンガープリント -> 解析済みヘッダー
+# 同じロガー系列のファイルは同じヘッダーを持つため、解析結果を再利用する
+_HEADER_CACHE = {}
+
+
+def sniff_csv_header(source, encoding='utf-8', encodings=None):
+    """
+    3行ヘッダーCSVの先頭を1回だけ読み込み、エンコーディング・区切り文字・
+    ヘッダー3行を解析する
+
+    解析結果はヘッダーのバイト列のフィンガープリントでキャッシュされ、
+    同じヘッダーを持つファイルでは再解析しない。戻り値の辞書はキャッシュと
+    共有されるため、呼び出し側で変更しないこと（'dtypes'を除く）。
+
+    Parameters:
+    -----------
+    source : str, tuple or file-like
+        CSVファイルのパス、(ZIPファイルのパス, メンバー名) のタプル、
+        またはバイナリモードで開いたファイルオブジェクト
+    encoding : str, optional
+        最初に試すエンコーディング
+    encodings : list, optional
+        encodingで失敗した場合に試すエンコーディングのリスト
+
+    Returns:
+    --------
+    dict
+        encoding, header_rows, delimiter, sensor_points, sensor_names, units,
+        custom_headers, fingerprint, header_size, dtypes を含む辞書
+    """
+    if hasattr(source, 'read'):
+        header_bytes = read_header_bytes(source)
+    else:
+        with open_source(source) as f:
+            header_bytes = read_header_bytes(f)
+
+    candidates = [encoding] if encoding else []
+    candidates += [enc for enc in (encodings or DEFAULT_ENCODINGS) if enc not in candidates]
+
+    fingerprint = hashlib.sha1(header_bytes).hexdigest()
+    cache_key = (fingerprint, tuple(candidates))
+    cached = _HEADER_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    detected_encoding, text = _decode_header(header_bytes, candidates)
+    delimiter = _detect_delimiter(text)
+
+    rows = list(csv.reader(io.StringIO(text), delimiter=delimiter))
+    rows += [[] for _ in range(HEADER_ROWS - len(rows))]
+    n_cols = max(len(row) for row in rows[:HEADER_ROWS])
+    sensor_points, sensor_names, units = [
+        [_header_value(cell) for cell in row] + [float('nan')] * (n_cols - len(row))
+        for row in rows[:HEADER_ROWS]
+    ]
+
+    header = {
+        'encoding': detected_encoding,
+        # 型変換前のヘッダー3行の文字列
+        'header_rows': [row + [''] * (n_cols - len(row)) for row in rows[:HEADER_ROWS]],
+        'delimiter': delimiter,
+        'sensor_points': sensor_points,
+        'sensor_names': sensor_names,
+        'units': units,
+        'custom_headers': build_custom_headers(sensor_points, sensor_names),
+        'fingerprint': fingerprint,
+        'header_size': len(header_bytes),
+        # 最初に処理したファイルから学習した列の型（列名 -> dtype文字列）
+        'dtypes': {},
+    }
+    _HEADER_CACHE[cache_key] = header
+    return header
+
+
+def read_header_bytes(f):
+    """
+    バイナリファイルオブジェクトからヘッダー3行分のバイト列を読み込む
+
+    改行(0x0A)はUTF-8/Shift-JIS/CP932のいずれでもマルチバイト文字の一部に
+    ならないため、デコード前のバイト列のまま行を区切ることができる。
+    ファイルオブジェクトの位置はヘッダーの直後（データ行の先頭）になる。
+    """
+    buffer = b''
+    start = f.tell() if f.seekable() else None
+
+    while buffer.count(b'\n') < HEADER_ROWS:
+        block = f.read(SNIFF_BLOCK_SIZE)
+        if not block:
+            break
+        buffer += block
+
+    # 3行目の改行までをヘッダーとする
+    end = 0
+    for _ in range(HEADER_ROWS):
+        pos = buffer.find(b'\n', end)
+        if pos < 0:
+            end = len(buffer)
+            break
+        end = pos + 1
+
+    if start is not None:
+        f.seek(start + end)
+    return buffer[:end]
+
+
+@contextmanager
+def open_source(source):
+    """
+    CSVのソースをバイナリストリームとして開く
+
+    sourceはファイルパス、または (ZIPファイルのパス, メンバー名) のタプル。
+    ZIPのメンバーは一時ディレクトリに展開せず、ZipFile.openで直接展開しながら読む。
+    """
+    if isinstance(source, tuple):
+        zip_path, member = source
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            with zip_ref.open(member, 'r') as f:
+                yield f
+    else:
+        with open(source, 'rb') as f:
+            yield f
+
+
+@contextmanager
+def open_data_stream(source, header, prefetch_blocks=0):
+    """
+    ヘッダー3行を読み飛ばした位置（データ行の先頭）でソースを開く
+    prefetch_blocksを指定すると、ZIPのメンバーは別のスレッドで先行して展開する
+    """
+    with open_source(source) as f:
+        f.seek(header['header_size'])
+        if prefetch_blocks and isinstance(source, tuple):
+            with io.BufferedReader(ReadAheadReader(f, blocks=prefetch_blocks)) as reader:
+                yield reader
+        else:
+            yield f
+
+
+def source_size(source):
+    """ソースの（展開後の）サイズをバイト数で返す"""
+    if isinstance(source, tuple):
+        zip_path, member = source
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            return zip_ref.getinfo(member).file_size
+    return os.path.getsize(source)
+
+
+def source_name(source):
+    """ソースのファイル名を返す（ZIPのメンバーはフォルダを除いたファイル名）"""
+    if isinstance(source, tuple):
+        return os.path.basename(source[1])
+    return os.path.basename(source)
+
+
+def list_zip_csv_members(zip_path):
+    """ZIP内のCSVファイルのメンバー名を返す（フォルダ内のファイルも含む）"""
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        return [
+            info.filename for info in zip_ref.infolist()
+            if not info.is_dir() and info.filename.lower().endswith('.csv')
+        ]
+
+
+def build_custom_headers(sensor_points, sensor_names):
+    """
+    センサー点番とセンサー名から重複のない列名のリストを作成する
+    1列目は日時列で名前がないため、'timestamp'という名前を付ける
+    """
+    custom_headers = ['timestamp']
+
+    # 重複名のチェックと修正のための辞書
+    header_count = {}
+
+    for i in range(1, len(sensor_points)):
+        # センサー点番とセンサー名を組み合わせた列名を作成
+        header = f"{sensor_points[i]}_{sensor_names[i]}"
+        # 特殊文字を除去（パーティショニングに影響するため）
+        header = re.sub(r'[^\w]', '_', header)
+
+        # 重複名の処理: 同じヘッダー名が既に存在する場合、連番を付ける
+        if header in header_count:
+            header_count[header] += 1
+            header = f"{header}_{header_count[header]}"
+        else:
+            header_count[header] = 0
+
+        custom_headers.append(header)
+
+    # 連番を付けた結果、別の列名と重複する場合があるため完全に重複を排除する
+    if len(custom_headers) != len(set(custom_headers)):
+        print(f"警告: 重複するヘッダーが存在します: {[h for h in custom_headers if custom_headers.count(h) > 1]}")
+        unique_headers = []
+        header_count = {}
+
+        for h in custom_headers:
+            if h in header_count:
+                header_count[h] += 1
+                unique_headers.append(f"{h}_{header_count[h]}")
+            else:
+                header_count[h] = 0
+                unique_headers.append(h)
+
+        custom_headers = unique_headers
+
+    return custom_headers
+
+
+def clear_header_cache():
+    """ヘッダーキャッシュを消去する"""
+    _HEADER_CACHE.clear()
+
+
+def _decode_header(header_bytes, encodings):
+    """候補のエンコーディングを順に試してヘッダーをデコードする"""
+    last_error = None
+    for enc in encodings:
+        try:
+            text = header_bytes.decode(enc)
+        except (UnicodeDecodeError, LookupError) as e:
+            last_error = e
+            continue
+
+        # UTF-8のBOMを除去
+        if text.startswith('\ufeff'):
+            text = text[1:]
+            if enc.replace('-', '').replace('_', '').lower() == 'utf8':
+                enc = 'utf-8-sig'
+        return enc, text
+
+    raise UnicodeDecodeError(
+        'sniff', header_bytes, 0, len(header_bytes),
+        f"ヘッダーをデコードできませんでした（試行: {encodings}）: {last_error}"
+    )
+
+
+def _detect_delimiter(text):
+    """ヘッダーの内容から区切り文字を推定する"""
+    try:
+        return csv.Sniffer().sniff(text, delimiters=',\t;').delimiter
+    except csv.Error:
+        return ','
+
+
+def _header_value(cell):
+    """
+    ヘッダーのセルを pd.read_csv(nrows=1) と同じ型に変換する
+    （空欄はNaN、数値のみのセルは数値）。列名を以前の読み込み方法と一致させるため
+    """
+    value = cell.strip()
+    if value == '':
+        return float('nan')
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return cell
+
+
+def arrow_column_types(custom_headers):
+    """ヘッダーから明示的な列の型を作成する（日時列は文字列、センサー列はfloat64）"""
+    column_types = {name: pa.float64() for name in custom_headers[1:]}
+    column_types[custom_headers[0]] = pa.string()
+    return column_types
+
+
+def read_csv_arrow(source, header, engine='pyarrow', streaming=False, block_size=None, chunk_rows=None, prefetch_blocks=0):
+    """
+    3行ヘッダーCSVのデータ部分をpandasを経由せずにArrowテーブルとして読み込む
+
+    センサー列はヘッダーから決めたfloat64型で直接パースされ、数値に
+    変換できない値は欠損値になる（pd.to_numeric(errors='coerce')と同じ結果）。
+
+    Parameters:
+    -----------
+    source : str or tuple
+        CSVファイルのパス、または (ZIPファイルのパス, メンバー名) のタプル
+    header : dict
+        sniff_csv_header()の戻り値
+    engine : str, optional
+        'pyarrow' または 'polars'
+    streaming : bool, optional
+        Trueの場合はファイル全体を読み込まず、ブロックごとにテーブルを返す
+    block_size : int, optional
+        pyarrowで読み込む場合の1ブロックのバイト数（既定はCSV_BLOCK_SIZE）
+    chunk_rows : int, optional
+        Polarsでストリーミングする場合の1テーブルの行数
+    prefetch_blocks : int, optional
+        ZIP内のファイルを別のスレッドで先行して展開するブロック数（0の場合は先行しない）
+
+    Yields:
+    -------
+    pyarrow.Table
+        timestamp列（文字列）とセンサー列（float64）を持つテーブル
+    """
+    if engine == 'polars':
+        if isinstance(source, tuple):
+            # Polarsはストリームを全てメモリに読み込むため、ZIP内のファイルはpyarrowで読み込む
+            pass
+        elif header['encoding'].replace('-', '').lower() in ('utf8', 'utf8sig'):
+            yield from _read_csv_polars(source, header, streaming, chunk_rows)
+            return
+        else:
+            # PolarsはUTF-8しか読めないため、それ以外はpyarrowで読み込む
+            print(f"Polarsは{header['encoding']}に対応していないため、pyarrowで読み込みます: {source_name(source)}")
+    elif engine != 'pyarrow':
+        raise ValueError(f"未対応のエンジンです: {engine}")
+
+    yield from _read_csv_pyarrow(source, header, streaming, block_size, prefetch_blocks)
+
+
+@contextmanager
+def _arrow_input(source, header, prefetch_blocks=0):
+    """
+    pyarrowのCSVリーダーに渡す入力と読み飛ばす行数を返す
+    通常のファイルはパスのまま渡し（ネイティブのI/O）、ZIP内のファイルは
+    ヘッダーの直後から展開しながら読むストリームを渡す
+    """
+    if isinstance(source, tuple):
+        with open_data_stream(source, header, prefetch_blocks) as f:
+            yield f, 0
+    elif isinstance(source, pa.Buffer):
+        # メモリ上のデータ行（read_csv_range）
+        yield pa.BufferReader(source), 0
+    else:
+        yield source, HEADER_ROWS
+
+
+def _read_csv_pyarrow(source, header, streaming, block_size=None, prefetch_blocks=0):
+    """pyarrowのマルチスレッドCSVリーダーで読み込む"""
+    custom_headers = header['custom_headers']
+    parse_options = pv.ParseOptions(delimiter=header['delimiter'])
+    typed_options = pv.ConvertOptions(
+        column_types=arrow_column_types(custom_headers),
+        null_values=NULL_VALUES,
+        strings_can_be_null=True
+    )
+
+    def read_options(skip_rows, skip_rows_after_names=0):
+        return pv.ReadOptions(
+            skip_rows=skip_rows,
+            skip_rows_after_names=skip_rows_after_names,
+            column_names=custom_headers,
+            encoding=header['encoding'],
+            block_size=block_size or CSV_BLOCK_SIZE,
+            use_threads=True
+        )
+
+    rows_read = 0
+    try:
+        with _arrow_input(source, header, prefetch_blocks) as (input_file, skip_rows):
+            if streaming:
+                reader = pv.open_csv(input_file, read_options=read_options(skip_rows), parse_options=parse_options,
+                                     convert_options=typed_options)
+                for batch in reader:
+                    rows_read += batch.num_rows
+                    yield pa.Table.from_batches([batch])
+            else:
+                yield pv.read_csv(input_file, read_options=read_options(skip_rows), parse_options=parse_options,
+                                  convert_options=typed_options)
+        return
+    except pa.ArrowInvalid as e:
+        # 数値に変換できない値があった場合は、読み込めた行の続きから
+        # センサー列を文字列として読み直し、変換できない値を欠損値にする
+        print(f"数値に変換できない値があるため、文字列として読み直します: {e}")
+
+    string_options = pv.ConvertOptions(
+        column_types={name: pa.string() for name in custom_headers},
+        null_values=NULL_VALUES,
+        strings_can_be_null=True
+    )
+    with _arrow_input(source, header, prefetch_blocks) as (input_file, skip_rows):
+        if streaming:
+            reader = pv.open_csv(input_file, read_options=read_options(skip_rows, rows_read),
+                                 parse_options=parse_options, convert_options=string_options)
+            tables = (pa.Table.from_batches([batch]) for batch in reader)
+        else:
+            tables = [pv.read_csv(input_file, read_options=read_options(skip_rows), parse_options=parse_options,
+                                  convert_options=string_options)]
+
+        for table in tables:
+            yield _coerce_numeric_columns(table)
+
+
+def scan_csv_ranges(data, start=0, range_bytes=CSV_BLOCK_SIZE):
+    """
+    メモリマップしたファイルのstart以降を、改行の直後で区切ったバイト範囲に分け、行数を数える
+
+    ファイル全体を1回だけ走査し（改行の数を数える）、各範囲は独立にCSVとして解析できる
+    （センサーCSVは値に改行を含まないため、改行の直後は必ず行の先頭になる）。
+
+    Parameters:
+    -----------
+    data : pyarrow.Buffer
+        ファイル全体のバッファ（pyarrow.memory_mapで開いたファイルのread_buffer()。
+        コピーせずにメモリマップを参照する）
+    start : int, optional
+        データの先頭のバイト位置（3行ヘッダーのCSVではheader['header_size']）
+    range_bytes : int, optional
+        1つの範囲の目安のバイト数（範囲は次の改行まで延ばす）
+
+    Returns:
+    --------
+    dict
+        rows: 行数（最後の行が改行で終わらない場合も1行と数える）
+        ranges: (開始位置, 終了位置) のリスト（ファイル内の順）
+        size: start以降のバイト数
+    """
+    size = data.size
+    if size <= start:
+        return {'rows': 0, 'ranges': [], 'size': 0}
+
+    data = np.frombuffer(data, dtype=np.uint8, offset=start)
+    rows = 0
+    for offset in range(0, len(data), _SCAN_BLOCK_SIZE):
+        rows += int(np.count_nonzero(data[offset:offset + _SCAN_BLOCK_SIZE] == 0x0A))
+    if data[-1] != 0x0A:
+        rows += 1
+
+    ranges = []
+    begin = 0
+    range_bytes = max(int(range_bytes), 1)
+    while begin < len(data):
+        end = _next_line_start(data, begin + range_bytes)
+        ranges.append((start + begin, start + end))
+        begin = end
+    return {'rows': rows, 'ranges': ranges, 'size': size - start}
+
+
+def _next_line_start(data, pos):
+    """pos-1以降で最初の改行の直後の位置（改行がない場合はデータの末尾）"""
+    pos = max(pos - 1, 0)
+    while pos < len(data):
+        found = np.flatnonzero(data[pos:pos + _NEWLINE_SEARCH_SIZE] == 0x0A)
+        if len(found):
+            return pos + int(found[0]) + 1
+        pos += _NEWLINE_SEARCH_SIZE
+    return len(data)
+
+
+def read_csv_range(data, header, begin, end):
+    """
+    scan_csv_rangesで求めたバイト範囲をpyarrowでArrowテーブルとして読み込む
+    （メモリマップからコピーせずに解析する。列の型はread_csv_arrowと同じ）
+    """
+    return list(_read_csv_pyarrow(data.slice(begin, end - begin), header, streaming=False))[0]
+
+
+def _read_csv_polars(csv_path, header, streaming, chunk_rows=None):
+    """PolarsのマルチスレッドCSVリーダーで読み込み、Arrowテーブルとして返す"""
+    import polars as pl
+
+    custom_headers = header['custom_headers']
+    schema_overrides = {name: pl.Float64 for name in custom_headers[1:]}
+    schema_overrides[custom_headers[0]] = pl.String
+
+    lazy_df = pl.scan_csv(
+        csv_path,
+        has_header=False,
+        skip_rows=HEADER_ROWS,
+        separator=header['delimiter'],
+        new_columns=custom_headers,
+        schema_overrides=schema_overrides,
+        null_values=NULL_VALUES,
+        ignore_errors=True,  # 数値に変換できない値は欠損値にする
+        encoding='utf8'
+    )
+
+    frames = lazy_df.collect_batches(chunk_size=chunk_rows) if streaming else [lazy_df.collect()]
+    for df in frames:
+        table = df.to_arrow()
+        # Polarsの文字列型（large_string/string_view）を通常の文字列型にそろえる
+        yield table.set_column(0, custom_headers[0], table.column(0).cast(pa.string()))
+
+
+def _coerce_numeric_columns(table):
+    """文字列として読み込んだセンサー列をfloat64に変換する（変換できない値は欠損値）"""
+    columns = [table.column(0)]
+    for column in table.columns[1:]:
+        is_numeric = pc.match_substring_regex(column, _NUMERIC_PATTERN)
+        columns.append(pc.if_else(is_numeric, pc.utf8_trim_whitespace(column), None).cast(pa.float64()))
+    return pa.Table.from_arrays(columns, names=table.column_names)
+
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+# 間引きの方法
+DOWNSAMPLE_METHODS = ('minmax', 'lttb')
+
+# LTTBの前処理で、出力点数の何倍の区間に分けて最小・最大の点を選ぶか
+LTTB_PRESELECT_RATIO = 2
+
+
+def lttb_indices(x, y, n_out):
+    """
+    LTTB（Largest-Triangle-Three-Buckets）で残す点の位置を返す
+
+    最初と最後の点は必ず残し、その間をn_out - 2個の区間に分け、各区間で
+    前に選んだ点と次の区間の平均点とで作る三角形の面積が最大の点を選ぶ。
+
+    Parameters:
+    -----------
+    x : numpy.ndarray
+        点のx座標（昇順。時刻は数値に変換して渡す）
+    y : numpy.ndarray
+        点のy座標
+    n_out : int
+        残す点の数
+
+    Returns:
+    --------
+    numpy.ndarray
+        残す点の位置（昇順）
+    """
+    n = len(x)
+    if n <= n_out:
+        return np.arange(n)
+    if n_out < 3:
+        raise ValueError(f"n_outは3以上を指定してください: {n_out}")
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # 最初と最後の点を除いた区間の境界
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_lo, next_hi = edges[i + 1], edges[i + 2]
+        else:
+            next_lo, next_hi = n - 1, n
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def lttb(frame, n_out):
+    """
+    sensor, timestamp, value の点をセンサーごとにLTTBでn_out点以下に間引く
+    （点はsensor・timestamp順に並んでいること）
+    """
+    parts = []
+    for _, points in frame.groupby('sensor', sort=False):
+        x = points['timestamp'].to_numpy(dtype='datetime64[us]').astype(np.int64)
+        parts.append(points.iloc[lttb_indices(x, points['value'].to_numpy(), n_out)])
+    if not parts:
+        return frame
+    return pd.concat(parts, ignore_index=True)
+
+
+def minmax_points(buckets):
+    """
+    区間ごとの最小・最大の点（sensor, min_ts, min, max_ts, max）を
+    時刻順の (sensor, timestamp, value) の点に展開する
+    （最小と最大が同じ点の場合は1点にする。ロールアップから求めた点は時刻が
+    同じで値の異なる2点になることがある）
+    """
+    points = pd.concat([
+        buckets[['sensor', 'min_ts', 'min']].set_axis(['sensor', 'timestamp', 'value'], axis=1),
+        buckets[['sensor', 'max_ts', 'max']].set_axis(['sensor', 'timestamp', 'value'], axis=1),
+    ], ignore_index=True)
+    points = points.drop_duplicates(['sensor', 'timestamp', 'value'])
+    return points.sort_values(['sensor', 'timestamp'], kind='stable').reset_index(drop=True)
+
+
+def to_plot_series(points, names=None, colors=None):
+    """
+    間引いた点をフロントエンドのMultiLinePlotに渡すseriesの形式に変換する
+    （[{id, name, color, data: [{date, value}, ...]}, ...]）
+
+    Parameters:
+    -----------
+    points : pandas.DataFrame
+        sensor, timestamp, value の列を持つ点
+    names : dict, optional
+        センサー -> 表示名
+    colors : dict, optional
+        センサー -> 線の色
+    """
+    names = names or {}
+    colors = colors or {}
+    series = []
+    for sensor, group in points.groupby('sensor', sort=False):
+        item = {
+            'id': str(sensor),
+            'name': names.get(sensor, str(sensor)),
+            'data': [
+                {'date': date, 'value': value}
+                for date, value in zip(group['timestamp'].dt.strftime('%Y-%m-%dT%H:%M:%S').tolist(), group['value'].tolist())
+            ],
+        }
+        if sensor in colors:
+            item['color'] = colors[sensor]
+        series.append(item)
+    return series
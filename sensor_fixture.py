@@ -0,0 +1,258 @@
+import argparse
+import io
+import os
+import time
+import zipfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+
+# 日時列の形式の名前 -> strftimeの形式（名前の代わりに形式を直接指定することもできる）
+DATE_FORMAT_ALIASES = {
+    'slash': '%Y/%m/%d %H:%M:%S',         # 2024/11/21 0:00:00
+    'iso': '%Y-%m-%d %H:%M:%S',           # 2024-11-21 0:00:00
+    'kanji': '%Y年%m月%d日 %H時%M分%S秒',  # 2024年11月21日 0時00分00秒
+}
+
+# センサーの種類と単位（列ごとに順に割り当てる）
+SENSOR_KINDS = [
+    ('温度', '℃'), ('圧力', 'MPa'), ('流量', 'm3/h'), ('振動', 'mm/s'), ('電流', 'A'), ('回転数', 'rpm')
+]
+
+# 値の刻みの数（0を中心に±この数の刻みの範囲でランダムウォークさせる）
+VALUE_LEVELS = 50000
+
+# 1ブロックの目安のバイト数（ブロックごとにArrowで組み立てて書き込む）
+BLOCK_BYTES = 32 * 1024 * 1024
+
+# 時の0埋めを外す位置の目印（strftimeの結果から0埋めを除去する）
+_HOUR_MARK = '\x01'
+
+
+def generate_sensor_csv(path, rows=100000, columns=10, interval='1s', start='2024-11-21 00:00:00',
+                        nan_ratio=0.0, duplicate_columns=0, date_format='slash', pad_hour=False,
+                        encoding='utf-8', decimals=2, line_terminator='\n', seed=0, members=1,
+                        compresslevel=1):
+    """
+    3行ヘッダー（センサー点番、センサー名、単位）のセンサーCSVを生成する
+
+    ベンチマークや動作確認を実データなしで行うためのもの。同じ引数とseedからは
+    同じバイト列を生成する。値は列ごとのランダムウォークで、あらかじめ文字列にした
+    刻みの辞書を参照して書き込み、日時は日付と時刻の文字列を組み合わせて作るため、
+    数GBのファイルも短時間で生成できる。
+
+    Parameters:
+    -----------
+    path : str
+        出力先（拡張子が.zipの場合はZIPの中にCSVを作成する）
+    rows : int, optional
+        データ行数
+    columns : int, optional
+        センサー列数（日時列を除く）
+    interval : str or float, optional
+        サンプリング間隔（'1s'・'100ms'・'1min'などの文字列、または秒数）
+    start : str, optional
+        最初の行の日時
+    nan_ratio : float, optional
+        欠損値（空欄）の割合
+    duplicate_columns : int, optional
+        前の列とセンサー点番・センサー名が重複する列数（末尾の列を重複させる）
+    date_format : str, optional
+        日時の形式（DATE_FORMAT_ALIASESの名前、またはstrftimeの形式）
+    pad_hour : bool, optional
+        時を0埋めするかどうか（Falseの場合は 0:00:00 のように出力する）
+    encoding : str, optional
+        エンコーディング（'utf-8'、'shift-jis'、'cp932'など）
+    decimals : int, optional
+        値の小数点以下の桁数
+    line_terminator : str, optional
+        改行文字（'\\n' または '\\r\\n'）
+    seed : int, optional
+        乱数のシード
+    members : int, optional
+        ZIPの場合に行を分けて格納するCSVの数（連続する期間ごとに分ける）
+    compresslevel : int, optional
+        ZIPの圧縮レベル（既定は生成を速くするため1。ロガーのZIPに近づける場合は6）
+
+    Returns:
+    --------
+    dict
+        path, members, rows, columns, bytes（CSVのバイト数の合計）, seconds, mb_per_second
+    """
+    started = time.perf_counter()
+    if duplicate_columns >= columns:
+        raise ValueError(f"重複させる列数（{duplicate_columns}）は列数（{columns}）より小さくしてください")
+    fmt = DATE_FORMAT_ALIASES.get(date_format, date_format)
+    step = _interval_us(interval)
+    start_us = pd.Timestamp(start).value // 1000
+    header = _header_bytes(columns, duplicate_columns, encoding, line_terminator)
+    block_rows = max(1000, BLOCK_BYTES // _row_bytes_estimate(fmt, columns, decimals))
+
+    rng = np.random.default_rng(seed)
+    dictionary = _value_dictionary(decimals)
+    # 列ごとのランダムウォークの現在位置（ブロックをまたいで引き継ぐ）
+    levels = rng.integers(VALUE_LEVELS // 2, VALUE_LEVELS * 3 // 2, size=columns)
+    formatter = _TimestampFormatter(fmt, step, pad_hour)
+    options = pv.WriteOptions(include_header=False, quoting_style='none', eol=line_terminator, null_string='')
+    transcode = not fmt.isascii() and encoding.replace('-', '').replace('_', '').lower() not in ('utf8', 'utf8sig')
+
+    def write_rows(f, first_row, n_rows):
+        total = len(header)
+        f.write(header)
+        for offset in range(0, n_rows, block_rows):
+            n = min(block_rows, n_rows - offset)
+            timestamps = start_us + (first_row + offset + np.arange(n, dtype=np.int64)) * step
+            arrays = [formatter.format(timestamps)]
+            for i in range(columns):
+                walk = np.cumsum(rng.integers(-3, 4, size=n, dtype=np.int8), dtype=np.int32) + levels[i]
+                walk = np.clip(walk, 0, len(dictionary) - 1)
+                levels[i] = walk[-1]
+                mask = rng.random(n, dtype=np.float32) < nan_ratio if nan_ratio > 0 else None
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(walk, mask=mask), dictionary))
+            sink = io.BytesIO()
+            pv.write_csv(pa.Table.from_arrays(arrays, names=[str(i) for i in range(len(arrays))]), sink, options)
+            block = sink.getvalue()
+            if transcode:
+                block = block.decode('utf-8').encode(encoding)
+            f.write(block)
+            total += len(block)
+        return total
+
+    written = 0
+    if path.lower().endswith('.zip'):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        names = [f"{stem}.csv"] if members <= 1 else [f"{stem}_{i + 1:03d}.csv" for i in range(members)]
+        bounds = np.linspace(0, rows, len(names) + 1).astype(np.int64)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zip_ref:
+            for name, first_row, last_row in zip(names, bounds[:-1], bounds[1:]):
+                with zip_ref.open(name, 'w', force_zip64=True) as f:
+                    written += write_rows(f, int(first_row), int(last_row - first_row))
+    else:
+        names = [os.path.basename(path)]
+        with open(path, 'wb') as f:
+            written += write_rows(f, 0, rows)
+
+    seconds = time.perf_counter() - started
+    return {
+        'path': path,
+        'members': names,
+        'rows': rows,
+        'columns': columns,
+        'bytes': written,
+        'seconds': round(seconds, 3),
+        'mb_per_second': round(written / 1024 / 1024 / seconds, 1) if seconds > 0 else None
+    }
+
+
+def sensor_header_rows(columns, duplicate_columns=0):
+    """ヘッダー3行（センサー点番、センサー名、単位）のセルのリストを返す（1列目は日時列で空欄）"""
+    points, names, units = [''], [''], ['']
+    for i in range(columns):
+        # 末尾のduplicate_columns列は、前の列と同じセンサー点番・センサー名にする
+        source = i - (columns - duplicate_columns) if i >= columns - duplicate_columns else i
+        kind, unit = SENSOR_KINDS[source % len(SENSOR_KINDS)]
+        points.append(f"TAG{source + 1:05d}")
+        names.append(f"{kind}{source // len(SENSOR_KINDS) + 1}")
+        units.append(unit)
+    return [points, names, units]
+
+
+def _header_bytes(columns, duplicate_columns, encoding, line_terminator):
+    rows = sensor_header_rows(columns, duplicate_columns)
+    return ''.join(','.join(row) + line_terminator for row in rows).encode(encoding)
+
+
+def _interval_us(interval):
+    """サンプリング間隔をマイクロ秒にする"""
+    if isinstance(interval, (int, float)):
+        step = int(round(interval * 1_000_000))
+    else:
+        step = pd.Timedelta(interval).value // 1000
+    if step <= 0:
+        raise ValueError(f"サンプリング間隔は正の値を指定してください: {interval}")
+    return step
+
+
+def _value_dictionary(decimals):
+    """値の刻みを文字列にした辞書（-VALUE_LEVELS〜VALUE_LEVELSの刻み × 10^-decimals）"""
+    values = np.arange(-VALUE_LEVELS, VALUE_LEVELS) / 10 ** decimals
+    return pa.array([f"{value:.{decimals}f}" for value in values], pa.string())
+
+
+def _row_bytes_estimate(fmt, columns, decimals):
+    return len(fmt) + 8 + columns * (decimals + 5)
+
+
+class _TimestampFormatter:
+    """
+    連続する日時（マイクロ秒）をstrftimeの形式の文字列にする
+
+    間隔が秒の倍数で、形式が日付・時刻の順の場合は、日付の文字列（ブロック内の日数分）と
+    時刻の文字列（1日分を最初に作成）を組み合わせる（行ごとにstrftimeするより大幅に速い）。
+    """
+
+    def __init__(self, fmt, step, pad_hour):
+        self.pad_hour = pad_hour
+        hour = '%H' if pad_hour else _HOUR_MARK + '%H'
+        self.fmt = fmt.replace('%H', hour)
+        split = self.fmt.find(hour)
+        date_part, time_part = (self.fmt[:split], self.fmt[split:]) if split >= 0 else (self.fmt, '')
+        self.fast = (
+            step % 1_000_000 == 0 and split >= 0
+            and not any(d in date_part for d in ('%H', '%M', '%S', '%I', '%p'))
+            and not any(d in time_part for d in ('%Y', '%y', '%m', '%d', '%b', '%B', '%j', '%a', '%A', '%e'))
+        )
+        if self.fast:
+            self.date_part = date_part
+            seconds = pa.array(np.arange(86400).astype('datetime64[s]'))
+            self.times = self._strip_hour_mark(pc.strftime(seconds, format=time_part))
+        self.unit = 's' if step % 1_000_000 == 0 else 'ms' if step % 1000 == 0 else 'us'
+
+    def format(self, timestamps):
+        if not self.fast:
+            values = pa.array(timestamps.astype('datetime64[us]').astype(f'datetime64[{self.unit}]'))
+            return self._strip_hour_mark(pc.strftime(values, format=self.fmt))
+        seconds = timestamps // 1_000_000
+        days = seconds // 86400
+        unique_days, day_index = np.unique(days, return_inverse=True)
+        dates = pc.strftime(pa.array((unique_days * 86400).astype('datetime64[s]')), format=self.date_part)
+        return pc.binary_join_element_wise(
+            pc.take(dates, pa.array(day_index)), pc.take(self.times, pa.array(seconds - days * 86400)), ''
+        )
+
+    def _strip_hour_mark(self, strings):
+        if self.pad_hour:
+            return strings
+        return pc.replace_substring_regex(strings, pattern=_HOUR_MARK + '0?', replacement='')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='3行ヘッダーのセンサーCSV・ZIPを生成する（ベンチマーク・動作確認用）')
+    parser.add_argument('path', help='出力先（.zipの場合はZIPの中にCSVを作成する）')
+    parser.add_argument('--rows', type=int, default=100000, help='データ行数')
+    parser.add_argument('--columns', type=int, default=10, help='センサー列数')
+    parser.add_argument('--interval', default='1s', help="サンプリング間隔（'1s'・'100ms'・'1min'など）")
+    parser.add_argument('--start', default='2024-11-21 00:00:00', help='最初の行の日時')
+    parser.add_argument('--nan-ratio', type=float, default=0.0, help='欠損値（空欄）の割合')
+    parser.add_argument('--duplicate-columns', type=int, default=0, help='センサー点番・センサー名が重複する列数')
+    parser.add_argument('--date-format', default='slash', help=f"日時の形式（{', '.join(DATE_FORMAT_ALIASES)}、またはstrftimeの形式）")
+    parser.add_argument('--pad-hour', action='store_true', help='時を0埋めする（00:00:00）')
+    parser.add_argument('--encoding', default='utf-8', help='エンコーディング（utf-8, shift-jis, cp932）')
+    parser.add_argument('--decimals', type=int, default=2, help='値の小数点以下の桁数')
+    parser.add_argument('--crlf', action='store_true', help='改行をCRLFにする')
+    parser.add_argument('--seed', type=int, default=0, help='乱数のシード')
+    parser.add_argument('--members', type=int, default=1, help='ZIPの場合に格納するCSVの数')
+    parser.add_argument('--compresslevel', type=int, default=1, help='ZIPの圧縮レベル（1〜9）')
+    args = parser.parse_args()
+
+    stats = generate_sensor_csv(
+        args.path, rows=args.rows, columns=args.columns, interval=args.interval, start=args.start,
+        nan_ratio=args.nan_ratio, duplicate_columns=args.duplicate_columns, date_format=args.date_format,
+        pad_hour=args.pad_hour, encoding=args.encoding, decimals=args.decimals,
+        line_terminator='\r\n' if args.crlf else '\n', seed=args.seed, members=args.members,
+        compresslevel=args.compresslevel
+    )
+    print(f"生成しました: {stats['path']}（{stats['rows']}行 × {stats['columns']}列、"
+          f"{stats['bytes'] / 1024 / 1024:.1f} MB、{stats['seconds']}秒、{stats['mb_per_second']} MB/秒）")
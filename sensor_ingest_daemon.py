@@ -0,0 +1,445 @@
+import argparse
+import ctypes
+import ctypes.util
+import importlib.util
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import zipfile
+from datetime import datetime
+from parquet_dataset import compact_dataset
+from sensor_csv import list_zip_csv_members
+
+# 取り込み先の変換スクリプト
+TARGETS = {
+    'converter': 'csv-to-parquet-converter.py',
+    'conversion': 'csv-to-parquet-conversion.py',
+}
+
+# 取り込みの状態（取り込みの遅れなど）を書き出すファイル（データセットのルートに置く）
+INGEST_STATUS_FILE = '_ingest_status.json'
+
+# 取り込み対象の拡張子
+SOURCE_EXTENSIONS = ('.csv', '.zip')
+
+# inotifyで監視するイベント（書き込み終了・移動・作成・変更・削除）
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+_IN_EVENT = struct.Struct('iIII')
+
+# 取り込み遅れの統計に使う直近のファイル数
+_LAG_HISTORY = 1000
+
+
+class IngestDaemon:
+    """
+    監視フォルダに届いたCSV・ZIPファイルを継続的にデータセットへ取り込む常駐プロセス
+
+    フォルダの変更はinotify（Linux）で検知し、使えない環境ではpoll_intervalごとに
+    フォルダを走査する。ファイルはサイズと更新時刻がsettle_seconds変わらなくなった
+    時点で書き込み完了とみなす（ZIPは中央ディレクトリが読めることも確認する）。
+    書き込みが完了したファイルはbatch_windowの間まとめてから、1回の変換で取り込む
+    （マニフェスト・サマリー・メタデータの更新はバッチごとに1回）。取り込みで
+    パーティションに増えた小さなファイルは、compact_intervalごとに変更のあった
+    パーティションだけまとめる。
+
+    取り込みの遅れ（ファイルの最終更新からデータセットに反映されるまでの秒数）と
+    待機中のファイル数はstatus()で取得でき、バッチごとにデータセットの
+    _ingest_status.json にも書き出す。
+
+    Parameters:
+    -----------
+    source_dir : str
+        監視するディレクトリ（ロガーがファイルを置くディレクトリ）
+    output_dir : str
+        出力ディレクトリ
+    dataset_name : str, optional
+        データセットの名前（target='converter'の場合）
+    target : str, optional
+        'converter'はcsv-to-parquet-converter.pyの統合データセットに、
+        'conversion'はcsv-to-parquet-conversion.pyの機械別のデータセット
+        （output_dir直下のmachine=/year=/month=）に取り込む
+    settle_seconds : float, optional
+        書き込み完了とみなすまでにサイズと更新時刻が変わらない時間（秒）
+    batch_window : float, optional
+        最初のファイルの書き込みが完了してから、同じバッチにまとめるために待つ最大の時間（秒）。
+        書き込み中のファイルがなければ待たずに取り込む
+    poll_interval : float, optional
+        フォルダを走査する間隔（inotifyを使えない場合）と、書き込み完了を確認する間隔（秒）
+    compact_interval : float, optional
+        パーティションのファイルをまとめる間隔（秒）。Noneの場合はまとめない
+    use_inotify : bool, optional
+        Falseの場合はinotifyを使わず、常にフォルダを走査する
+    name_patterns : list, optional
+        ファイル名に含まれるべき文字列パターンのリスト
+    **convert_options
+        変換関数に渡す引数（target='converter'ではconvert_csvs_to_parquetの
+        engine, storage_schema, layout, memory_budgetなど、'conversion'ではstorage_schema）
+    """
+
+    def __init__(self, source_dir, output_dir, dataset_name='sensor_data', target='converter', settle_seconds=5.0,
+                 batch_window=10.0, poll_interval=1.0, compact_interval=600.0, use_inotify=True, name_patterns=None,
+                 **convert_options):
+        if target not in TARGETS:
+            raise ValueError(f"未対応の取り込み先です: {target}")
+
+        self.source_dir = source_dir
+        self.output_dir = output_dir
+        self.dataset_name = dataset_name
+        self.target = target
+        self.settle_seconds = settle_seconds
+        self.batch_window = batch_window
+        self.poll_interval = poll_interval
+        self.compact_interval = compact_interval
+        self.name_patterns = name_patterns
+        self.convert_options = convert_options
+        self.dataset_path = os.path.join(output_dir, dataset_name) if target == 'converter' else output_dir
+
+        self._module = _load_script(TARGETS[target])
+        self._watcher = None
+        if use_inotify:
+            try:
+                self._watcher = _Inotify(source_dir)
+            except (OSError, AttributeError) as e:
+                print(f"inotifyを使えないため、{poll_interval}秒ごとにフォルダを走査します: {e}")
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # ファイル名 -> 書き込み中のファイルの状態 {'size', 'mtime', 'stable_since'}
+        self._pending = {}
+        # ファイル名 -> 書き込みが完了したファイルの (サイズ, 最終更新時刻)
+        self._ready = {}
+        # ファイル名 -> 取り込んだ時点の (サイズ, 最終更新時刻)（変更のないファイルは取り込み直さない）
+        self._ingested = {}
+        # ファイル名 -> 取り込む対象のCSVがなかった時点の (サイズ, 最終更新時刻)（変更がなければ確認し直さない）
+        self._skipped = {}
+        self._ready_since = None
+        self._last_compaction = time.time()
+        self._lags = []
+        self.stats = {
+            'batches': 0,
+            'files_ingested': 0,
+            'errors': 0,
+            'last_batch_at': None,
+            'last_batch_seconds': None,
+        }
+
+    def serve_forever(self):
+        print(f"{self.source_dir} の監視を開始しました（{'inotify' if self._watcher else 'ポーリング'}）")
+        self._scan()
+        while not self._stop.is_set():
+            self._wait()
+            self._check_settled()
+            if self._batch_due():
+                self.ingest_ready()
+            if self.compact_interval is not None and time.time() - self._last_compaction >= self.compact_interval:
+                self.compact()
+
+    def start(self):
+        """バックグラウンドのスレッドで監視を開始する"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        """監視を停止する（取り込み中のバッチは最後まで取り込む）"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._watcher is not None:
+            self._watcher.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        return False
+
+    def status(self):
+        """取り込みの状態（待機中のファイル数と取り込みの遅れ）"""
+        with self._lock:
+            now = time.time()
+            arrivals = [state['mtime'] for state in self._pending.values() if state['mtime'] is not None]
+            arrivals += [mtime for _, mtime in self._ready.values()]
+            lags = list(self._lags)
+        return {
+            **self.stats,
+            'pending_files': len(arrivals),
+            # 最も古い未取り込みのファイルの待ち時間
+            'oldest_pending_seconds': round(now - min(arrivals), 3) if arrivals else 0.0,
+            'last_lag_seconds': lags[-1] if lags else None,
+            'avg_lag_seconds': round(sum(lags) / len(lags), 3) if lags else None,
+            'max_lag_seconds': max(lags) if lags else None,
+        }
+
+    def ingest_ready(self):
+        """書き込みが完了したファイルを1回の変換で取り込む"""
+        with self._lock:
+            batch = dict(self._ready)
+            self._ready.clear()
+            self._ready_since = None
+        if not batch:
+            return
+
+        paths = [os.path.join(self.source_dir, name) for name in sorted(batch)]
+        started = time.time()
+        try:
+            result = self._ingest(paths)
+        except Exception as e:
+            # 取り込めなかったファイルは、書き込み完了の確認からやり直す
+            print(f"エラー: {len(paths)}ファイルの取り込みに失敗しました - {e}")
+            self.stats['errors'] += 1
+            with self._lock:
+                for name in batch:
+                    self._pending[name] = {'size': None, 'mtime': None, 'stable_since': time.time()}
+            return
+
+        # 取り込めなかったファイルは書き込み完了の確認からやり直し、対象のCSVがなかったファイルは
+        # 取り込み済みにも遅れの統計にも含めない
+        failed = {os.path.basename(path) for path in result['failed']}
+        skipped = {os.path.basename(path) for path in result['skipped']} - failed
+        ingested = {name: state for name, state in batch.items() if name not in failed and name not in skipped}
+        if failed:
+            print(f"エラー: {len(failed)}ファイルの取り込みに失敗しました（再度取り込みます） - {', '.join(sorted(failed))}")
+            self.stats['errors'] += len(failed)
+
+        finished = time.time()
+        with self._lock:
+            for name in failed:
+                self._pending[name] = {'size': None, 'mtime': None, 'stable_since': time.time()}
+            self._skipped.update((name, batch[name]) for name in skipped)
+            self._ingested.update(ingested)
+            self._lags.extend(round(finished - mtime, 3) for _, mtime in ingested.values())
+            del self._lags[:-_LAG_HISTORY]
+        self.stats['batches'] += 1
+        self.stats['files_ingested'] += len(ingested)
+        self.stats['last_batch_at'] = datetime.now().isoformat()
+        self.stats['last_batch_seconds'] = round(finished - started, 3)
+        status = self.status()
+        if ingested:
+            print(f"{len(ingested)}ファイルを取り込みました（{status['last_batch_seconds']}秒、"
+                  f"最大の遅れ {max(finished - mtime for _, mtime in ingested.values()):.1f}秒）")
+        _save_status(self.dataset_path, status)
+
+    def compact(self):
+        """取り込みで増えた小さなファイルを、変更のあったパーティションごとにまとめる"""
+        self._last_compaction = time.time()
+        try:
+            if self.target == 'converter':
+                compact_dataset(self.dataset_path, target_file_mb=128, sort_by='timestamp')
+            else:
+                self._module.compact(self.output_dir)
+        except Exception as e:
+            print(f"エラー: パーティションをまとめられませんでした - {e}")
+            self.stats['errors'] += 1
+
+    def _ingest(self, paths):
+        """
+        ファイルを取り込み、{'failed': 取り込みに失敗したパス, 'skipped': 対象のCSVがなかったパス} を返す
+        （ZIPは1つでもメンバーの取り込みに失敗した場合に失敗とする）
+        """
+        if self.target == 'converter':
+            result = self._module.convert_csvs_to_parquet(
+                self.source_dir, self.output_dir, self.dataset_name, name_patterns=self.name_patterns,
+                sources=paths, **self.convert_options
+            )
+            return {'failed': result['failed'], 'skipped': result['skipped']}
+
+        # 機械別のデータセット（ZIPはメンバーごとに取り込む）
+        manifest = self._module.IngestManifest(os.path.join(self.output_dir, "_ingest_manifest.json"))
+        storage_schema = self.convert_options.get('storage_schema')
+        failed = []
+        skipped = []
+        for path in paths:
+            members = list_zip_csv_members(path) if path.lower().endswith('.zip') else [None]
+            matched = False
+            for member in members:
+                name = os.path.basename(member or path)
+                if self.name_patterns and not any(pattern in name for pattern in self.name_patterns):
+                    continue
+                matched = True
+                # process_csvは例外を送出せず、失敗した場合はFalseを返す
+                if not self._module.process_csv((path, member) if member else path, self.output_dir, manifest,
+                                                storage_schema):
+                    if path not in failed:
+                        failed.append(path)
+            if not matched:
+                skipped.append(path)
+        manifest.save()
+        return {'failed': failed, 'skipped': skipped}
+
+    def _scan(self):
+        """フォルダを走査し、取り込み対象のファイルを書き込み完了の確認の対象にする"""
+        try:
+            names = os.listdir(self.source_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            self._touch(name)
+
+    def _touch(self, name):
+        if name.startswith('.') or not name.lower().endswith(SOURCE_EXTENSIONS):
+            return
+        if not name.lower().endswith('.zip') and self.name_patterns and not any(p in name for p in self.name_patterns):
+            return
+        with self._lock:
+            if name not in self._pending and name not in self._ready:
+                self._pending[name] = {'size': None, 'mtime': None, 'stable_since': time.time()}
+
+    def _wait(self):
+        """フォルダの変更（inotify）か、poll_intervalの経過を待つ"""
+        if self._watcher is None:
+            self._stop.wait(self.poll_interval)
+            self._scan()
+            return
+        for name in self._watcher.read(self.poll_interval):
+            self._touch(name)
+
+    def _check_settled(self):
+        """サイズと更新時刻がsettle_seconds変わらないファイルを書き込み完了とする"""
+        now = time.time()
+        with self._lock:
+            for name, state in list(self._pending.items()):
+                path = os.path.join(self.source_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self._pending[name]
+                    continue
+                if (stat.st_size, stat.st_mtime) in (self._ingested.get(name), self._skipped.get(name)):
+                    # 取り込み済み（または対象のCSVがなかった）で変更のないファイル
+                    del self._pending[name]
+                    continue
+                if (stat.st_size, stat.st_mtime) != (state['size'], state['mtime']):
+                    state.update(size=stat.st_size, mtime=stat.st_mtime, stable_since=now)
+                    continue
+                if now - state['stable_since'] < self.settle_seconds:
+                    continue
+                # ZIPは末尾の中央ディレクトリまで書き込まれていることを確認する
+                if name.lower().endswith('.zip') and not zipfile.is_zipfile(path):
+                    continue
+                del self._pending[name]
+                self._ready[name] = (stat.st_size, stat.st_mtime)
+                if self._ready_since is None:
+                    self._ready_since = now
+
+    def _batch_due(self):
+        """書き込み中のファイルがないか、batch_windowが経過した場合に取り込む"""
+        with self._lock:
+            if not self._ready:
+                return False
+            return not self._pending or time.time() - self._ready_since >= self.batch_window
+
+
+class _Inotify:
+    """inotify（Linux）でディレクトリ直下のファイルの変更を検知する"""
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1に失敗しました")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), _IN_WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watchに失敗しました: {path}")
+
+    def read(self, timeout):
+        """timeout秒まで変更を待ち、変更のあったファイル名を返す"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset + _IN_EVENT.size <= len(data):
+            _, _, _, length = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _load_script(file_name):
+    """ファイル名にハイフンを含む変換スクリプトをモジュールとして読み込む"""
+    module_name = os.path.splitext(file_name)[0].replace('-', '_')
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    # プロセスプールのワーカーに関数を渡せるように登録する
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _save_status(dataset_path, status):
+    os.makedirs(dataset_path, exist_ok=True)
+    path = os.path.join(dataset_path, INGEST_STATUS_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(status, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='監視フォルダに届いたCSV・ZIPファイルを継続的にデータセットへ取り込む')
+    parser.add_argument('source_dir', help='監視するディレクトリ')
+    parser.add_argument('output_dir', help='出力ディレクトリ')
+    parser.add_argument('--dataset-name', default='sensor_data', help='データセットの名前')
+    parser.add_argument('--target', default='converter', choices=sorted(TARGETS), help='取り込み先の変換スクリプト')
+    parser.add_argument('--settle', type=float, default=5.0, help='書き込み完了とみなすまでの秒数')
+    parser.add_argument('--batch-window', type=float, default=10.0, help='ファイルをまとめて取り込むために待つ最大の秒数')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='フォルダを確認する間隔（秒）')
+    parser.add_argument('--compact-interval', type=float, default=600.0, help='パーティションをまとめる間隔（秒、0でまとめない）')
+    parser.add_argument('--polling', action='store_true', help='inotifyを使わずにフォルダを走査する')
+    parser.add_argument('--engine', default='pyarrow', choices=['pandas', 'pyarrow', 'polars'], help='CSV読み込みエンジン')
+    parser.add_argument('--storage-schema', default='compact', help="保存用スキーマ（'none'で読み込んだ型のまま）")
+    parser.add_argument('--layout', default='wide', choices=['wide', 'long'], help='データセットのレイアウト')
+    parser.add_argument('--memory-budget', default=None, help="取り込みに使うメモリの予算（例: '2GB'）")
+    args = parser.parse_args()
+
+    storage_schema = None if args.storage_schema == 'none' else args.storage_schema
+    if args.target == 'converter':
+        options = dict(engine=args.engine, storage_schema=storage_schema, layout=args.layout,
+                       memory_budget=args.memory_budget)
+    else:
+        options = dict(storage_schema=storage_schema)
+
+    daemon = IngestDaemon(
+        args.source_dir,
+        args.output_dir,
+        dataset_name=args.dataset_name,
+        target=args.target,
+        settle_seconds=args.settle,
+        batch_window=args.batch_window,
+        poll_interval=args.poll_interval,
+        compact_interval=args.compact_interval or None,
+        use_inotify=not args.polling,
+        **options
+    )
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        daemon.shutdown()
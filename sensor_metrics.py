@@ -0,0 +1,229 @@
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import psutil
+
+# 取り込みで記録するステージ（記録した順に出力する。これ以外の名前も記録できる）
+# sniff: ヘッダーの判定とサイズの見積もり / read: CSVの解析 / timestamp: 日時の変換
+# numeric: 数値への変換 / arrow: Arrowテーブル・保存用スキーマへの変換
+# write: Parquetの書き込み / rollup: ロールアップの集計と書き込み
+STAGES = ('sniff', 'read', 'timestamp', 'numeric', 'arrow', 'write', 'rollup')
+
+# OpenMetricsのメトリクス名の接頭辞
+METRIC_PREFIX = 'sensor_ingest'
+
+# 記録したメトリクスを書き出す形式（拡張子から判定する）
+_OPENMETRICS_EXTENSIONS = ('.prom', '.om', '.txt')
+
+
+class FileTrace:
+    """
+    1つのファイルの取り込みのステージごとの処理時間・行数・バイト数とピークメモリを記録する
+
+    spanはパイプラインの各スレッドから同時に呼び出せる（ステージごとに合計する）。
+    ピークメモリは各spanの終了時にプロセスのRSSを確認して求める。
+
+    Parameters:
+    -----------
+    name : str
+        ファイル名（ZIP内のファイルはメンバー名）
+    host : str, optional
+        ホスト名（Noneの場合はこのマシンのホスト名）
+    """
+
+    def __init__(self, name, host=None):
+        self.name = name
+        self.host = host or socket.gethostname()
+        self.stages = {}
+        self.rows = 0
+        self.bytes = 0
+        self.output_bytes = 0
+        self.dropped_rows = 0
+        self.error = None
+        self._lock = threading.Lock()
+        self._process = psutil.Process()
+        self._rss_start = self._process.memory_info().rss
+        self._rss_peak = self._rss_start
+        self._started_at = datetime.now().isoformat()
+        self._started = time.perf_counter()
+        self._elapsed = None
+
+    @contextmanager
+    def span(self, stage, rows=0, nbytes=0):
+        """
+        stageの処理時間を記録する（with文のブロックの処理時間）
+        行数・バイト数は引数か、返すdictの'rows'・'bytes'に設定する
+        """
+        counts = {'rows': rows, 'bytes': nbytes}
+        started = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.add(stage, time.perf_counter() - started, counts['rows'], counts['bytes'])
+
+    def add(self, stage, seconds, rows=0, nbytes=0):
+        """stageの処理時間を加算する（spanを使わずに計測した場合）"""
+        rss = self._process.memory_info().rss
+        with self._lock:
+            stats = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0, 'bytes': 0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['rows'] += int(rows or 0)
+            stats['bytes'] += int(nbytes or 0)
+            self._rss_peak = max(self._rss_peak, rss)
+
+    def drop(self, rows):
+        """取り込まずに除外した行数を加算する（タイムスタンプを変換できない行など）"""
+        with self._lock:
+            self.dropped_rows += int(rows)
+
+    def finish(self, rows=None, nbytes=None, output_bytes=None, error=None):
+        """ファイルの取り込みの終了を記録する"""
+        if rows is not None:
+            self.rows = int(rows)
+        if nbytes is not None:
+            self.bytes = int(nbytes)
+        if output_bytes is not None:
+            self.output_bytes = int(output_bytes)
+        if error is not None:
+            self.error = str(error)
+        self._elapsed = time.perf_counter() - self._started
+        self._rss_peak = max(self._rss_peak, self._process.memory_info().rss)
+        return self
+
+    def to_dict(self):
+        """記録をdictで返す（プロセスプールの結果として返せる）"""
+        elapsed = self._elapsed if self._elapsed is not None else time.perf_counter() - self._started
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        return {
+            'host': self.host,
+            'pid': os.getpid(),
+            'file': self.name,
+            'started_at': self._started_at,
+            'seconds': round(elapsed, 6),
+            'rows': self.rows,
+            'dropped_rows': self.dropped_rows,
+            'bytes': self.bytes,
+            'output_bytes': self.output_bytes,
+            'mb_per_second': round(self.bytes / 1024 / 1024 / elapsed, 3) if elapsed > 0 else None,
+            'peak_rss': self._rss_peak,
+            'rss_growth': self._rss_peak - self._rss_start,
+            'error': self.error,
+            'stages': {
+                stage: dict(stats, seconds=round(stats['seconds'], 6), max_seconds=round(stats['max_seconds'], 6))
+                for stage, stats in sorted(self.stages.items(), key=lambda item: order.get(item[0], len(order)))
+            }
+        }
+
+
+class MetricsRecorder:
+    """
+    ファイルごとの取り込みの記録（FileTrace.to_dict()）を集め、JSON Lines または
+    OpenMetricsのテキスト形式で書き出す
+
+    プロセスプールのワーカーで記録したものは、結果として受け取ってaddで追加する。
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        """記録を追加する（FileTraceまたはそのto_dict()）"""
+        if record is None:
+            return
+        if isinstance(record, FileTrace):
+            record = record.to_dict()
+        with self._lock:
+            self.records.append(record)
+
+    def extend(self, records):
+        for record in records or []:
+            self.add(record)
+
+    def summary(self):
+        """ステージごとの合計（全ファイル）"""
+        stages = {}
+        for record in self.records:
+            for stage, stats in record['stages'].items():
+                total = stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0})
+                for key in total:
+                    total[key] += stats[key]
+        return stages
+
+    def write(self, path, format=None):
+        """
+        記録を書き出す
+
+        Parameters:
+        -----------
+        path : str
+            出力先のファイル
+        format : str, optional
+            'jsonl'（1ファイル1行のJSON。既存のファイルに追記する）または
+            'openmetrics'（ホスト・ステージごとの値。ファイルを置き換える）。
+            Noneの場合は拡張子から判定する（.prom/.om/.txtはOpenMetrics）
+        """
+        if format is None:
+            format = 'openmetrics' if path.lower().endswith(_OPENMETRICS_EXTENSIONS) else 'jsonl'
+        if format == 'jsonl':
+            with open(path, 'a', encoding='utf-8') as f:
+                for record in self.records:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        elif format == 'openmetrics':
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.to_openmetrics())
+            os.replace(tmp_path, path)
+        else:
+            raise ValueError(f"未対応のメトリクスの形式です: {format}")
+        return path
+
+    def to_openmetrics(self):
+        """OpenMetricsのテキスト形式（ホスト・ステージごとの合計と、ファイルごとの値）"""
+        families = {}
+
+        def sample(name, help_text, labels, value):
+            family = families.setdefault(name, (help_text, []))
+            label_text = ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels.items())
+            family[1].append(f"{METRIC_PREFIX}_{name}{{{label_text}}} {value}")
+
+        hosts = {}
+        for record in self.records:
+            hosts.setdefault(record['host'], []).append(record)
+        for host, records in hosts.items():
+            sample('files', '取り込んだファイル数', {'host': host}, len(records))
+            sample('errors', '取り込みに失敗したファイル数', {'host': host}, sum(1 for r in records if r['error']))
+            sample('rows', '取り込んだ行数', {'host': host}, sum(r['rows'] for r in records))
+            sample('dropped_rows', '除外した行数', {'host': host}, sum(r['dropped_rows'] for r in records))
+            sample('bytes', '読み込んだCSVのバイト数', {'host': host}, sum(r['bytes'] for r in records))
+            stages = {}
+            for record in records:
+                for stage, stats in record['stages'].items():
+                    total = stages.setdefault(stage, [0, 0.0])
+                    total[0] += stats['calls']
+                    total[1] += stats['seconds']
+            for stage, (calls, seconds) in stages.items():
+                sample('stage_calls', 'ステージの呼び出し回数', {'host': host, 'stage': stage}, calls)
+                sample('stage_seconds', 'ステージの処理時間の合計（秒）', {'host': host, 'stage': stage}, round(seconds, 6))
+            for record in records:
+                labels = {'host': host, 'file': record['file']}
+                sample('file_seconds', 'ファイルの取り込み時間（秒）', labels, record['seconds'])
+                sample('file_peak_rss_bytes', 'ファイルの取り込み中のピークRSS（バイト）', labels, record['peak_rss'])
+
+        lines = []
+        for name, (help_text, samples) in families.items():
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.extend(samples)
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,244 @@
+import io
+import queue
+import threading
+import time
+
+# パイプラインの既定の設定
+# queue_depth: ステージ間のキューに置けるチャンク数（メモリ使用量の上限になる）
+# convert_workers: 型変換のステージのスレッド数
+# prefetch_blocks: ZIPの展開を先行して行うブロック数（0の場合は先行しない）
+DEFAULT_PIPELINE = {'queue_depth': 2, 'convert_workers': 1, 'prefetch_blocks': 4}
+
+# ZIPの展開を先行して行う場合の1ブロックのバイト数
+PREFETCH_BLOCK_SIZE = 4 * 1024 * 1024
+
+# キューの待ち時間の上限（停止の確認間隔、秒）
+_POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+def resolve_pipeline(pipeline, engine='pyarrow'):
+    """
+    パイプラインの設定（Falseの場合はNone、dictの場合は既定値に上書きする）
+
+    pandasのCSVパーサーは解析中もGILを保持し、変換のスレッドと並行に動けないため、
+    engineが'pandas'の場合はpipelineを指定したときだけパイプラインを使う。
+    """
+    if pipeline is False or (pipeline is None and engine == 'pandas'):
+        return None
+    return {**DEFAULT_PIPELINE, **(pipeline or {})}
+
+
+def in_flight_chunks(pipeline):
+    """
+    パイプラインで同時に処理中になるチャンク数（読み込み・変換のスレッド数・書き込み）
+    チャンクの行数はこの数で予算を割って決め、キューで待つチャンクは予算の空きを待つ
+    """
+    return max(pipeline['convert_workers'], 1) + 2
+
+
+def run_pipeline(items, stages, sink, queue_depth=2, stats=None, stop=None):
+    """
+    チャンクを読み込み・変換・書き込みのステージに分けて並行に処理する
+
+    itemsのイテレーターは専用のスレッドで読み進め、各ステージは指定した数の
+    スレッドでキューからチャンクを受け取って処理し、次のキューに渡す。
+    sinkは呼び出し元のスレッドで、読み込んだ順に呼び出す（書き込みの順序を保つ）。
+    キューはqueue_depthまでしかチャンクを置けないため、後のステージが遅い場合は
+    前のステージが待つ（メモリ上のチャンク数が一定以下になる）。
+    いずれかのステージで例外が発生した場合は全てのステージを止め、その例外を送出する。
+
+    Parameters:
+    -----------
+    items : iterable
+        読み込むチャンク（読み込み自体をイテレーターの中で行う）
+    stages : list
+        (名前, 関数, スレッド数) のリスト。関数はチャンクを受け取り、変換したものを返す
+    sink : callable
+        変換したチャンクを受け取る関数（読み込んだ順に呼び出される）
+    queue_depth : int, optional
+        ステージ間のキューに置けるチャンク数
+    stats : dict, optional
+        ステージごとの処理時間（秒）を加算する（'read', 各ステージの名前, 'write'）
+    stop : threading.Event, optional
+        停止を伝えるEvent（例外が発生した場合に設定される。読み込みのイテレーターが
+        メモリの予算の空きを待つ場合などに、待つのをやめるために使う）
+
+    Returns:
+    --------
+    int
+        処理したチャンク数
+    """
+    stats = stats if stats is not None else {}
+    for name in ['read'] + [stage[0] for stage in stages] + ['write']:
+        stats.setdefault(name, 0.0)
+    stop = stop if stop is not None else threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=max(queue_depth, 1)) for _ in range(len(stages) + 1)]
+    threads = []
+    lock = threading.Lock()
+
+    def fail(e):
+        with lock:
+            errors.append(e)
+        stop.set()
+
+    def read():
+        try:
+            iterator = iter(items)
+            seq = 0
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                _add(stats, lock, 'read', time.perf_counter() - started)
+                if not _put(queues[0], (seq, item), stop):
+                    return
+                seq += 1
+        except Exception as e:
+            fail(e)
+            return
+        for _ in range(stages[0][2] if stages else 1):
+            _put(queues[0], _DONE, stop)
+
+    def work(index, name, func, remaining):
+        try:
+            while True:
+                item = _get(queues[index], stop)
+                if item is None:
+                    return
+                if item is _DONE:
+                    break
+                seq, value = item
+                started = time.perf_counter()
+                value = func(value)
+                _add(stats, lock, name, time.perf_counter() - started)
+                if not _put(queues[index + 1], (seq, value), stop):
+                    return
+        except Exception as e:
+            fail(e)
+            return
+        # ステージの最後のスレッドが終了したら、次のステージに終了を伝える
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            next_workers = stages[index + 1][2] if index + 1 < len(stages) else 1
+            for _ in range(next_workers):
+                _put(queues[index + 1], _DONE, stop)
+
+    threads.append(threading.Thread(target=read, name='pipeline-read', daemon=True))
+    for index, (name, func, workers) in enumerate(stages):
+        remaining = [max(workers, 1)]
+        for i in range(max(workers, 1)):
+            threads.append(threading.Thread(
+                target=work, args=(index, name, func, remaining), name=f"pipeline-{name}-{i}", daemon=True
+            ))
+    for thread in threads:
+        thread.start()
+
+    # 変換のステージを複数のスレッドで行うと順序が入れ替わるため、読み込んだ順に並べ直して渡す
+    buffered = {}
+    next_seq = 0
+    try:
+        while True:
+            item = _get(queues[-1], stop)
+            if item is None or item is _DONE:
+                break
+            buffered[item[0]] = item[1]
+            while next_seq in buffered:
+                started = time.perf_counter()
+                sink(buffered.pop(next_seq))
+                _add(stats, lock, 'write', time.perf_counter() - started)
+                next_seq += 1
+    except BaseException as e:
+        fail(e)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return next_seq
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            continue
+    return None
+
+
+def _add(stats, lock, name, seconds):
+    with lock:
+        stats[name] += seconds
+
+
+class ReadAheadReader(io.RawIOBase):
+    """
+    別のスレッドで元のストリームを先行して読み込むファイル風のオブジェクト
+    （ZIPの展開とCSVの解析を並行に行う。先行して読むのはblocks個のブロックまで）
+    """
+
+    def __init__(self, raw, block_size=PREFETCH_BLOCK_SIZE, blocks=4):
+        self.raw = raw
+        self.block_size = block_size
+        self._queue = queue.Queue(maxsize=max(blocks, 1))
+        self._stop = threading.Event()
+        self._buffer = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._stop.is_set():
+                block = self.raw.read(self.block_size)
+                if not _put(self._queue, block, self._stop) or not block:
+                    return
+        except Exception as e:
+            _put(self._queue, e, self._stop)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # 終端以外では要求されたバイト数を全て返す（短い読み込みを終端と扱う読み手のため）
+        view = memoryview(b).cast('B')
+        n = 0
+        while n < len(view):
+            if not self._buffer:
+                if self._eof:
+                    break
+                block = self._queue.get()
+                if isinstance(block, Exception):
+                    raise block
+                if not block:
+                    self._eof = True
+                    break
+                self._buffer = memoryview(block)
+            size = min(len(view) - n, len(self._buffer))
+            view[n:n + size] = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            n += size
+        return n
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        super().close()
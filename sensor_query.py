@@ -0,0 +1,558 @@
+import os
+import queue
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+from parquet_dataset import SUMMARY_INDEX_FILE, open_dataset
+from sensor_downsample import DOWNSAMPLE_METHODS, LTTB_PRESELECT_RATIO, lttb, minmax_points
+from sensor_rollup import ROLLUP_LEVELS, open_rollups
+
+# データセットの更新を検出するために監視するファイル
+VERSION_FILES = ('_ingest_manifest.json', SUMMARY_INDEX_FILE, '_compaction_state.json')
+
+# 集計の時間枠（細かい順）
+INTERVALS = ('hour', 'day', 'month', 'year')
+
+# 集計結果の列（sensor, bucket の後に続く列）
+AGGREGATE_COLUMNS = ('count', 'sum', 'min', 'max', 'first', 'last', 'avg')
+
+# ロールアップからの集計（部分集計をまとめ直す）
+ROLLUP_QUERY = """
+SELECT
+    sensor,
+    date_trunc('{interval}', bucket) AS bucket,
+    SUM("count")::BIGINT AS "count",
+    SUM("sum") AS "sum",
+    MIN("min") AS "min",
+    MAX("max") AS "max",
+    arg_min("first", first_ts) AS "first",
+    arg_max("last", last_ts) AS "last",
+    SUM("sum") / SUM("count") AS "avg"
+FROM {table}
+WHERE sensor IN ({sensors}){where}
+GROUP BY ALL
+ORDER BY sensor, bucket
+"""
+
+# 生データ（横持ち）からの集計（センサー列ごと）
+WIDE_QUERY = """
+SELECT
+    ? AS sensor,
+    date_trunc('{interval}', timestamp) AS bucket,
+    COUNT({column}) AS "count",
+    SUM({column}) AS "sum",
+    MIN({column}) AS "min",
+    MAX({column}) AS "max",
+    arg_min({column}, timestamp) FILTER (WHERE {column} IS NOT NULL) AS "first",
+    arg_max({column}, timestamp) FILTER (WHERE {column} IS NOT NULL) AS "last",
+    AVG({column}) AS "avg"
+FROM dataset
+WHERE {column} IS NOT NULL{where}
+GROUP BY ALL
+"""
+
+# 生データ（縦持ち）からの集計
+LONG_QUERY = """
+SELECT
+    sensor_id AS sensor,
+    date_trunc('{interval}', timestamp) AS bucket,
+    COUNT(value) AS "count",
+    SUM(value) AS "sum",
+    MIN(value) AS "min",
+    MAX(value) AS "max",
+    arg_min(value, timestamp) AS "first",
+    arg_max(value, timestamp) AS "last",
+    AVG(value) AS "avg"
+FROM dataset
+WHERE sensor_id IN ({sensors}) AND value IS NOT NULL{where}
+GROUP BY ALL
+ORDER BY sensor, bucket
+"""
+
+# 表示区間ごとの最小・最大の点（生データ・横持ち、センサー列ごと）
+MINMAX_WIDE_QUERY = """
+SELECT
+    ? AS sensor,
+    (epoch_us(timestamp) - ?) // ? AS px,
+    arg_min(timestamp, {column}) AS min_ts,
+    MIN({column}) AS "min",
+    arg_max(timestamp, {column}) AS max_ts,
+    MAX({column}) AS "max"
+FROM dataset
+WHERE {column} IS NOT NULL AND timestamp >= ? AND timestamp < ?
+GROUP BY ALL
+"""
+
+# 表示区間ごとの最小・最大の点（生データ・縦持ち）
+MINMAX_LONG_QUERY = """
+SELECT
+    sensor_id AS sensor,
+    (epoch_us(timestamp) - ?) // ? AS px,
+    arg_min(timestamp, value) AS min_ts,
+    MIN(value) AS "min",
+    arg_max(timestamp, value) AS max_ts,
+    MAX(value) AS "max"
+FROM dataset
+WHERE sensor_id IN ({sensors}) AND value IS NOT NULL AND timestamp >= ? AND timestamp < ?
+GROUP BY ALL
+ORDER BY sensor, px
+"""
+
+# 表示区間ごとの最小・最大の点（ロールアップ。点の時刻はロールアップの時間枠の開始時刻）
+MINMAX_ROLLUP_QUERY = """
+SELECT
+    sensor,
+    (epoch_us(bucket) - ?) // ? AS px,
+    arg_min(bucket, "min") AS min_ts,
+    MIN("min") AS "min",
+    arg_max(bucket, "max") AS max_ts,
+    MAX("max") AS "max"
+FROM {table}
+WHERE sensor IN ({sensors}) AND bucket >= ? AND bucket < ?
+GROUP BY ALL
+ORDER BY sensor, px
+"""
+
+# ロールアップの時間枠の長さ（マイクロ秒）
+ROLLUP_MICROS = {'day': 86400 * 10 ** 6, 'hour': 3600 * 10 ** 6}
+
+
+def quote_identifier(name):
+    """SQLの識別子（列名）として引用符で囲む"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def dataset_version(dataset_path):
+    """
+    データセットのバージョン（マニフェスト・サマリーファイルのサイズと更新時刻）
+    取り込みやcompactionでデータが変わるとバージョンも変わる
+    """
+    version = []
+    for file_name in VERSION_FILES:
+        path = os.path.join(dataset_path, file_name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            version.append((file_name, stat.st_size, stat.st_mtime_ns))
+    return tuple(version)
+
+
+class QueryCancelled(Exception):
+    """実行中のクエリがキャンセルされた"""
+
+
+class CancelToken:
+    """
+    実行中のクエリをキャンセルするためのトークン
+
+    QueryService.streamに渡すと、cancel()を別のスレッドから呼び出したときに
+    実行中のDuckDBのクエリを中断し、ストリームはQueryCancelledで終了する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._conn = None
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """クエリをキャンセルする（まだ実行していない場合は実行しない）"""
+        with self._lock:
+            self._cancelled = True
+            if self._conn is not None:
+                self._conn.interrupt()
+
+    def _attach(self, conn):
+        with self._lock:
+            if self._cancelled:
+                raise QueryCancelled()
+            self._conn = conn
+
+    def _detach(self):
+        with self._lock:
+            self._conn = None
+
+
+class QueryService:
+    """
+    データセットに対してクエリを実行する常駐型のサービス
+
+    DuckDBの接続をプールして使い回し、各接続にはデータセットを'dataset'、
+    ロールアップを'rollup_day' / 'rollup_hour'という名前で1回だけ登録する。クエリはパラメータをバインドして実行し、結果は
+    (SQL, パラメータ, データセットのバージョン) をキーにLRUでキャッシュする。
+    データセットのバージョンが変わった場合はキャッシュを消去し、登録を作り直す。
+
+    Parameters:
+    -----------
+    dataset_path : str
+        データセットのルートディレクトリ
+    pool_size : int, optional
+        プールする接続数（同時に実行できるクエリ数）
+    threads : int, optional
+        1つの接続でDuckDBが使うスレッド数
+    memory_limit : str, optional
+        1つの接続のメモリ上限（例: '2GB'）
+    cache_size : int, optional
+        キャッシュする結果の数（0でキャッシュしない）
+    """
+
+    def __init__(self, dataset_path, pool_size=4, threads=None, memory_limit=None, cache_size=256):
+        import duckdb
+
+        self.dataset_path = dataset_path
+        self.pool_size = pool_size
+        self.cache_size = cache_size
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._version = None
+        self._dataset = None
+        self._rollups = {}
+        # データセットを開き直した回数と、接続ごとに登録済みの回数
+        self._generation = 0
+        self._registered = {}
+
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            conn = duckdb.connect(':memory:')
+            if threads:
+                conn.execute(f"SET threads = {int(threads)}")
+            if memory_limit:
+                # SETには値をバインドできないため、書式を確認してから埋め込む
+                if not re.fullmatch(r'\d+(\.\d+)?\s*[KMGT]?i?B', str(memory_limit), re.IGNORECASE):
+                    raise ValueError(f"memory_limitの書式が正しくありません: {memory_limit}")
+                conn.execute(f"SET memory_limit = '{memory_limit}'")
+            conn.execute("SET enable_object_cache = true")
+            self._pool.put(conn)
+
+        self.stats = {'queries': 0, 'cache_hits': 0, 'refreshes': 0, 'routes': {}}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def query(self, sql, params=None, use_cache=True):
+        """
+        パラメータをバインドしてクエリを実行し、pandasのDataFrameを返す
+
+        Parameters:
+        -----------
+        sql : str
+            'dataset'を参照するSQL（値は?プレースホルダで指定する）
+        params : list, optional
+            プレースホルダにバインドする値
+        use_cache : bool, optional
+            結果のキャッシュを使うかどうか
+        """
+        params = list(params or [])
+        version = self._refresh()
+        key = (sql, tuple(params), version)
+
+        if use_cache and self.cache_size:
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+                    self.stats['cache_hits'] += 1
+                    return cached.copy()
+
+        with self.connection() as conn:
+            result = conn.execute(sql, params).fetchdf()
+
+        with self._lock:
+            self.stats['queries'] += 1
+            if use_cache and self.cache_size and version == self._version:
+                self._cache[key] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result.copy() if use_cache and self.cache_size else result
+
+    def stream(self, sql, params=None, batch_rows=65536, token=None):
+        """
+        クエリの結果をArrowのRecordBatchとして順に返すジェネレーター
+
+        最初に結果のスキーマを返し、続けてRecordBatchを返す。結果全体を
+        メモリに読み込まずに、batch_rows行ずつ返す（キャッシュは使わない）。
+        接続は最後のバッチを返すまでプールから借りたままになる。
+
+        Parameters:
+        -----------
+        sql : str
+            'dataset'を参照するSQL（値は?プレースホルダで指定する）
+        params : list, optional
+            プレースホルダにバインドする値
+        batch_rows : int, optional
+            1つのRecordBatchの最大行数
+        token : CancelToken, optional
+            キャンセル用のトークン。キャンセルされた場合はQueryCancelledを送出する
+        """
+        params = list(params or [])
+        token = token or CancelToken()
+        self._refresh()
+
+        with self.connection() as conn:
+            token._attach(conn)
+            try:
+                result = conn.execute(sql, params)
+                # DuckDBのバージョンによってメソッド名が異なる
+                to_reader = getattr(result, 'to_arrow_reader', None) or result.fetch_record_batch
+                reader = to_reader(batch_rows)
+                yield reader.schema
+                for batch in reader:
+                    if token.cancelled:
+                        raise QueryCancelled()
+                    yield batch
+            except QueryCancelled:
+                raise
+            except Exception:
+                # 中断された場合はDuckDB・Arrowの例外になるため、キャンセルとして扱う
+                if token.cancelled:
+                    raise QueryCancelled()
+                raise
+            finally:
+                token._detach()
+                with self._lock:
+                    self.stats['queries'] += 1
+
+    def aggregate(self, sensors, start=None, end=None, interval='hour', use_rollups=True):
+        """
+        センサーごと・時間枠ごとの集計（件数・合計・最小・最大・最初と最後の値・平均）
+
+        集計は要求を満たす最も粗いロールアップから求める。期間の境界が日の区切りに
+        揃っていて時間枠が日以上なら日別、時の区切りなら時間別のロールアップを使い、
+        どちらも使えない場合（ロールアップがない場合を含む）は生データから集計する。
+        件数は欠損値を除いた値の数である。
+
+        Parameters:
+        -----------
+        sensors : str or list
+            センサー（横持ちではセンサー列名、縦持ちではsensor_id）
+        start : datetime or str, optional
+            期間の開始（この時刻を含む）
+        end : datetime or str, optional
+            期間の終了（この時刻を含まない）
+        interval : str, optional
+            集計の時間枠（'hour' / 'day' / 'month' / 'year'）
+        use_rollups : bool, optional
+            Falseの場合は常に生データから集計する
+
+        Returns:
+        --------
+        pandas.DataFrame
+            sensor, bucket と集計値の列（sensor・bucket順）
+        """
+        if interval not in INTERVALS:
+            raise ValueError(f"未対応の時間枠です: {interval}")
+        sensors = [sensors] if isinstance(sensors, str) else list(sensors)
+        start = pd.Timestamp(start).to_pydatetime() if start is not None else None
+        end = pd.Timestamp(end).to_pydatetime() if end is not None else None
+        self._refresh()
+
+        where, range_params = '', []
+        if start is not None:
+            where += ' AND {ts} >= ?'
+            range_params.append(start)
+        if end is not None:
+            where += ' AND {ts} < ?'
+            range_params.append(end)
+
+        level = self.route(start, end, interval) if use_rollups else None
+        with self._lock:
+            routes = self.stats['routes']
+            routes[level or 'raw'] = routes.get(level or 'raw', 0) + 1
+        placeholders = ', '.join('?' for _ in sensors)
+
+        if level is not None:
+            sql = ROLLUP_QUERY.format(
+                interval=interval, table=f"rollup_{level}", sensors=placeholders, where=where.format(ts='bucket')
+            )
+            return self.query(sql, sensors + range_params)
+
+        if self._is_long():
+            sql = LONG_QUERY.format(interval=interval, sensors=placeholders, where=where.format(ts='timestamp'))
+            return self.query(sql, sensors + range_params)
+
+        parts, params = [], []
+        for sensor in sensors:
+            parts.append(WIDE_QUERY.format(
+                interval=interval, column=quote_identifier(sensor), where=where.format(ts='timestamp')
+            ))
+            params += [sensor] + range_params
+        return self.query("\nUNION ALL\n".join(parts) + "ORDER BY sensor, bucket", params)
+
+    def route(self, start=None, end=None, interval='hour'):
+        """集計に使えるロールアップの粒度（最も粗いもの）。使えない場合はNone"""
+        with self._lock:
+            available = set(self._rollups)
+        for level in ROLLUP_LEVELS:
+            if level not in available or INTERVALS.index(interval) < INTERVALS.index(level):
+                continue
+            if all(bound is None or _is_aligned(bound, level) for bound in (start, end)):
+                return level
+        return None
+
+    def downsample(self, sensors, start, end, width, method='minmax', use_rollups=True):
+        """
+        グラフの表示幅に合わせてセンサーの時系列を間引く
+
+        期間を表示幅（ピクセル数）の区間に分け、区間ごとの最小・最大の点を
+        クエリエンジンで求める（'minmax'）。'lttb'ではさらに区間を細かく分けて
+        最小・最大の点を選んだ後、LTTBでwidth点以下に間引く。点の数は
+        データ量によらず、センサーあたり最大でwidthの2倍（'minmax'）か
+        width（'lttb'）になる。1区間が1時間以上の場合は、要求を満たす最も粗い
+        ロールアップを使う（点の時刻はロールアップの時間枠の開始時刻になる）。
+
+        Parameters:
+        -----------
+        sensors : str or list
+            センサー（横持ちではセンサー列名、縦持ちではsensor_id）
+        start : datetime or str
+            表示する期間の開始（この時刻を含む）
+        end : datetime or str
+            表示する期間の終了（この時刻を含まない）
+        width : int
+            グラフの表示幅（ピクセル数）
+        method : str, optional
+            'minmax'（区間ごとの最小・最大）または 'lttb'
+        use_rollups : bool, optional
+            Falseの場合は常に生データから求める
+
+        Returns:
+        --------
+        pandas.DataFrame
+            sensor, timestamp, value の列を持つ点（sensor・timestamp順）。
+            to_plot_seriesでMultiLinePlotのseriesに変換できる
+        """
+        if method not in DOWNSAMPLE_METHODS:
+            raise ValueError(f"未対応の間引き方法です: {method}")
+        sensors = [sensors] if isinstance(sensors, str) else list(sensors)
+        self._refresh()
+
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        n_buckets = max(int(width), 1) * (LTTB_PRESELECT_RATIO if method == 'lttb' else 1)
+        span = max((end - start).value // 1000, 1)
+        bucket_micros = max(-(-span // n_buckets), 1)
+        origin = start.value // 1000
+        bucket_params = [origin, bucket_micros]
+        range_params = [start.to_pydatetime(), end.to_pydatetime()]
+
+        level = None
+        if use_rollups:
+            with self._lock:
+                available = set(self._rollups)
+            level = next(
+                (level for level in ROLLUP_LEVELS if level in available and bucket_micros >= ROLLUP_MICROS[level]),
+                None
+            )
+        with self._lock:
+            routes = self.stats['routes']
+            routes[level or 'raw'] = routes.get(level or 'raw', 0) + 1
+
+        placeholders = ', '.join('?' for _ in sensors)
+        if level is not None:
+            sql = MINMAX_ROLLUP_QUERY.format(table=f"rollup_{level}", sensors=placeholders)
+            buckets = self.query(sql, bucket_params + sensors + range_params)
+        elif self._is_long():
+            sql = MINMAX_LONG_QUERY.format(sensors=placeholders)
+            buckets = self.query(sql, bucket_params + sensors + range_params)
+        else:
+            parts, params = [], []
+            for sensor in sensors:
+                parts.append(MINMAX_WIDE_QUERY.format(column=quote_identifier(sensor)))
+                params += [sensor] + bucket_params + range_params
+            buckets = self.query("\nUNION ALL\n".join(parts) + "ORDER BY sensor, px", params)
+
+        points = minmax_points(buckets)
+        if method == 'lttb':
+            points = lttb(points, max(int(width), 3))
+        return points
+
+    def hourly(self, sensor_column, year, month):
+        """時間帯別の平均値"""
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+        result = self.aggregate(sensor_column, start, end, interval='hour')
+        bucket = result['bucket'].dt
+        return result.assign(
+            year=bucket.year, month=bucket.month, day=bucket.day, hour=bucket.hour
+        )[['year', 'month', 'day', 'hour', 'avg']].rename(columns={'avg': 'avg_value'})
+
+    def daily(self, sensor_column):
+        """日別の統計情報"""
+        result = self.aggregate(sensor_column, interval='day')
+        bucket = result['bucket'].dt
+        return result.assign(year=bucket.year, month=bucket.month, day=bucket.day)[
+            ['year', 'month', 'day', 'avg', 'min', 'max', 'count']
+        ].rename(columns={'avg': 'avg_value', 'min': 'min_value', 'max': 'max_value', 'count': 'data_points'})
+
+    @contextmanager
+    def connection(self):
+        """プールから接続を借りる（全て使用中の場合は空くまで待つ）"""
+        conn = self._pool.get()
+        try:
+            with self._lock:
+                generation, dataset, rollups = self._generation, self._dataset, self._rollups
+            # データセットの登録は開き直したときだけ作り直す
+            if self._registered.get(id(conn)) != generation:
+                conn.register('dataset', dataset)
+                for level in ROLLUP_LEVELS:
+                    if level in rollups:
+                        conn.register(f"rollup_{level}", rollups[level])
+                    else:
+                        conn.unregister(f"rollup_{level}")
+                self._registered[id(conn)] = generation
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def invalidate(self):
+        """キャッシュを消去し、次のクエリでデータセットを開き直す"""
+        with self._lock:
+            self._cache.clear()
+            self._version = None
+
+    def close(self):
+        """全ての接続を閉じる"""
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+        self._cache.clear()
+
+    def _refresh(self):
+        """データセットのバージョンを確認し、変わっていればキャッシュと登録を作り直す"""
+        version = dataset_version(self.dataset_path)
+        with self._lock:
+            if version == self._version and self._dataset is not None:
+                return version
+
+        dataset = open_dataset(self.dataset_path)
+        rollups = open_rollups(self.dataset_path)
+        with self._lock:
+            if version != self._version or self._dataset is None:
+                self._cache.clear()
+                self._version = version
+                self._dataset = dataset
+                self._rollups = rollups
+                self._generation += 1
+                self.stats['refreshes'] += 1
+            return self._version
+
+    def _is_long(self):
+        """データセットが縦持ち（sensor_id, timestamp, value）かどうか"""
+        with self._lock:
+            names = set(self._dataset.schema.names)
+        return {'sensor_id', 'value'} <= names
+
+
+def _is_aligned(bound, level):
+    """時刻がロールアップの時間枠の区切りに揃っているかどうか"""
+    if bound.minute or bound.second or bound.microsecond:
+        return False
+    return level == 'hour' or bound.hour == 0
@@ -0,0 +1,286 @@
+import os
+import shutil
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# ロールアップを保存するディレクトリ（_始まりのためデータセットの走査・サマリーからは除外される）
+ROLLUP_DIR = '_rollups'
+
+# ロールアップの粒度（粗い順）
+ROLLUP_LEVELS = ('day', 'hour')
+
+# ロールアップの列（センサー・時間枠ごとの件数・合計・最小・最大・最初と最後の値）
+ROLLUP_SCHEMA = pa.schema([
+    ('sensor', pa.string()),
+    ('bucket', pa.timestamp('us')),
+    ('count', pa.int64()),
+    ('sum', pa.float64()),
+    ('min', pa.float64()),
+    ('max', pa.float64()),
+    ('first', pa.float64()),
+    ('first_ts', pa.timestamp('us')),
+    ('last', pa.float64()),
+    ('last_ts', pa.timestamp('us')),
+])
+
+# 部分集計をまとめ直すまでに溜めておくチャンク数
+_MERGE_EVERY = 32
+
+
+class RollupAccumulator:
+    """
+    書き込むチャンクごとに時間別の部分集計を作り、ソースファイル単位の
+    ロールアップ（時間別・日別）をまとめるクラス
+
+    ロールアップはソースファイルごと・パーティションごとに
+    _rollups/<粒度>/year=/month=/<file_id>.parquet として保存する。
+    部分集計は件数・合計・最小・最大と最初・最後の値（とその時刻）を持つため、
+    複数のファイルや時間枠をまとめ直すことができる。
+    横持ちのテーブルはセンサー列を横持ちのまま時間枠で集計し、書き込むときに
+    (sensor, bucket) の行に展開する。
+
+    Parameters:
+    -----------
+    sensor_columns : list, optional
+        横持ちのテーブルのセンサー列の名前（ロールアップのsensorの値になる）。
+        Noneの場合は縦持ち（sensor_id, timestamp, value）のテーブルとして扱う
+    """
+
+    def __init__(self, sensor_columns=None):
+        self.sensor_columns = list(sensor_columns) if sensor_columns is not None else None
+        self._partials = []
+
+    def add(self, table):
+        """書き込むテーブル（保存用スキーマ適用後）の時間別の部分集計を追加する"""
+        if table.num_rows == 0:
+            return
+        if self.sensor_columns is None:
+            self._partials.append(_rollup_long(table))
+        else:
+            self._partials.append(_rollup_wide(table, self.sensor_columns))
+        if len(self._partials) >= _MERGE_EVERY:
+            self._partials = [self._merge()]
+
+    def write(self, dataset_path, file_id):
+        """
+        ロールアップを粒度・パーティションごとに書き込む
+
+        Returns:
+        --------
+        list
+            書き込んだファイルのデータセットからの相対パス
+        """
+        if not self._partials:
+            return []
+
+        hourly = self._merge()
+        if self.sensor_columns is None:
+            tables = {'hour': hourly, 'day': rollup_to(hourly, 'day')}
+        else:
+            n_columns = len(self.sensor_columns)
+            tables = {
+                'hour': _wide_to_long(hourly, self.sensor_columns),
+                'day': _wide_to_long(_wide_to_day(hourly, n_columns), self.sensor_columns),
+            }
+
+        written = []
+        for level in ROLLUP_LEVELS:
+            table = tables[level]
+            table = table.append_column('year', pc.year(table['bucket'])).append_column('month', pc.month(table['bucket']))
+            keys = table.select(['year', 'month']).group_by(['year', 'month']).aggregate([])
+            for row in keys.to_pylist():
+                mask = pc.and_(pc.equal(table['year'], row['year']), pc.equal(table['month'], row['month']))
+                rel = f"{ROLLUP_DIR}/{level}/year={row['year']}/month={row['month']}/{file_id}.parquet"
+                _write_rollup(os.path.join(dataset_path, rel), table.filter(mask).drop_columns(['year', 'month']))
+                written.append(rel)
+        return sorted(written)
+
+    def _merge(self):
+        table = pa.concat_tables(self._partials)
+        if self.sensor_columns is None:
+            return merge_rollups(table)
+        return _merge_wide(table, len(self.sensor_columns))
+
+
+def _rollup_long(table):
+    """
+    sensor_id・timestamp順に並んだ縦持ちのテーブルを時間別に集計する
+    （並び順を保ったまま集計するため、最初・最後の値は時刻の順になる）
+    """
+    timestamps = table['timestamp'].cast(pa.timestamp('us'))
+    table = pa.table({
+        'sensor': table['sensor_id'].cast(pa.string()),
+        'bucket': pc.floor_temporal(timestamps, unit='hour'),
+        'timestamp': timestamps,
+        'value': table['value'].cast(pa.float64()),
+    })
+    table = table.filter(pc.is_valid(table['value']))
+    result = table.group_by(['sensor', 'bucket'], use_threads=False).aggregate([
+        ('value', 'count'), ('value', 'sum'), ('value', 'min'), ('value', 'max'),
+        ('value', 'first'), ('timestamp', 'min'), ('value', 'last'), ('timestamp', 'max'),
+    ])
+    return result.rename_columns(['sensor', 'bucket'] + ROLLUP_SCHEMA.names[2:])
+
+
+def _rollup_wide(table, sensor_columns):
+    """
+    横持ちのテーブルをセンサー列ごとに時間別に集計する
+    （列 "<列番号>:<集計>" を持つ横持ちの部分集計を返す）
+    """
+    timestamps = table['timestamp'].cast(pa.timestamp('us'))
+    # 最初・最後の値を時刻の順に求めるため、並んでいない場合だけ並べ替える
+    if len(timestamps) > 1 and not pc.all(pc.greater_equal(timestamps[1:], timestamps[:-1])).as_py():
+        order = pc.sort_indices(timestamps)
+        table, timestamps = table.take(order), timestamps.take(order)
+
+    no_time = pa.scalar(None, pa.timestamp('us'))
+    columns = {'bucket': pc.floor_temporal(timestamps, unit='hour')}
+    aggregations = []
+    for i, name in enumerate(sensor_columns):
+        values = table[name].cast(pa.float64())
+        columns[f"{i}:value"] = values
+        columns[f"{i}:timestamp"] = pc.if_else(pc.is_valid(values), timestamps, no_time)
+        aggregations += [
+            (f"{i}:value", 'count'), (f"{i}:value", 'sum'), (f"{i}:value", 'min'), (f"{i}:value", 'max'),
+            (f"{i}:value", 'first'), (f"{i}:timestamp", 'min'), (f"{i}:value", 'last'), (f"{i}:timestamp", 'max'),
+        ]
+    result = pa.table(columns).group_by(['bucket'], use_threads=False).aggregate(aggregations)
+    return result.rename_columns(['bucket'] + _wide_names(len(sensor_columns)))
+
+
+def _wide_names(n_columns):
+    return [f"{i}:{stat}" for i in range(n_columns) for stat in ROLLUP_SCHEMA.names[2:]]
+
+
+def _merge_wide(table, n_columns):
+    """
+    横持ちの部分集計の同じ時間枠の行をまとめ、bucket順に並べる
+    （チャンクの境界をまたぐ時間枠だけが複数行になる）
+    """
+    table = table.sort_by([('bucket', 'ascending')])
+    buckets = table['bucket']
+    if len(buckets) < 2 or pc.all(pc.greater(buckets[1:], buckets[:-1])).as_py():
+        return table
+
+    counts = table.group_by(['bucket']).aggregate([('bucket', 'count')])
+    duplicated = counts.filter(pc.greater(counts['bucket_count'], 1))['bucket']
+    mask = pc.is_in(buckets, value_set=duplicated.combine_chunks())
+    single, multiple = table.filter(pc.invert(mask)), table.filter(mask)
+
+    aggregations = []
+    for i in range(n_columns):
+        aggregations += [
+            (f"{i}:count", 'sum'), (f"{i}:sum", 'sum'), (f"{i}:min", 'min'), (f"{i}:max", 'max'),
+            (f"{i}:first_ts", 'min'), (f"{i}:last_ts", 'max'),
+        ]
+    multiple = multiple.sort_by([('bucket', 'ascending')])
+    merged = multiple.group_by(['bucket'], use_threads=False).aggregate(aggregations)
+    columns = {name.rsplit('_', 1)[0]: merged[name] for name in merged.column_names[1:]}
+    # 最初・最後の値は、列ごとにその時刻の順に並べ直して取り出す
+    # （どちらもbucket順に並べ直すため、グループの順番は上の集計と一致する）
+    for i in range(n_columns):
+        for stat, ts in [('first', 'first_ts'), ('last', 'last_ts')]:
+            ordered = multiple.select(['bucket', f"{i}:{ts}", f"{i}:{stat}"]).sort_by(
+                [('bucket', 'ascending'), (f"{i}:{ts}", 'ascending')]
+            )
+            values = ordered.group_by(['bucket'], use_threads=False).aggregate([(f"{i}:{stat}", stat)])
+            columns[f"{i}:{stat}"] = values[f"{i}:{stat}_{stat}"]
+
+    columns = {'bucket': merged['bucket'], **{name: columns[name] for name in _wide_names(n_columns)}}
+    merged = pa.table(columns).cast(single.schema)
+    return pa.concat_tables([single, merged]).sort_by([('bucket', 'ascending')])
+
+
+def _wide_to_day(hourly, n_columns):
+    """
+    bucket順に並んだ横持ちの時間別の集計を日別にまとめる
+    （時間枠の順と時刻の順が一致するため、最初・最後の値は並び順で決まる）
+    """
+    table = hourly.set_column(0, 'bucket', pc.floor_temporal(hourly['bucket'], unit='day'))
+    aggregations = []
+    for i in range(n_columns):
+        aggregations += [
+            (f"{i}:count", 'sum'), (f"{i}:sum", 'sum'), (f"{i}:min", 'min'), (f"{i}:max", 'max'),
+            (f"{i}:first", 'first'), (f"{i}:first_ts", 'min'), (f"{i}:last", 'last'), (f"{i}:last_ts", 'max'),
+        ]
+    result = table.group_by(['bucket'], use_threads=False).aggregate(aggregations)
+    return result.rename_columns(['bucket'] + _wide_names(n_columns))
+
+
+def _wide_to_long(wide, sensor_columns):
+    """横持ちの集計を (sensor, bucket) の行に展開する（値のない時間枠は含めない）"""
+    parts = []
+    for i in sorted(range(len(sensor_columns)), key=lambda i: sensor_columns[i]):
+        part = wide.select(['bucket'] + [f"{i}:{stat}" for stat in ROLLUP_SCHEMA.names[2:]])
+        part = part.rename_columns(ROLLUP_SCHEMA.names[1:])
+        part = part.filter(pc.greater(part['count'], 0))
+        parts.append(part.add_column(0, 'sensor', pa.nulls(part.num_rows, pa.string()).fill_null(sensor_columns[i])))
+    return pa.concat_tables(parts).cast(ROLLUP_SCHEMA)
+
+
+def merge_rollups(table):
+    """
+    同じセンサー・時間枠の部分集計をまとめる
+    （件数・合計は足し、最初の値は最も早い時刻の、最後の値は最も遅い時刻の値を使う）
+    """
+    keys = ['sensor', 'bucket']
+    by_first = table.sort_by([(k, 'ascending') for k in keys] + [('first_ts', 'ascending')])
+    result = by_first.group_by(keys, use_threads=False).aggregate([
+        ('count', 'sum'), ('sum', 'sum'), ('min', 'min'), ('max', 'max'),
+        ('first', 'first'), ('first_ts', 'min'), ('last_ts', 'max'),
+    ])
+    # 同じキーの順に並べ直しているため、グループの順番は1回目の集計と一致する
+    by_last = table.sort_by([(k, 'ascending') for k in keys] + [('last_ts', 'ascending')])
+    last = by_last.group_by(keys, use_threads=False).aggregate([('last', 'last')])
+
+    result = result.rename_columns(keys + ['count', 'sum', 'min', 'max', 'first', 'first_ts', 'last_ts'])
+    result = result.add_column(result.schema.get_field_index('last_ts'), 'last', last['last_last'])
+    return result.select(ROLLUP_SCHEMA.names)
+
+
+def rollup_to(table, unit):
+    """部分集計をより粗い時間枠（'day'など）にまとめる"""
+    table = table.set_column(
+        table.schema.get_field_index('bucket'), 'bucket', pc.floor_temporal(table['bucket'], unit=unit)
+    )
+    return merge_rollups(table)
+
+
+def _write_rollup(path, table):
+    """sensor・bucket順に並べて書き込む（一時ファイルに書いてからリネームする）"""
+    table = table.sort_by([('sensor', 'ascending'), ('bucket', 'ascending')])
+    table = table.cast(ROLLUP_SCHEMA)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    pq.write_table(
+        table, tmp_path,
+        sorting_columns=pq.SortingColumn.from_ordering(ROLLUP_SCHEMA, [('sensor', 'ascending'), ('bucket', 'ascending')])
+    )
+    os.replace(tmp_path, path)
+
+
+def remove_rollups(dataset_path):
+    """データセットのロールアップを全て削除する（クエリは生データから集計される）"""
+    shutil.rmtree(os.path.join(dataset_path, ROLLUP_DIR), ignore_errors=True)
+
+
+def open_rollups(dataset_path):
+    """
+    粒度ごとのロールアップのpyarrowデータセットを開く
+
+    Returns:
+    --------
+    dict
+        粒度（'day' / 'hour'）-> pyarrow.dataset.Dataset（ロールアップがある粒度のみ）
+    """
+    rollups = {}
+    for level in ROLLUP_LEVELS:
+        level_dir = os.path.join(dataset_path, ROLLUP_DIR, level)
+        if not os.path.isdir(level_dir):
+            continue
+        dataset = ds.dataset(level_dir, format='parquet', partitioning='hive', schema=ROLLUP_SCHEMA)
+        if dataset.files:
+            rollups[level] = dataset
+    return rollups
@@ -0,0 +1,315 @@
+import argparse
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pyarrow as pa
+from sensor_query import CancelToken, QueryCancelled, QueryService
+
+# Arrow IPCストリームのContent-Type
+ARROW_STREAM_TYPE = 'application/vnd.apache.arrow.stream'
+
+
+class QueryServer:
+    """
+    データセットに対するクエリの結果をArrow IPCストリームで返すローカルHTTPサーバー
+
+    結果はRecordBatchごとに（チャンク転送で）順に送るため、クライアントは
+    大きな期間のデータを先頭から少しずつ受け取って描画できる。各バッチは
+    compressionで圧縮される。クエリはquery_idでキャンセルでき、同じchannelで
+    新しいクエリを送ると実行中のクエリはキャンセルされる（パン・ズームで
+    表示範囲が変わった場合など）。クライアントが接続を切った場合もキャンセルする。
+
+    エンドポイント（リクエストの本文はJSON）:
+        POST /query       {"sql", "params", "batch_rows", "query_id", "channel"}
+        POST /aggregate   QueryService.aggregateの引数 + "query_id", "channel"
+        POST /downsample  QueryService.downsampleの引数 + "query_id", "channel"
+        POST /cancel      {"query_id"} または {"channel"}
+        GET  /health
+
+    Parameters:
+    -----------
+    dataset_path : str
+        データセットのルートディレクトリ
+    host : str, optional
+        待ち受けるアドレス（既定ではローカルからの接続のみ）
+    port : int, optional
+        待ち受けるポート（0の場合は空いているポートを使う）
+    compression : str, optional
+        RecordBatchの圧縮（'zstd' / 'lz4' / None）
+    batch_rows : int, optional
+        1つのRecordBatchの既定の最大行数
+    pool_size : int, optional
+        QueryServiceの接続数（同時に実行できるクエリ数）
+    """
+
+    def __init__(self, dataset_path, host='127.0.0.1', port=8765, compression='zstd', batch_rows=65536,
+                 pool_size=4, **service_options):
+        if compression is not None and not pa.Codec.is_available(compression):
+            raise ValueError(f"未対応の圧縮形式です: {compression}")
+
+        self.service = QueryService(dataset_path, pool_size=pool_size, **service_options)
+        self.compression = compression
+        self.batch_rows = batch_rows
+
+        self._lock = threading.Lock()
+        # query_id -> CancelToken、channel -> query_id
+        self._running = {}
+        self._channels = {}
+
+        self.httpd = ThreadingHTTPServer((host, port), _QueryRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.query_server = self
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self):
+        print(f"クエリサーバーを起動しました: {self.address}")
+        self.httpd.serve_forever()
+
+    def start(self):
+        """バックグラウンドのスレッドでサーバーを起動する"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        """実行中のクエリを全てキャンセルしてサーバーを停止する"""
+        with self._lock:
+            tokens = list(self._running.values())
+        for token in tokens:
+            token.cancel()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.service.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        return False
+
+    def begin(self, query_id=None, channel=None):
+        """クエリを登録する（同じchannelで実行中のクエリはキャンセルする）"""
+        query_id = query_id or uuid.uuid4().hex
+        token = CancelToken()
+        with self._lock:
+            if query_id in self._running:
+                raise ValueError(f"query_idが重複しています: {query_id}")
+            previous = self._channels.get(channel) if channel else None
+            self._running[query_id] = token
+            if channel:
+                self._channels[channel] = query_id
+            superseded = self._running.get(previous)
+        if superseded is not None:
+            superseded.cancel()
+        return query_id, token
+
+    def end(self, query_id, channel=None):
+        with self._lock:
+            self._running.pop(query_id, None)
+            if channel and self._channels.get(channel) == query_id:
+                del self._channels[channel]
+
+    def cancel(self, query_id=None, channel=None):
+        """クエリをキャンセルする。キャンセルしたクエリがあればTrueを返す"""
+        with self._lock:
+            if query_id is None and channel:
+                query_id = self._channels.get(channel)
+            token = self._running.get(query_id)
+        if token is None:
+            return False
+        token.cancel()
+        return True
+
+
+class _QueryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_OPTIONS(self):
+        # ブラウザ（Next.jsの開発サーバーなど）からのCORSのプリフライト
+        self.send_response(204)
+        self._send_cors_headers()
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == '/health':
+            service = self.server.query_server.service
+            self._send_json(200, {'status': 'ok', 'dataset_path': service.dataset_path, 'stats': service.stats})
+        else:
+            self._send_json(404, {'error': f"見つかりません: {self.path}"})
+
+    def do_POST(self):
+        server = self.server.query_server
+        try:
+            body = self._read_json()
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        if self.path == '/cancel':
+            cancelled = server.cancel(body.get('query_id'), body.get('channel'))
+            self._send_json(200 if cancelled else 404, {'cancelled': cancelled})
+            return
+
+        if self.path == '/query':
+            if 'sql' not in body:
+                self._send_json(400, {'error': "sqlを指定してください"})
+                return
+            batch_rows = int(body.get('batch_rows') or server.batch_rows)
+            run = lambda token: server.service.stream(body['sql'], body.get('params'), batch_rows, token)
+        elif self.path in ('/aggregate', '/downsample'):
+            method = getattr(server.service, self.path[1:])
+            args = {k: v for k, v in body.items() if k not in ('query_id', 'channel')}
+            run = lambda token: _table_stream(method, args, token, server.batch_rows)
+        else:
+            self._send_json(404, {'error': f"見つかりません: {self.path}"})
+            return
+
+        channel = body.get('channel')
+        try:
+            query_id, token = server.begin(body.get('query_id'), channel)
+        except ValueError as e:
+            self._send_json(409, {'error': str(e)})
+            return
+        try:
+            self._stream(run(token), query_id, token)
+        finally:
+            server.end(query_id, channel)
+
+    def _stream(self, batches, query_id, token):
+        """結果のスキーマを受け取ってからレスポンスを開始し、バッチごとに送る"""
+        server = self.server.query_server
+        try:
+            schema = next(batches)
+        except QueryCancelled:
+            self._send_json(409, {'error': 'キャンセルされました', 'query_id': query_id})
+            return
+        except Exception as e:
+            self._send_json(400, {'error': str(e), 'query_id': query_id})
+            return
+
+        self.send_response(200)
+        self._send_cors_headers()
+        self.send_header('Content-Type', ARROW_STREAM_TYPE)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('X-Query-Id', query_id)
+        self.end_headers()
+
+        sink = _ChunkedWriter(self.wfile)
+        writer = pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression=server.compression))
+        try:
+            for batch in batches:
+                writer.write_batch(batch)
+                sink.flush()
+            # ストリームの終端と終端のチャンクは、全ての結果を送った場合だけ送る
+            writer.close()
+            sink.finish()
+        except Exception as e:
+            # 終端を送らずに接続を閉じ、結果が途中で終わったことをクライアントに伝える
+            # （クライアントの読み込みはエラーになる）
+            if not isinstance(e, (QueryCancelled, BrokenPipeError, ConnectionResetError)):
+                self.log_error("クエリの送信中にエラーが発生しました: %s", e)
+            token.cancel()
+            sink.abort()
+            batches.close()
+            self.close_connection = True
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValueError(f"リクエストの本文がJSONではありません: {e}")
+        if not isinstance(body, dict):
+            raise ValueError("リクエストの本文はJSONのオブジェクトで指定してください")
+        return body
+
+    def _send_json(self, status, data):
+        payload = json.dumps(data, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(status)
+        self._send_cors_headers()
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_cors_headers(self):
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'X-Query-Id')
+
+
+class _ChunkedWriter:
+    """HTTPのチャンク転送で書き込むファイル風のオブジェクト（Arrow IPCの出力先）"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.closed = False
+        self.aborted = False
+
+    def write(self, data):
+        data = bytes(data)
+        if data and not self.aborted:
+            self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def finish(self):
+        """終端のチャンクを送る"""
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def abort(self):
+        """以降の書き込みを捨てる（送信を途中で打ち切る）"""
+        self.aborted = True
+
+    def close(self):
+        self.closed = True
+
+
+def _table_stream(method, args, token, batch_rows):
+    """DataFrameを返すQueryServiceのメソッドの結果を、streamと同じ形式で返す"""
+    if token.cancelled:
+        raise QueryCancelled()
+    table = pa.Table.from_pandas(method(**args), preserve_index=False)
+    yield table.schema
+    for batch in table.to_batches(max_chunksize=batch_rows):
+        if token.cancelled:
+            raise QueryCancelled()
+        yield batch
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='データセットのクエリ結果をArrow IPCストリームで返すローカルサーバー')
+    parser.add_argument('dataset_path', help='データセットのルートディレクトリ')
+    parser.add_argument('--host', default='127.0.0.1', help='待ち受けるアドレス')
+    parser.add_argument('--port', type=int, default=8765, help='待ち受けるポート')
+    parser.add_argument('--compression', default='zstd', choices=['zstd', 'lz4', 'none'], help='RecordBatchの圧縮')
+    parser.add_argument('--batch-rows', type=int, default=65536, help='1つのRecordBatchの最大行数')
+    parser.add_argument('--pool-size', type=int, default=4, help='同時に実行できるクエリ数')
+    args = parser.parse_args()
+
+    server = QueryServer(
+        args.dataset_path,
+        host=args.host,
+        port=args.port,
+        compression=None if args.compression == 'none' else args.compression,
+        batch_rows=args.batch_rows,
+        pool_size=args.pool_size
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,258 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# タイムスタンプ列の日付フォーマットの候補
+DATE_FORMATS = [
+    '%Y/%m/%d %H:%M:%S',  # 2024/11/21 0:00:00
+    '%Y/%m/%d %H:%M',     # 2024/11/21 0:00
+    '%Y/%m/%d',           # 2024/11/21
+    '%Y-%m-%d %H:%M:%S',  # 2024-11-21 00:00:00
+    '%Y-%m-%d %H:%M',     # 2024-11-21 00:00
+    '%Y-%m-%d',           # 2024-11-21
+    '%Y年%m月%d日 %H時%M分%S秒',
+    '%Y年%m月%d日 %H時%M分',
+    '%Y年%m月%d日',
+    '%m/%d/%Y %H:%M:%S',  # 米国形式
+    '%d/%m/%Y %H:%M:%S'   # 欧州形式
+]
+
+# 年月日の順に並んだ日本のロガーの形式を固定レイアウトとして解析する
+# strptimeで扱えない小数秒（2024/11/21 0:00:00.5）や、列内で区切り文字が
+# 混在する場合（2024/11/21 と 2024年11月21日）に使用する
+FAST_LAYOUT = 'fast:ymd'
+_FAST_PATTERN = (
+    r'^\s*(?P<y>\d{4})[/\-年](?P<m>\d{1,2})[/\-月](?P<d>\d{1,2})日?'
+    r'(?:[ T]+(?P<H>\d{1,2})[:時](?P<M>\d{1,2})'
+    r'(?:(?::|分)(?P<S>\d{1,2})(?:\.(?P<f>\d{1,6}))?秒?)?分?)?\s*$'
+)
+
+# フォーマット判定に使うサンプル数
+SAMPLE_SIZE = 5
+
+# ヘッダーのフィンガープリント -> 判定済みのフォーマット
+# 同じロガー系列のファイルでは判定を省略する
+_FORMAT_CACHE = {}
+
+
+def parse_timestamps_arrow(column, fingerprint=None, date_format=None):
+    """
+    文字列の日時列をtimestamp[us]型のArrow配列に変換する
+
+    date_formatが指定されていない場合はサンプルからフォーマットを判定し、
+    結果をヘッダーのフィンガープリントごとに記憶する。変換はArrowのstrptime
+    カーネル（0埋めなしの月・日・時にも対応）で列全体を一括で行い、
+    そのフォーマットで変換できなかった値は年月日順の固定レイアウトで
+    再変換する（いずれも要素ごとのPython処理なし）。変換できない値は欠損値になる。
+    date_formatを指定した場合は、そのフォーマットに一致しない値（空欄を除く）が
+    あるとValueErrorを送出する（pd.to_datetime(format=...)と同じく厳密に変換する）。
+
+    Parameters:
+    -----------
+    column : pyarrow.Array or pyarrow.ChunkedArray
+        日時の文字列の列
+    fingerprint : str, optional
+        ヘッダーのフィンガープリント（フォーマットの記憶に使用）
+    date_format : str, optional
+        明示的に指定するstrptime形式のフォーマット
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if not pa.types.is_string(column.type):
+        column = column.cast(pa.string())
+
+    if date_format:
+        return _parse_strict(column, date_format)
+
+    fmt = _FORMAT_CACHE.get(fingerprint) if fingerprint else None
+    if fmt is not None:
+        result = _parse_with_format(column, fmt)
+        # 記憶したフォーマットで全く変換できない場合は判定し直す
+        if result.null_count < len(result) or column.null_count == len(column):
+            return result
+
+    fmt = detect_date_format(column)
+    if fingerprint and fmt is not None:
+        _FORMAT_CACHE[fingerprint] = fmt
+
+    if fmt is None:
+        print("日付フォーマットを自動推測します")
+        return _parse_inferred(column)
+    return _parse_with_format(column, fmt)
+
+
+def parse_timestamps_pandas(series, fingerprint=None, date_format=None):
+    """parse_timestamps_arrowのpandas版（datetime64のSeriesを返す）"""
+    import pandas as pd
+
+    try:
+        column = pa.array(series, from_pandas=True, type=pa.string())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        column = pa.array(series.astype(str), type=pa.string())
+
+    result = parse_timestamps_arrow(column, fingerprint, date_format)
+    return pd.Series(result.to_numpy(zero_copy_only=False), index=series.index, name=series.name)
+
+
+def detect_date_format(column):
+    """
+    先頭の値のサンプルから日付フォーマットを判定する
+    判定できない場合はNoneを返す
+    """
+    sample = pc.drop_null(column)[:SAMPLE_SIZE]
+    if len(sample) == 0:
+        return None
+
+    for fmt in DATE_FORMATS:
+        try:
+            pc.strptime(sample, format=fmt, unit='us')
+        except (pa.ArrowInvalid, ValueError):
+            continue
+        print(f"検出された日付フォーマット: {fmt}")
+        return fmt
+
+    if pc.all(pc.match_substring_regex(sample, _FAST_PATTERN)).as_py():
+        return FAST_LAYOUT
+    return None
+
+
+def clear_format_cache():
+    """記憶したフォーマットを消去する"""
+    _FORMAT_CACHE.clear()
+
+
+def _parse_strict(column, fmt):
+    """指定されたフォーマットだけで変換する（一致しない値がある場合はValueError）"""
+    if fmt == FAST_LAYOUT:
+        result = parse_fixed_layout(column)
+    else:
+        result = pc.strptime(column, format=fmt, unit='us', error_is_null=True)
+    invalid = pc.and_(pc.is_null(result), pc.not_equal(pc.utf8_trim_whitespace(column), ''))
+    invalid_count = pc.sum(pc.fill_null(invalid, False)).as_py() or 0
+    if invalid_count:
+        examples = pc.filter(column, pc.fill_null(invalid, False))[:3].to_pylist()
+        raise ValueError(f"日付フォーマット {fmt} に一致しない値が{invalid_count}件あります（例: {examples}）")
+    return result
+
+
+def _parse_with_format(column, fmt):
+    if fmt == FAST_LAYOUT:
+        return parse_fixed_layout(column)
+
+    result = pc.strptime(column, format=fmt, unit='us', error_is_null=True)
+    if result.null_count > column.null_count:
+        # フォーマットに一致しない値だけ固定レイアウトで変換し直す
+        result = pc.coalesce(result, parse_fixed_layout(column))
+    return result
+
+
+def parse_fixed_layout(column):
+    """
+    年月日順の固定レイアウトの日時文字列をベクトル演算で変換する
+
+    Arrowの文字列配列のバイト列を直接numpyで走査し、数字の連続を
+    年・月・日・時・分・秒・小数秒の順に取り出して1970-01-01からの
+    マイクロ秒に変換する。レイアウトに一致しない値や存在しない日付
+    （2月30日など）は欠損値になる。
+    """
+    n = len(column)
+    valid = pc.fill_null(pc.match_substring_regex(column, _FAST_PATTERN), False)
+    valid = valid.to_numpy(zero_copy_only=False)
+
+    fields = _digit_fields(column, n_fields=7)
+    year, month, day, hour, minute, second, micro = fields.T
+
+    valid &= (month >= 1) & (month <= 12) & (day >= 1)
+    valid &= (hour < 24) & (minute < 60) & (second < 60)
+    valid &= day <= _days_in_month(year, np.clip(month, 1, 12))
+
+    days = _days_from_civil(year, month, day)
+    micros = ((days * 86400 + hour * 3600 + minute * 60 + second) * 1_000_000 + micro)
+
+    return pa.array(micros, type=pa.int64(), mask=~valid).cast(pa.timestamp('us'))
+
+
+def _digit_fields(column, n_fields):
+    """
+    文字列配列の各要素から数字の連続をn_fields個まで取り出し、(要素数, n_fields)の
+    整数配列として返す。最後のフィールドは小数秒としてマイクロ秒に換算する
+
+    UTF-8のマルチバイト文字（年・月・日など）のバイトは0x30-0x39にならないため、
+    バイト単位で数字を判定できる。
+    """
+    n = len(column)
+    fields = np.zeros((n, n_fields), dtype=np.int64)
+
+    _, offset_buf, data_buf = column.buffers()
+    if n == 0 or data_buf is None:
+        return fields
+
+    offsets = np.frombuffer(offset_buf, dtype=np.int32)[column.offset:column.offset + n + 1]
+    data = np.frombuffer(data_buf, dtype=np.uint8)[offsets[0]:offsets[-1]]
+    offsets = offsets - offsets[0]
+
+    digit = (data >= 48) & (data <= 57)
+    if not digit.any():
+        return fields
+
+    # 各バイトが属する要素の番号（空の要素はバイトを持たないので飛ばす）
+    nonempty_rows = np.flatnonzero(np.diff(offsets) > 0)
+    row_step = np.zeros(len(data), dtype=np.int32)
+    row_step[offsets[nonempty_rows]] = np.diff(nonempty_rows, prepend=0)
+    row_of_byte = np.cumsum(row_step, dtype=np.int32)
+    boundary = row_step.astype(bool)
+
+    # 数字の連続（ラン）の開始・終了位置
+    is_start = digit.copy()
+    is_start[1:] &= ~digit[:-1] | boundary[1:]
+    is_end = digit.copy()
+    is_end[:-1] &= ~digit[1:] | boundary[1:]
+    run_starts = np.flatnonzero(is_start)
+    run_len = np.flatnonzero(is_end) - run_starts + 1
+
+    # ランの値を上位桁から順に計算する（桁数の多いランはレイアウト外なので打ち切る）
+    run_value = np.zeros(len(run_starts), dtype=np.int64)
+    last_byte = len(data) - 1
+    for j in range(min(int(run_len.max()), 9)):
+        digit_value = data[np.minimum(run_starts + j, last_byte)].astype(np.int64) - 48
+        run_value = np.where(run_len > j, run_value * 10 + digit_value, run_value)
+
+    # ランが属する要素と、要素内でのフィールド番号
+    run_row = row_of_byte[run_starts]
+    new_row = np.ones(len(run_starts), dtype=bool)
+    new_row[1:] = run_row[1:] != run_row[:-1]
+    first_run = np.flatnonzero(new_row)
+    field_no = np.arange(len(run_starts)) - first_run[np.cumsum(new_row) - 1]
+
+    # 小数秒は桁数に応じてマイクロ秒に換算する
+    last = field_no == n_fields - 1
+    run_value[last] *= 10 ** (6 - np.clip(run_len[last], 0, 6))
+
+    keep = field_no < n_fields
+    fields[run_row[keep], field_no[keep]] = run_value[keep]
+    return fields
+
+
+def _days_from_civil(year, month, day):
+    """グレゴリオ暦の年月日を1970-01-01からの日数に変換する（H. Hinnantのアルゴリズム）"""
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    mp = (month + 9) % 12
+    doy = (153 * mp + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def _days_in_month(year, month):
+    days = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[month]
+    leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+    return days + ((month == 2) & leap)
+
+
+def _parse_inferred(column):
+    """フォーマットが判定できない場合にpandasの推測で変換する（低速）"""
+    import pandas as pd
+
+    values = pd.to_datetime(column.to_pandas(), errors='coerce')
+    return pa.array(values, from_pandas=True).cast(pa.timestamp('us'))